@@ -0,0 +1,158 @@
+"""Measure one dataset run in a fresh process: wall time per stage, rows loaded and peak RSS."""
+
+import functools
+import importlib
+import inspect
+import os
+import resource
+import sys
+import time
+
+# functions timed in every `datasets` module that imports them
+STAGES = [
+    "download",
+    "read_file",
+    "read_chunks",
+    "read_csv_chunks",
+    "save_postgis",
+    "save_postgis_chunks",
+    "copy_postgis",
+    "optimize_table",
+    "prepare_geometries",
+    "write_artifact",
+    "create_stac_item",
+    "coverage_variants",
+    "tiles_stage",
+    "compute_exposure",
+    "run_tasks",
+]
+LOADER_STAGES = ["add_collections", "add_item", "add_items", "flush"]
+
+TABLES_QUERY = """
+SELECT c.relname, c.oid
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p') AND NOT c.relispartition
+"""
+
+
+def _timed(fn, name: str, stats: dict):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stage = stats.setdefault(name, {"calls": 0, "seconds": 0.0})
+            stage["calls"] += 1
+            stage["seconds"] += time.perf_counter() - start
+
+    return wrapper
+
+
+def instrument(stats: dict):
+    """Wrap the STAGES functions wherever they were imported, and the pgstac loader methods.
+
+    Calls are nested (e.g. `utils.optimize_table` runs inside `utils.save_postgis`),
+    and stages run in worker processes are only timed as a whole (`scheduler.run_tasks`).
+    """
+    import geopandas
+    from datasets.pgstac_loader import StacLoader
+
+    wrappers = {}
+
+    def wrap(fn, name):
+        if fn not in wrappers:
+            wrappers[fn] = _timed(fn, name, stats)
+        return wrappers[fn]
+
+    for module_name, module in list(sys.modules.items()):
+        if module is None or not module_name.startswith("datasets"):
+            continue
+        for attr in STAGES:
+            fn = getattr(module, attr, None)
+            if inspect.isfunction(fn) and fn.__module__.startswith("datasets."):
+                setattr(module, attr, wrap(fn, f"{fn.__module__[len('datasets.'):]}.{attr}"))
+    for attr in LOADER_STAGES:
+        setattr(StacLoader, attr, wrap(getattr(StacLoader, attr), f"pgstac_loader.{attr}"))
+    geopandas.read_file = wrap(geopandas.read_file, "geopandas.read_file")
+
+
+def localize_module(module, base_url: str):
+    """Point the URL constants of a dataset module to the stand-in server."""
+    from benchmarks.server import localize
+
+    for name, value in list(vars(module).items()):
+        if name.isupper():
+            setattr(module, name, localize(value, base_url))
+
+
+def _tables() -> dict:
+    from datasets.db import get_pool
+
+    with get_pool().connection() as conn:
+        return dict(conn.execute(TABLES_QUERY).fetchall())
+
+
+def _new_rows(before: dict) -> dict:
+    """Row count of the tables created (or replaced) since before."""
+    from psycopg import sql
+    from datasets.db import get_pool
+
+    rows = {}
+    with get_pool().connection() as conn:
+        for table, oid in conn.execute(TABLES_QUERY).fetchall():
+            if before.get(table) != oid:
+                query = sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier("public", table))
+                rows[table] = conn.execute(query).fetchone()[0]
+    return rows
+
+
+def _max_rss_mb(who) -> float:
+    # ru_maxrss is in KB on Linux
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+def measure(dataset: str, params: dict, base_url: str, manifest_path: str) -> dict:
+    """Run dataset once, with its sources served by the stand-in at base_url.
+
+    Meant to run in a fresh (spawned) process, so that imports, peak RSS and
+    the download manifest are its own.
+
+    Return:
+        dict: wall_s, rows, rows_per_s, tables, peak_rss_mb, peak_children_rss_mb, stages, error
+    """
+    os.environ["INGEST_MANIFEST_PATH"] = manifest_path
+    from config import DATASETS
+    from orchestrator import run_dataset
+
+    module = importlib.import_module(DATASETS[dataset]["module"])
+    localize_module(module, base_url)
+    function = getattr(module, DATASETS[dataset]["function"])
+    if "force" in inspect.signature(function).parameters:
+        params = {**params, "force": True}
+    stats = {}
+    instrument(stats)
+
+    before = _tables()
+    error = None
+    start = time.perf_counter()
+    try:
+        run_dataset(dataset, params)
+    except Exception as ex:
+        error = repr(ex)
+    wall = time.perf_counter() - start
+    tables = _new_rows(before)
+    rows = sum(tables.values())
+    return {
+        "wall_s": round(wall, 3),
+        "rows": rows,
+        "rows_per_s": round(rows / wall, 1) if wall else None,
+        "tables": tables,
+        "peak_rss_mb": _max_rss_mb(resource.RUSAGE_SELF),
+        "peak_children_rss_mb": _max_rss_mb(resource.RUSAGE_CHILDREN),
+        "stages": {
+            name: {"calls": s["calls"], "seconds": round(s["seconds"], 3)}
+            for name, s in sorted(stats.items(), key=lambda kv: -kv[1]["seconds"])
+        },
+        "error": error,
+    }
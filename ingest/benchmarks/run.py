@@ -0,0 +1,181 @@
+"""Benchmark the dataset modules against synthetic sources, a local stand-in server and a local PostGIS+pgstac.
+
+Usage (from ingest/, with DATABASE_URL pointing to `docker compose up db`):
+    python -m benchmarks.run generate --scale 1
+    python -m benchmarks.run run --scale 1 --label my-change
+    python -m benchmarks.run compare benchmarks/results/a.json benchmarks/results/b.json
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import click
+from benchmarks.harness import measure
+from benchmarks.server import StandInServer
+from benchmarks.synthetic import generate
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DATA_DIR = "/tmp/eoapi-risk-bench/data"
+WORK_DIR = "/tmp/eoapi-risk-bench/work"
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+# in dependency order, exposure joins the tables of the others
+DATASETS = ["shakemap_peak", "admin_boundaries", "population", "buildings", "exposure"]
+# params overriding config.DATASETS for the synthetic sources
+PARAMS = {
+    "admin_boundaries": {"iso3_country": ["AFG"]},
+}
+# relative change counted as a regression by `compare`
+THRESHOLD = 0.10
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _sizes(data_dir: str) -> dict:
+    try:
+        with open(os.path.join(data_dir, "sizes.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def run_dataset(dataset: str, base_url: str, work_dir: str) -> dict:
+    """Measure dataset in a spawned process, so that peak RSS and imports are its own."""
+    params = {**PARAMS.get(dataset, {}), "path_local": os.path.join(work_dir, dataset)}
+    manifest_path = os.path.join(work_dir, ".ingest_manifest.json")
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(measure, dataset, params, base_url, manifest_path).result()
+
+
+def _report(results: dict):
+    click.echo(f"{'dataset':<18}{'wall s':>10}{'rows':>12}{'rows/s':>12}{'RSS MB':>10}  top stages")
+    for dataset, r in results.items():
+        stages = ", ".join(f"{n} {s['seconds']:.1f}s" for n, s in list(r["stages"].items())[:3])
+        click.echo(
+            f"{dataset:<18}{r['wall_s']:>10.1f}{r['rows']:>12}{r['rows_per_s'] or 0:>12.0f}"
+            f"{max(r['peak_rss_mb'], r['peak_children_rss_mb']):>10.0f}  {stages}"
+            + (f"  ERROR {r['error']}" if r["error"] else "")
+        )
+
+
+@click.group()
+def main():
+    """Offline benchmarks of the ingest pipeline."""
+
+
+@main.command("generate")
+@click.option("--data-dir", default=DATA_DIR, show_default=True)
+@click.option("--scale", type=float, default=1.0, show_default=True, help="Multiplier of the source sizes.")
+def generate_command(data_dir, scale):
+    """Write the synthetic sources."""
+    generate(data_dir, scale)
+
+
+@main.command("run")
+@click.option("--datasets", default=",".join(DATASETS), show_default=True, help="Comma separated dataset names.")
+@click.option("--data-dir", default=DATA_DIR, show_default=True)
+@click.option("--work-dir", default=WORK_DIR, show_default=True)
+@click.option("--scale", type=float, default=1.0, show_default=True, help="Multiplier of the source sizes.")
+@click.option("--label", default="", help="Name of the run, added to the results file name.")
+@click.option("--output", default=RESULTS_DIR, show_default=True, help="Directory of the results files.")
+def run_command(datasets, data_dir, work_dir, scale, label, output):
+    """Run the datasets against the synthetic sources and save the results."""
+    if "DATABASE_URL" not in os.environ:
+        raise click.UsageError("DATABASE_URL must point to a local PostGIS+pgstac database")
+    if _sizes(data_dir).get("scale") != scale:
+        generate(data_dir, scale)
+    names = [d.strip() for d in datasets.split(",") if d.strip()]
+
+    results = {}
+    with StandInServer(data_dir) as server:
+        for dataset in names:
+            logger.info(f"Benchmarking {dataset}")
+            results[dataset] = run_dataset(dataset, server.url, work_dir)
+
+    created_at = datetime.now(timezone.utc)
+    revision = _git_revision()
+    report = {
+        "label": label,
+        "revision": revision,
+        "created_at": created_at.isoformat(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "sizes": _sizes(data_dir),
+        "datasets": results,
+    }
+    os.makedirs(output, exist_ok=True)
+    name = "_".join(p for p in [created_at.strftime("%Y%m%dT%H%M%S"), revision, label] if p)
+    path = os.path.join(output, f"{name}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    _report(results)
+    click.echo(f"Results saved to {path}")
+    sys.exit(1 if any(r["error"] for r in results.values()) else 0)
+
+
+def compare_results(baseline: dict, current: dict, threshold: float = THRESHOLD) -> list:
+    """Return the (dataset, metric, baseline, current, change) rows of the metrics worse than threshold."""
+    regressions = []
+    # metric -> True if higher is better
+    metrics = {"wall_s": False, "rows_per_s": True, "peak_rss_mb": False, "peak_children_rss_mb": False}
+    for dataset, new in current["datasets"].items():
+        old = baseline["datasets"].get(dataset)
+        if not old:
+            continue
+        values = [(m, old.get(m), new.get(m), higher) for m, higher in metrics.items()]
+        values += [
+            (f"stage {stage}", s["seconds"], new["stages"].get(stage, {}).get("seconds"), False)
+            for stage, s in old["stages"].items()
+        ]
+        for metric, a, b, higher_is_better in values:
+            if not a or b is None:
+                continue
+            change = (b - a) / a
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append((dataset, metric, a, b, change))
+    return regressions
+
+
+@main.command("compare")
+@click.argument("baseline", type=click.Path(exists=True))
+@click.argument("current", type=click.Path(exists=True))
+@click.option("--threshold", type=float, default=THRESHOLD, show_default=True, help="Relative change counted as a regression.")
+def compare_command(baseline, current, threshold):
+    """Compare two results files, exit with 1 if CURRENT regressed."""
+    with open(baseline) as f:
+        baseline = json.load(f)
+    with open(current) as f:
+        current = json.load(f)
+    if baseline.get("sizes") != current.get("sizes"):
+        click.echo("Warning: the runs used different source sizes")
+    for dataset, new in current["datasets"].items():
+        old = baseline["datasets"].get(dataset)
+        if old:
+            click.echo(
+                f"{dataset:<18} wall {old['wall_s']:.1f}s -> {new['wall_s']:.1f}s, "
+                f"rows/s {old['rows_per_s'] or 0:.0f} -> {new['rows_per_s'] or 0:.0f}, "
+                f"RSS {old['peak_rss_mb']:.0f} -> {new['peak_rss_mb']:.0f} MB"
+            )
+    regressions = compare_results(baseline, current, threshold)
+    for dataset, metric, a, b, change in regressions:
+        click.echo(f"REGRESSION {dataset} {metric}: {a} -> {b} ({change:+.0%})")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
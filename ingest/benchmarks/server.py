@@ -0,0 +1,106 @@
+"""Local HTTP stand-in for the HDX, GADM and USGS hosts, serving the synthetic sources."""
+
+import html
+import json
+import logging
+import os
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# hosts of the dataset modules, replaced by the stand-in URL
+HOSTS = [
+    "https://data.humdata.org",
+    "https://geodata.ucdavis.edu",
+    "https://earthquake.usgs.gov",
+]
+
+
+class StandInHandler(SimpleHTTPRequestHandler):
+    """Files from the data directory, plus rendered HDX dataset pages (`/dataset/<slug>`)."""
+
+    def __init__(self, *args, pages=None, **kwargs):
+        self.pages = pages or {}
+        super().__init__(*args, **kwargs)
+
+    def _page(self):
+        slug = self.path.split("?")[0].rstrip("/").split("/")[-1]
+        if not self.path.startswith("/dataset/") or slug not in self.pages:
+            return None
+        base = f"http://{self.headers.get('Host')}"
+        links = "\n".join(
+            f'<a class="resource-url" href="{html.escape(f"{base}/{path}")}">{html.escape(path)}</a>'
+            for path in self.pages[slug]
+        )
+        return f"<html><body><h1>{html.escape(slug)}</h1>\n{links}\n</body></html>".encode()
+
+    def _send_page(self, body, head=False):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        body = self._page()
+        if body is None:
+            return super().do_GET()
+        self._send_page(body)
+
+    def do_HEAD(self):
+        body = self._page()
+        if body is None:
+            return super().do_HEAD()
+        self._send_page(body, head=True)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class StandInServer:
+    """Serve a directory written by `synthetic.generate` on localhost, in a thread.
+
+    Usage:
+        with StandInServer("/tmp/bench-data") as server:
+            localize("https://data.humdata.org/dataset/...", server.url)
+    """
+
+    def __init__(self, directory: str, port: int = 0):
+        with open(os.path.join(directory, "pages.json")) as f:
+            pages = json.load(f)
+        handler = partial(StandInHandler, directory=directory, pages=pages)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"Stand-in server on {self.url}")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return False
+
+
+def localize(value, base_url: str):
+    """Replace the real hosts by base_url in the strings of value (str, dict keys/values, lists)."""
+    if isinstance(value, str):
+        for host in HOSTS:
+            value = value.replace(host, base_url)
+        return value
+    if isinstance(value, dict):
+        return {localize(k, base_url): localize(v, base_url) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(localize(v, base_url) for v in value)
+    return value
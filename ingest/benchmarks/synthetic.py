@@ -0,0 +1,326 @@
+"""Synthetic sources shaped like the real ones, laid out under the URL paths of their hosts.
+
+Every file is written at `<out>/<url path>`, so that `server.py` can serve the
+directory in place of data.humdata.org, geodata.ucdavis.edu and
+earthquake.usgs.gov. HDX dataset pages are described in `pages.json` and
+rendered by the server, as their links have to point back to it.
+"""
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+import geopandas as gpd
+import h3
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Herat, Afghanistan (around the epicenter of the real Shakemap)
+CENTER = (62.03, 34.60)
+COUNTRY_BOUNDS = (60.5, 29.4, 74.9, 38.5)
+SHAKEMAP_PATH = "product/shakemap/us6000lfn5/us/1703038955396/download/shape.zip"
+# the server ignores query strings, every event id gets this detail document
+EVENT_DETAIL_PATH = "fdsnws/event/1/query"
+EVENT_FEED_PATH = "earthquakes/feed/v1.0/summary/significant_week.geojson"
+SHAKEMAP_LAYERS = ["psa1p0", "mi", "pga", "pgv", "psa0p3", "psa3p0"]
+SHAKEMAP_RASTER_PATH = "product/shakemap/us6000lfn5/us/1703038955396/download/raster.zip"
+# metric -> peak value at the epicenter, decreasing with distance
+SHAKEMAP_GRIDS = {"mmi": 8.0, "pga": 60.0, "pgv": 50.0, "psa0p3": 120.0, "psa1p0": 40.0, "psa3p0": 10.0}
+
+# number of features per source at scale 1
+SIZES = {
+    "hexbins": 50_000,
+    "buildings": 200_000,
+    "contour_bands": 12,
+    "contour_vertices": 2_000,
+    "grid_size": 500,
+    "admin_units": [1, 34, 400],
+    "admin_vertices": 200,
+}
+
+
+def scaled_sizes(scale: float = 1.0) -> dict:
+    return {
+        "hexbins": int(SIZES["hexbins"] * scale),
+        "buildings": int(SIZES["buildings"] * scale),
+        "contour_bands": SIZES["contour_bands"],
+        "contour_vertices": max(64, int(SIZES["contour_vertices"] * scale)),
+        "grid_size": max(16, int(SIZES["grid_size"] * scale**0.5)),
+        "admin_units": [max(1, int(n * scale)) if n > 1 else 1 for n in SIZES["admin_units"]],
+        "admin_vertices": max(8, int(SIZES["admin_vertices"] * scale)),
+    }
+
+
+def _target(out: str, path: str) -> str:
+    target = os.path.join(out, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    return target
+
+
+def _zip(target: str, files: list, arcnames: list = None):
+    with zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED) as zf:
+        for i, file_path in enumerate(files):
+            zf.write(file_path, arcnames[i] if arcnames else os.path.basename(file_path))
+
+
+def hexbins(n: int, res: int = 8, seed: int = 0) -> gpd.GeoDataFrame:
+    """About n H3 cells around CENTER with a population, in EPSG:3857 like Kontur."""
+    rng = np.random.default_rng(seed)
+    k = int(np.ceil((-3 + np.sqrt(9 + 12 * max(n - 1, 0))) / 6))
+    cells = sorted(h3.grid_disk(h3.latlng_to_cell(CENTER[1], CENTER[0], res), k))[:n]
+    polygons = [shapely.Polygon([(lng, lat) for lat, lng in h3.cell_to_boundary(c)]) for c in cells]
+    gdf = gpd.GeoDataFrame(
+        {"h3": cells, "population": rng.lognormal(3, 1.5, len(cells)).round(1)},
+        geometry=polygons,
+        crs=4326,
+    )
+    return gdf.to_crs(3857)
+
+
+def buildings(n: int, seed: int = 0) -> gpd.GeoDataFrame:
+    """n small rectangles scattered around CENTER, with OSM and Open Buildings attributes."""
+    rng = np.random.default_rng(seed)
+    x = CENTER[0] + rng.normal(0, 0.3, n)
+    y = CENTER[1] + rng.normal(0, 0.2, n)
+    # 5 to 30 m sides
+    w = rng.uniform(5, 30, n) / 111_000
+    h = rng.uniform(5, 30, n) / 111_000
+    geometry = shapely.box(x - w / 2, y - h / 2, x + w / 2, y + h / 2)
+    return gpd.GeoDataFrame(
+        {
+            "osm_id": np.arange(n, dtype=np.int64) + 1_000_000,
+            "building": rng.choice(["yes", "house", "residential", "school"], n),
+            "name": pd.Series([None] * n, dtype=object),
+            "confidence": rng.uniform(0.65, 1, n).round(4),
+        },
+        geometry=geometry,
+        crs=4326,
+    )
+
+
+def contour_bands(bands: int, vertices: int, seed: int = 0) -> gpd.GeoDataFrame:
+    """Nested, irregular rings around CENTER, the highest value in the middle, like Shakemap contours."""
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    radii = np.linspace(2.0, 0.05, bands + 1)
+    rings = []
+    for radius in radii:
+        r = radius * (1 + 0.15 * np.sin(3 * angles + rng.uniform(0, np.pi)) + rng.normal(0, 0.01, vertices))
+        rings.append(shapely.Polygon(np.c_[CENTER[0] + r * np.cos(angles), CENTER[1] + r * np.sin(angles)]))
+    geometry = [shapely.difference(rings[i], rings[i + 1]) for i in range(bands)] + [rings[-1]]
+    values = np.linspace(2, 8, bands + 1).round(1)
+    return gpd.GeoDataFrame(
+        {"GRID_CODE": np.arange(len(values)), "PARAMVALUE": values},
+        geometry=geometry,
+        crs=4326,
+    )
+
+
+def admin_levels(units: list, vertices: int, iso3: str = "AFG", seed: int = 0) -> list:
+    """GADM like coverages, one GeoDataFrame of MultiPolygons per level.
+
+    Level 0 is the country, level n is a Voronoi partition of it into units[n]
+    units, with the names and GIDs of the units of the upper levels.
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = COUNTRY_BOUNDS
+    points = np.c_[rng.uniform(minx, maxx, 64), rng.uniform(miny, maxy, 64)]
+    country = shapely.convex_hull(shapely.MultiPoint(points))
+    country = shapely.segmentize(country, country.length / vertices)
+    levels = []
+    for adm, n in enumerate(units):
+        if adm == 0:
+            geometry = [country]
+        else:
+            seeds = shapely.MultiPoint(np.c_[rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n)])
+            cells = shapely.get_parts(shapely.voronoi_polygons(seeds, extend_to=country))
+            cells = shapely.intersection(cells, country)
+            cells = cells[~shapely.is_empty(cells)]
+            geometry = shapely.segmentize(cells, country.length / vertices / 4)
+        geometry = [g if g.geom_type == "MultiPolygon" else shapely.MultiPolygon([g]) for g in geometry]
+        gdf = gpd.GeoDataFrame(
+            {"GID_0": [iso3] * len(geometry), "COUNTRY": ["Afghanistan"] * len(geometry)},
+            geometry=geometry,
+            crs=4326,
+        )
+        points = gpd.GeoDataFrame(geometry=gdf.representative_point(), crs=4326)
+        for upper in range(1, adm + 1):
+            parent = levels[upper] if upper < adm else None
+            if parent is None:
+                ids = np.arange(1, len(gdf) + 1)
+            else:
+                joined = gpd.sjoin(points, parent[["geometry"]], how="left", predicate="within")
+                ids = joined[~joined.index.duplicated()]["index_right"].fillna(0).astype(int).to_numpy() + 1
+            gdf[f"GID_{upper}"] = [f"{iso3}.{i}_1" for i in ids]
+            gdf[f"NAME_{upper}"] = [f"Unit {upper}.{i}" for i in ids]
+            gdf[f"HASC_{upper}"] = [f"AF.{upper}{i:03d}" for i in ids]
+        levels.append(gdf)
+    return levels
+
+
+def write_population(out: str, n: int) -> str:
+    path = "files/kontur_population_AF_20231101.gpkg.gz"
+    with tempfile.TemporaryDirectory() as tmp:
+        gpkg = os.path.join(tmp, "kontur_population_AF_20231101.gpkg")
+        hexbins(n).to_file(gpkg, driver="GPKG", layer="population")
+        with open(gpkg, "rb") as src, gzip.open(_target(out, path), "wb") as dst:
+            shutil.copyfileobj(src, dst)
+    return path
+
+
+def write_buildings(out: str, n: int) -> tuple:
+    gdf = buildings(n)
+    osm_path = "files/hotosm_afg_buildings_polygons_gpkg.zip"
+    with tempfile.TemporaryDirectory() as tmp:
+        gpkg = os.path.join(tmp, "hotosm_afg_buildings_polygons.gpkg")
+        gdf[["osm_id", "building", "name", "geometry"]].to_file(gpkg, driver="GPKG")
+        _zip(_target(out, osm_path), [gpkg])
+
+    csv_path = "files/afghanistan-herat-earthquake-epicenter-googleresearch.csv"
+    centroids = shapely.centroid(gdf.geometry.to_numpy())
+    pd.DataFrame(
+        {
+            "latitude": shapely.get_y(centroids).round(7),
+            "longitude": shapely.get_x(centroids).round(7),
+            "area_in_meters": gdf.to_crs(6933).area.round(4),
+            "confidence": gdf["confidence"],
+            "geometry": gdf.geometry.to_wkt(),
+            "full_plus_code": "8FVC0000+00",
+        }
+    ).to_csv(_target(out, csv_path), index=False)
+    return osm_path, csv_path
+
+
+def write_shakemap(out: str, bands: int, vertices: int) -> str:
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for i, layer in enumerate(SHAKEMAP_LAYERS):
+            shp = os.path.join(tmp, f"{layer}.shp")
+            contour_bands(bands, vertices, seed=i).to_file(shp, driver="ESRI Shapefile")
+            files += [os.path.join(tmp, f"{layer}.{ext}") for ext in ("shp", "shx", "dbf", "prj")]
+        _zip(_target(out, SHAKEMAP_PATH), files)
+    return SHAKEMAP_PATH
+
+
+def write_shakemap_raster(out: str, size: int) -> str:
+    """ESRI .flt/.hdr grids of every metric (mean and std) around CENTER, like the Shakemap raster.zip."""
+    resolution = 4.0 / size
+    transform = from_origin(CENTER[0] - 2, CENTER[1] + 2, resolution, resolution)
+    ys, xs = np.mgrid[0:size, 0:size]
+    distance = np.hypot(xs - size / 2, ys - size / 2) / (size / 2)
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for metric, peak in SHAKEMAP_GRIDS.items():
+            for stat, values in [("mean", peak * np.exp(-3 * distance)), ("std", np.full_like(distance, 0.6))]:
+                flt = os.path.join(tmp, f"{metric}_{stat}.flt")
+                with rasterio.open(
+                    flt,
+                    "w",
+                    driver="EHdr",
+                    width=size,
+                    height=size,
+                    count=1,
+                    dtype="float32",
+                    crs="EPSG:4326",
+                    transform=transform,
+                ) as dst:
+                    dst.write(values.astype(np.float32), 1)
+                files += [flt, flt[: -len(".flt")] + ".hdr"]
+        _zip(_target(out, SHAKEMAP_RASTER_PATH), files)
+    return SHAKEMAP_RASTER_PATH
+
+
+def write_event(out: str, event_id: str = "us6000lfn5") -> tuple:
+    """USGS event detail and feed documents pointing to the synthetic shakemap, with relative links."""
+    detail = {
+        "type": "Feature",
+        "id": event_id,
+        "properties": {
+            "title": "M 6.3 - 34 km NNW of Herat, Afghanistan",
+            "time": 1697284800000,
+            "mag": 6.3,
+            "products": {
+                "shakemap": [
+                    {
+                        "status": "UPDATE",
+                        "preferredWeight": 1,
+                        "updateTime": 1703038955396,
+                        "properties": {"maximum-mmi": "8.0"},
+                        "contents": {
+                            "download/shape.zip": {"url": f"/{SHAKEMAP_PATH}"},
+                            "download/raster.zip": {"url": f"/{SHAKEMAP_RASTER_PATH}"},
+                        },
+                    }
+                ]
+            },
+        },
+        "geometry": {"type": "Point", "coordinates": [*CENTER, 10]},
+    }
+    feed = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                **detail,
+                "properties": {
+                    **{k: v for k, v in detail["properties"].items() if k != "products"},
+                    "types": ",origin,shakemap,",
+                    "updated": 1703038955396,
+                    "detail": f"/{EVENT_DETAIL_PATH}?eventid={event_id}&format=geojson",
+                },
+            }
+        ],
+    }
+    for path, document in [(EVENT_DETAIL_PATH, detail), (EVENT_FEED_PATH, feed)]:
+        with open(_target(out, path), "w") as f:
+            json.dump(document, f)
+    return EVENT_DETAIL_PATH, EVENT_FEED_PATH
+
+
+def write_gadm(out: str, units: list, vertices: int, iso3: str = "AFG") -> list:
+    paths = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for adm, gdf in enumerate(admin_levels(units, vertices, iso3)):
+            name = f"gadm41_{iso3}_{adm}.json"
+            json_path = os.path.join(tmp, name)
+            gdf.to_file(json_path, driver="GeoJSON")
+            path = f"gadm/gadm4.1/json/{name}.zip"
+            _zip(_target(out, path), [json_path])
+            paths.append(path)
+    return paths
+
+
+def generate(out: str, scale: float = 1.0) -> dict:
+    """Write every synthetic source under out.
+
+    Return:
+        dict: Sizes used, also saved to `<out>/sizes.json`.
+    """
+    sizes = scaled_sizes(scale)
+    os.makedirs(out, exist_ok=True)
+    population = write_population(out, sizes["hexbins"])
+    osm_buildings, csv_buildings = write_buildings(out, sizes["buildings"])
+    write_shakemap(out, sizes["contour_bands"], sizes["contour_vertices"])
+    write_shakemap_raster(out, sizes["grid_size"])
+    write_event(out)
+    write_gadm(out, sizes["admin_units"], sizes["admin_vertices"])
+    # HDX dataset pages: slug -> file paths linked from the page
+    pages = {
+        "kontur-population-afghanistan": [population],
+        "hotosm_afg_buildings": [osm_buildings],
+        "afghanistan-buildings-footprint-herat-province": [csv_buildings],
+    }
+    with open(os.path.join(out, "pages.json"), "w") as f:
+        json.dump(pages, f, indent=2)
+    with open(os.path.join(out, "sizes.json"), "w") as f:
+        json.dump({"scale": scale, **sizes}, f, indent=2)
+    logger.info(f"Synthetic sources written to {out}: {sizes}")
+    return sizes
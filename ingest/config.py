@@ -1,37 +1,113 @@
+import os
+
+# Slots available to the orchestrator (`entrypoint.py run-all`), shared by the
+# stages running at the same time. Stages declare what they use in "resources".
+RESOURCE_LIMITS = {
+    "network": int(os.environ.get("INGEST_NETWORK_SLOTS", 3)),
+    "cpu": int(os.environ.get("INGEST_CPU_SLOTS", os.cpu_count() or 2)),
+    "db": int(os.environ.get("INGEST_DB_SLOTS", 4)),
+}
+MAX_WORKERS = int(os.environ.get("INGEST_MAX_WORKERS", 4))
+
+# "collection": collection.json loaded into pgstac before the items stage
+# "depends_on": datasets whose tables must be loaded first
 DATASETS = {
     "maxar_opendata": {
         "module": "datasets.maxar_opendata.process",
         "function": "generate",
-        "params": {"output_dir": "/data/maxar_opendata", "limit": 2},
+        "params": {"output_dir": "/data/maxar_opendata", "limit": None, "concurrency": 32},
+        "depends_on": [],
+        "resources": {"network": 1, "db": 1},
     },
     "buildings": {
         "module": "datasets.buildings.process",
         "function": "run",
-        "params": {"path_local": "/data/buildings"},
+        "collection": "datasets/buildings/collection.json",
+        "depends_on": [],
+        "resources": {"network": 1, "cpu": 1, "db": 2},
+        "params": {
+            "path_local": "/data/buildings",
+            "artifact_format": "flatgeobuf",
+            "memory_budget_mb": 512,
+            "optimize": {"cluster": "hilbert"},
+            "tiles": {"minzoom": 10, "maxzoom": 14, "columns": ["id"]},
+        },
     },
     "health_facilities": {
         "module": "datasets.health_facilities.process",
         "function": "run",
-        "params": {"path_local": "/data/health_facilities"},
+        "collection": "datasets/health_facilities/collection.json",
+        "depends_on": [],
+        "resources": {"network": 1, "cpu": 1, "db": 1},
+        "params": {
+            "path_local": "/data/health_facilities",
+            "artifact_format": "geoparquet",
+            "optimize": {"cluster": None},
+        },
     },
     "population": {
         "module": "datasets.population.process",
         "function": "run",
-        "params": {"path_local": "/data/population"},
+        "collection": "datasets/population/collection.json",
+        "depends_on": [],
+        "resources": {"network": 1, "cpu": 1, "db": 2},
+        "params": {
+            "path_local": "/data/population",
+            "artifact_format": "geoparquet",
+            "memory_budget_mb": 512,
+            "h3_parents": [6, 4],
+            "optimize": {"cluster": "hilbert", "btree": ["h3", "h3_res6", "h3_res4"]},
+            "tiles": {"minzoom": 4, "maxzoom": 11, "columns": ["population"]},
+        },
     },
     "admin_boundaries": {
         "module": "datasets.admin_boundaries.process",
         "function": "run",
+        "collection": "datasets/admin_boundaries/collection.json",
+        "depends_on": [],
+        "resources": {"network": 1, "cpu": 2, "db": 2},
         "params": {
-            "iso3_country": ["USA"],
+            "iso3_country": ["USA", "AFG"],
             "path_local": "/data/admin_boundaries",
+            "artifact_format": "geoparquet",
+            "optimize": {"cluster": "cluster"},
+            "generalize_zooms": [4, 8],
+            "memory_limit_mb": 4096,
+            "db_connections": 4,
         },
     },
     "shakemap_peak": {
         "module": "datasets.shakemap_peak.process",
         "function": "run",
+        "collection": "datasets/shakemap_peak/collection.json",
+        "depends_on": [],
+        "resources": {"network": 1, "cpu": 1, "db": 1},
         "params": {
             "path_local": "/data",
+            "optimize": {"cluster": None},
+            # event id -> slug of the table names, see `watch-shakemap` to follow the USGS feed
+            "events": {"us6000lfn5": "afg"},
+        },
+    },
+    "exposure": {
+        "module": "datasets.exposure.process",
+        "function": "run",
+        "collection": "datasets/exposure/collection.json",
+        "depends_on": ["shakemap_peak", "population", "buildings", "admin_boundaries"],
+        "resources": {"cpu": 1, "db": 2},
+        "params": {
+            "path_local": "/data/exposure",
+            "hazard_tables": {
+                "mi": "earthquake_usgs_gov_shakemap_afg_mi",
+                "pga": "earthquake_usgs_gov_shakemap_afg_pga",
+            },
+            "admin_table": "admin_boundaries_afg_adm2",
+            "admin_columns": ["adm1_name", "adm2_name"],
+            "population_table": "population_hexbins_afghanistan",
+            "buildings_table": "buildings_hotosm_afg_osm",
+            "method": "h3",
+            "artifact_format": "geoparquet",
+            "optimize": {"cluster": None},
         },
     },
 }
@@ -1,10 +1,19 @@
-from tqdm import tqdm
 import geopandas as gpd
 import logging
-from joblib import Parallel, delayed
-from ..utils import run_cli, save_postgis
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from ..utils import save_postgis, save_postgis_chunks
+from ..pgstac_loader import StacLoader
+from ..download import POOL_SIZE, TIMEOUT, download, get_session
+from ..readers import CHUNK_OVERHEAD, read_chunks
+from ..scheduler import DB_CONNECTIONS, MEMORY_LIMIT_MB, Task, TasksFailed, run_tasks
+from ..stac import create_stac_item
+from ..artifacts import media_type, write_artifact_async
+from ..generalize import coverage_variants
+from ..instrument import stage
+from ..geometry import prepare_geometries
 import json
-from os import makedirs, environ
+from os import makedirs
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -33,64 +42,159 @@ DESCRIPTION = (
 TITLE = "GADM {iso3} Administrative Level {adm} Data Overview"
 COLLECTION = "admin_boundaries"
 
+# Peak memory of a level read at once, from the size of its zipped GeoJSON:
+# the JSON is ~6x the zip, and the frame, the artifact and the COPY rows
+# each hold a copy of the geometries.
+BASE_MEMORY_MB = 300
+MEMORY_PER_ZIP_MB = 20
+# levels estimated above this are streamed in chunks of CHUNK_MEMORY_MB
+CHUNKED_ABOVE_MB = 2048
+CHUNK_MEMORY_MB = 256
 
-def dowload_gadm_data(iso3, adm, path_local):
+
+def _prepare(gdf, adm):
+    """Add the ID of the admin units and keep the renamed columns."""
+    if adm == 0:
+        gdf["ID"] = gdf["GID_0"]
+    else:
+        gdf["ID"] = gdf[f"GID_{adm}"].apply(lambda x: x.split("_")[0])
+
+    gdf_columns = list(gdf.columns)
+    rename_columns = {k: v for k, v in RENAME_COLUMNS.items() if k in gdf_columns}
+
+    if rename_columns:
+        gdf = gdf.rename(columns=rename_columns)
+        gdf = gdf[
+            [
+                *list(rename_columns.values()),
+                "geometry",
+            ]
+        ]
+    return gdf
+
+
+def estimate_memory_mb(gadm_url):
+    """Estimated peak memory (MB) to load gadm_url at once, None if the level does not exist.
+
+    A level whose size can't be known (e.g. a transient HTTP error) is planned at
+    CHUNKED_ABOVE_MB, the largest level loaded at once, its download reports the error.
+    """
+    try:
+        response = get_session().head(gadm_url, allow_redirects=True, timeout=TIMEOUT)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+    except requests.RequestException as ex:
+        logger.warning(f"Could not get the size of {gadm_url}: {ex}")
+        return CHUNKED_ABOVE_MB
+    size_mb = int(response.headers.get("Content-Length", 0)) / 1024**2
+    return int(BASE_MEMORY_MB + size_mb * MEMORY_PER_ZIP_MB)
+
+
+def dowload_gadm_data(
+    iso3,
+    adm,
+    path_local,
+    optimize=None,
+    artifact_format="geoparquet",
+    generalize_zooms=(),
+    chunked=False,
+):
     gadm_url = GADM_LINK.format(iso3=iso3, adm=adm)
     try:
-        gdf = gpd.read_file(gadm_url)
+        zip_path = f"{path_local}/{gadm_url.split('/')[-1]}"
+        download(gadm_url, zip_path)
+        source = f"/vsizip/{zip_path}/{gadm_url.split('/')[-1][:-4]}"
         # ##############
         # metadata
         # ##############
         item = f"{COLLECTION}_{iso3}_adm{adm}".lower()
         title = TITLE.format(iso3=iso3, adm=str(adm))
         description = DESCRIPTION.format(iso3=iso3, adm=str(adm))
-        args = {
-            "--id": item,
-            "--datetime": "2023-07-16",
-            "--collection": COLLECTION,
-            "--asset-href": gadm_url,
-        }
         # ##############
         # items
         ########
-        if adm == 0:
-            gdf["ID"] = gdf["GID_0"]
+        generalized = {}
+        if chunked:
+            # large level: streamed, the artifact is written along the COPY
+            logger.info(f"Saving {item} in DB in chunks..")
+            loaded = save_postgis_chunks(
+                (
+                    _prepare(chunk, adm)
+                    for chunk in read_chunks(
+                        source,
+                        memory_budget_mb=CHUNK_MEMORY_MB,
+                        id_column=None,
+                        prepare={"make_valid": True},
+                    )
+                ),
+                table_name=item,
+                path_base=f"{path_local}/{item}",
+                artifact_format=artifact_format,
+                if_exists="replace",
+                schema="public",
+                table_id="id",
+                optimize=optimize,
+            )
+            if generalize_zooms:
+                # the coverage has to be simplified as a whole
+                logger.warning(f"{item} is loaded in chunks, no generalized tables")
+            gdf, file_path = None, loaded["artifact"]
+            bounds, crs = loaded["bounds"], loaded["crs"]
         else:
-            gdf["ID"] = gdf[f"GID_{adm}"].apply(lambda x: x.split("_")[0])
-
-        gdf_columns = list(gdf.columns)
-        rename_columns = {k: v for k, v in RENAME_COLUMNS.items() if k in gdf_columns}
-
-        if rename_columns:
-            gdf = gdf.rename(columns=rename_columns)
-            gdf = gdf[
-                [
-                    *list(rename_columns.values()),
-                    "geometry",
-                ]
-            ]
-        file_path = f"{path_local}/{item}.geojson"
-        gdf.to_file(file_path, driver="GeoJSON")
-        logger.info("Saving dataset in DB..")
-        save_postgis(
-            gdf=gdf,
-            table_name=item,
-            if_exists="replace",
-            index=True,
-            schema="public",
-            table_id="id",
-        )
+            with stage("read", item=item) as span:
+                gdf = _prepare(gpd.read_file(source), adm)
+                span.add(rows=len(gdf))
+            gdf = prepare_geometries(gdf, 4326, make_valid=True)
+            # the artifact is written while the data is loaded into the DB
+            artifact = write_artifact_async(gdf, f"{path_local}/{item}", artifact_format)
+            logger.info("Saving dataset in DB..")
+            save_postgis(
+                gdf=gdf,
+                table_name=item,
+                if_exists="replace",
+                index=True,
+                schema="public",
+                table_id="id",
+                optimize=optimize,
+            )
+            # ##############
+            # generalized variants, `<item>_z<zoom>` tables
+            # ##############
+            for zoom, variant in coverage_variants(gdf, generalize_zooms).items():
+                generalized[f"z{zoom}"] = f"{item}_z{zoom}"
+                save_postgis(
+                    gdf=variant,
+                    table_name=f"{item}_z{zoom}",
+                    if_exists="replace",
+                    index=True,
+                    schema="public",
+                    table_id="id",
+                    optimize=optimize,
+                )
+            file_path = artifact.result()
+            bounds, crs = None, None
         # ##############
         # save item stac
         # ##############
-
-        output_json = run_cli(["fio", "stac"], file_path, args)
-
-        output_json["output"]["title"] = title
-        output_json["output"]["description"] = description
-        output_json["output"]["license"] = LICENSE
-        output_json["output"]["table"] = item
-        output_json["output"]["links"] = [
+        stac_item = create_stac_item(
+            gdf,
+            item_id=item,
+            collection=COLLECTION,
+            datetime="2023-07-16",
+            asset_href=file_path,
+            asset_media_type=media_type(artifact_format),
+            asset_roles=["data"],
+            extra_assets={"source": {"href": gadm_url, "roles": ["source"]}},
+            bounds=bounds,
+            crs=crs,
+        )
+        stac_item["title"] = title
+        stac_item["description"] = description
+        stac_item["license"] = LICENSE
+        stac_item["table"] = item
+        stac_item["generalized_tables"] = generalized
+        stac_item["links"] = [
             {
                 "href": gadm_url,
                 "rel": gadm_url,
@@ -100,17 +204,11 @@ def dowload_gadm_data(iso3, adm, path_local):
         stac_item_path = f"{path_local}/{item}_stac_item_.json"
 
         with open(stac_item_path, "w") as file:
-            file.write(json.dumps(output_json["output"]))
-        #################
-        # Run: pypgstac load collections
-        #################
-        output_json = run_cli(
-            ["pypgstac", "load", "items"],
-            stac_item_path,
-            {"--method": "insert_ignore", "--dsn": environ["DATABASE_URL"]},
-        )
+            file.write(json.dumps(stac_item))
+        return stac_item
     except Exception as ex:
-        logger.error(f"no data for  {iso3} ({adm})\n{ex}")
+        logger.error(f"Could not load {iso3} ({adm}): {ex}")
+        raise
 
 
 def ingest_stac(collection_path_, data_path_):
@@ -119,20 +217,61 @@ def ingest_stac(collection_path_, data_path_):
     print(collection_path_, data_path_)
 
 
-def run(iso3_country: list, path_local: str):
+def run(
+    iso3_country: list,
+    path_local: str,
+    optimize: dict = None,
+    artifact_format: str = "geoparquet",
+    generalize_zooms: list = (),
+    memory_limit_mb: int = MEMORY_LIMIT_MB,
+    db_connections: int = DB_CONNECTIONS,
+):
     #################
     # Load collection into the DB
     #################
     logger.info("\n\nLoad collection into the DB..")
     stac_collection_path = f"datasets/admin_boundaries/collection.json"
-    logger.info("Importing colletion to pgstac...")
-    output_json = run_cli(["pypgstac", "load", "collections"], stac_collection_path,
-        {"--method": "insert_ignore", "--dsn": environ["DATABASE_URL"]}, )
-    # generate links
-    gadm_combinations = [(iso3, adm) for iso3 in iso3_country for adm in ADM]
-    # process links
-    makedirs(path_local, exist_ok=True)
-    Parallel(n_jobs=-1)(
-        delayed(dowload_gadm_data)(iso3, adm, path_local)
-        for (iso3, adm) in tqdm(gadm_combinations, desc="Download data")
-    )
+    failed = []
+    with StacLoader() as loader:
+        logger.info("Importing colletion to pgstac...")
+        loader.add_collections(stac_collection_path)
+        # generate links
+        gadm_combinations = [(iso3, adm) for iso3 in iso3_country for adm in ADM]
+        # estimate the memory of every level from its size, levels that
+        # do not exist are left out
+        with stage("discover_link"), ThreadPoolExecutor(max_workers=POOL_SIZE) as executor:
+            estimates = list(
+                executor.map(
+                    lambda c: estimate_memory_mb(GADM_LINK.format(iso3=c[0], adm=c[1])),
+                    gadm_combinations,
+                )
+            )
+        # process links, within the memory and DB connections budget
+        makedirs(path_local, exist_ok=True)
+        tasks = []
+        for (iso3, adm), memory_mb in zip(gadm_combinations, estimates):
+            if memory_mb is None:
+                logger.info(f"no data for  {iso3} ({adm})")
+                continue
+            chunked = memory_mb > CHUNKED_ABOVE_MB
+            tasks.append(
+                Task(
+                    name=f"{iso3} adm{adm}",
+                    fn=dowload_gadm_data,
+                    args=(iso3, adm, path_local, optimize, artifact_format, generalize_zooms, chunked),
+                    memory_mb=BASE_MEMORY_MB + CHUNK_MEMORY_MB * CHUNK_OVERHEAD if chunked else memory_mb,
+                )
+            )
+        # the stages of every level are logged by its worker process
+        with stage("process_levels", levels=len(tasks)):
+            try:
+                stac_items = run_tasks(tasks, memory_limit_mb=memory_limit_mb, db_connections=db_connections)
+            except TasksFailed as ex:
+                # the levels that were loaded still get their items
+                stac_items, failed = ex.results, ex.failed
+        #################
+        # Load items of every country/level in one batch
+        #################
+        loader.add_items(i for i in stac_items if i)
+    if failed:
+        raise RuntimeError(f"Admin boundaries ingest failed for {failed}")
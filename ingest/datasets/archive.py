@@ -0,0 +1,65 @@
+"""Read members of compressed archives in place through GDAL virtual file systems."""
+
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from .instrument import stage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def zip_members(archive_path: str, extension: str = "") -> list:
+    """List the members of a zip archive ending with extension (only reads the central directory)."""
+    with zipfile.ZipFile(archive_path, "r") as zip_ref:
+        return [
+            name
+            for name in zip_ref.namelist()
+            if name.endswith(extension) and not name.startswith("__MACOSX")
+        ]
+
+
+def vsi_path(archive_path: str, member: str = "", extension: str = "") -> str:
+    """Return a GDAL path reading a dataset straight from archive_path.
+
+    Args:
+        archive_path (str): Path of a .zip or .gz file (other files are returned as is).
+        member (str, optional): Member of a zip archive.
+        extension (str, optional): Pick the first zip member with this extension when member is not given.
+    Return:
+        str: `/vsizip/...` or `/vsigzip/...` path.
+    """
+    if archive_path.endswith(".zip"):
+        if not member:
+            members = zip_members(archive_path, extension)
+            if not members:
+                raise ValueError(f"No '{extension}' file in {archive_path}")
+            member = members[0]
+        return f"/vsizip/{archive_path}/{member}"
+    if archive_path.endswith(".gz"):
+        return f"/vsigzip/{archive_path}"
+    return archive_path
+
+
+@contextmanager
+def decompressed(archive_path: str, dir: str = None):
+    """Gunzip archive_path into a temporary file, removed when the context exits.
+
+    For formats that need fast random access (e.g. a GeoPackage larger than
+    what /vsigzip/ seeks comfortably through).
+    """
+    name = os.path.basename(archive_path)[: -len(".gz")]
+    with tempfile.TemporaryDirectory(dir=dir or os.path.dirname(archive_path)) as tmp_dir:
+        file_path = os.path.join(tmp_dir, name)
+        with stage("decompress", path=archive_path) as span:
+            with gzip.open(archive_path, "rb") as f_in, open(file_path, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+            span.add(bytes=os.path.getsize(file_path))
+        logger.debug(f"Decompressed {archive_path} into {file_path}")
+        yield file_path
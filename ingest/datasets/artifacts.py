@@ -0,0 +1,221 @@
+"""Write dataset artifacts (GeoParquet, FlatGeobuf, GeoJSON) off the critical path."""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyogrio.raw import write_arrow
+from .bulk_load import _pg_type
+from .instrument import stage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# format -> (extension, media type)
+ARTIFACT_FORMATS = {
+    "geoparquet": (".parquet", "application/vnd.apache.parquet"),
+    "flatgeobuf": (".fgb", "application/vnd.flatgeobuf"),
+    "geojson": (".geojson", "application/geo+json"),
+}
+DEFAULT_FORMAT = "geoparquet"
+
+# postgres type (as inferred by the BulkLoader) -> arrow type, for columns with no values in the first chunk
+ARROW_TYPES = {
+    "bool": pa.bool_(),
+    "int2": pa.int16(),
+    "int4": pa.int32(),
+    "int8": pa.int64(),
+    "float4": pa.float32(),
+    "float8": pa.float64(),
+    "timestamp": pa.timestamp("ns"),
+    "timestamptz": pa.timestamp("ns", tz="UTC"),
+    "date": pa.date32(),
+    "text": pa.string(),
+}
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="artifact")
+
+
+def artifact_path(path_base: str, fmt: str = DEFAULT_FORMAT) -> str:
+    """Return the artifact file path for path_base (path without extension)."""
+    if fmt not in ARTIFACT_FORMATS:
+        raise ValueError(f"Unknown artifact format '{fmt}', use one of {list(ARTIFACT_FORMATS)}")
+    return f"{path_base}{ARTIFACT_FORMATS[fmt][0]}"
+
+
+def media_type(fmt: str = DEFAULT_FORMAT) -> str:
+    return ARTIFACT_FORMATS[fmt][1]
+
+
+def write_artifact(gdf: gpd.GeoDataFrame, path_base: str, fmt: str = DEFAULT_FORMAT) -> str:
+    """Write gdf to disk in the given format.
+
+    Args:
+        gdf (object): A GeoDataFrame object.
+        path_base (str): Output path without extension.
+        fmt (str, optional): "geoparquet", "flatgeobuf" or "geojson". Defaults to 'geoparquet'
+    Return:
+        str: Path of the written file.
+    """
+    path = artifact_path(path_base, fmt)
+    start = time.perf_counter()
+    with stage("write_artifact", format=fmt) as span:
+        if fmt == "geoparquet":
+            gdf.to_parquet(path, index=False, compression="zstd")
+        elif fmt == "flatgeobuf":
+            # FlatGeobuf carries a packed Hilbert R-tree for spatially indexed range reads
+            gdf.to_file(path, driver="FlatGeobuf", engine="pyogrio", SPATIAL_INDEX="YES")
+        else:
+            gdf.to_file(path, driver="GeoJSON", engine="pyogrio")
+        span.add(rows=len(gdf), bytes=os.path.getsize(path))
+    logger.info(f"Wrote {path} in {time.perf_counter() - start:.1f}s")
+    return path
+
+
+def write_artifact_async(gdf: gpd.GeoDataFrame, path_base: str, fmt: str = DEFAULT_FORMAT) -> Future:
+    """Write the artifact in a background thread, e.g. while the database load runs.
+
+    Return:
+        Future: resolves to the path of the written file.
+    """
+    artifact_path(path_base, fmt)  # fail fast on an unknown format
+    return _executor.submit(write_artifact, gdf, path_base, fmt)
+
+
+def _geoparquet_metadata(gdf: gpd.GeoDataFrame) -> bytes:
+    geometry_name = gdf.geometry.name
+    return json.dumps(
+        {
+            "version": "1.0.0",
+            "primary_column": geometry_name,
+            "columns": {
+                geometry_name: {
+                    "encoding": "WKB",
+                    "geometry_types": [],
+                    "crs": gdf.crs.to_json_dict() if gdf.crs else None,
+                }
+            },
+        }
+    ).encode()
+
+
+def _arrow_schema(gdf: gpd.GeoDataFrame, table: pa.Table) -> pa.Schema:
+    """Schema of table, with the type the BulkLoader gives them for fields that are all null in gdf.
+
+    Otherwise such a field would be `null` typed, and no later chunk could be cast to it.
+    """
+    fields = [
+        pa.field(f.name, ARROW_TYPES.get(_pg_type(gdf[f.name]), pa.string()))
+        if pa.types.is_null(f.type) and f.name in gdf.columns
+        else f
+        for f in table.schema
+    ]
+    return pa.schema(fields, metadata=table.schema.metadata)
+
+
+class ArtifactWriter:
+    """Append GeoDataFrame chunks to an artifact file, for the streaming read path.
+
+    The schema of the file is the schema of the first chunk (with a type for its
+    all null columns, see `_arrow_schema`): later chunks are cast to it. GeoParquet
+    chunks become row groups; FlatGeobuf and GeoJSON chunks are streamed to
+    `pyogrio.raw.write_arrow` in a thread (the FlatGeobuf index is built on close).
+
+    Usage:
+        with ArtifactWriter(f"{path_local}/{ITEM}", "geoparquet") as writer:
+            for gdf in chunks:
+                writer.write(gdf)
+    """
+
+    def __init__(self, path_base: str, fmt: str = DEFAULT_FORMAT):
+        self.fmt = fmt
+        self.path = artifact_path(path_base, fmt)
+        self._writer = None
+        self._schema = None
+        self._batches = None
+        self._error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _table(self, gdf: gpd.GeoDataFrame) -> pa.Table:
+        table = pa.Table.from_pandas(gdf.to_wkb(), preserve_index=False)
+        if self._schema is None:
+            self._schema = _arrow_schema(gdf, table)
+        return table.select(self._schema.names).cast(self._schema)
+
+    def _write_ogr(self, gdf: gpd.GeoDataFrame, batches):
+        try:
+            write_arrow(
+                pa.RecordBatchReader.from_batches(self._schema, batches),
+                self.path,
+                driver="FlatGeobuf" if self.fmt == "flatgeobuf" else "GeoJSON",
+                geometry_name=gdf.geometry.name,
+                geometry_type="Unknown",
+                crs=gdf.crs.to_wkt() if gdf.crs else None,
+                layer_options={"SPATIAL_INDEX": "YES"} if self.fmt == "flatgeobuf" else None,
+            )
+        except Exception as ex:
+            self._error = ex
+            # unblock write, which may wait for room in the queue
+            while True:
+                try:
+                    self._batches.get_nowait()
+                except queue.Empty:
+                    break
+
+    def _put(self, item):
+        while self._writer.is_alive():
+            try:
+                self._batches.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise self._error or RuntimeError(f"Writer of {self.path} stopped")
+
+    def write(self, gdf: gpd.GeoDataFrame):
+        table = self._table(gdf)
+        if self.fmt == "geoparquet":
+            if self._writer is None:
+                self._schema = self._schema.with_metadata(
+                    {**(self._schema.metadata or {}), b"geo": _geoparquet_metadata(gdf)}
+                )
+                self._writer = pq.ParquetWriter(self.path, self._schema, compression="zstd")
+            self._writer.write_table(table.cast(self._schema))
+            return
+        if self._writer is None:
+            self._batches = queue.Queue(maxsize=2)
+            batches = iter(self._batches.get, None)
+            self._writer = threading.Thread(target=self._write_ogr, args=(gdf, batches), daemon=True)
+            self._writer.start()
+        for batch in table.to_batches():
+            self._put(batch)
+
+    def write_async(self, gdf: gpd.GeoDataFrame) -> Future:
+        """Append gdf in the artifact thread; wait for the future before the next write."""
+        return _executor.submit(self.write, gdf)
+
+    def close(self):
+        if self._writer is None:
+            return
+        try:
+            if self.fmt == "geoparquet":
+                self._writer.close()
+            else:
+                if self._writer.is_alive():
+                    self._put(None)
+                self._writer.join()
+        finally:
+            self._writer = None
+        if self._error:
+            raise self._error
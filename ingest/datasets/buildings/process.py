@@ -1,14 +1,22 @@
 import pandas as pd
 import geopandas as gpd
 import logging
-import requests
 import re
+import pyarrow as pa
 from tqdm import tqdm
-import zipfile
-from shapely import wkt
 import json
-from ..utils import run_cli, save_postgis
-from os import makedirs, environ
+from ..utils import exist_table, save_postgis, save_postgis_chunks
+from ..manifest import Manifest
+from ..archive import vsi_path
+from ..download import download, get_session
+from ..readers import read_chunks, read_csv_chunks
+from ..pgstac_loader import StacLoader
+from ..stac import create_stac_item
+from ..artifacts import media_type, write_artifact_async
+from ..tiles import tiles_stage
+from ..instrument import stage
+from ..geometry import prepare_geometries
+from os import makedirs
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -41,10 +49,15 @@ PAGE_SOURCES = {
 }
 STAC_VERSION = "1.0.0"
 COLLECTION = "buildings"
+# compact dtypes of the numeric columns of the Open Buildings CSV
+CSV_COLUMN_TYPES = {"area_in_meters": pa.float32(), "confidence": pa.float32()}
+# footprints are repaired on read, invalid polygons break the spatial joins downstream
+PREPARE = {"make_valid": True}
+DOWNLOAD_PARALLEL = 4
 
 
 def get_link(link_, condition):
-    r = requests.get(link_)
+    r = get_session().get(link_)
     all_links = list(dict.fromkeys(list(re.findall(REGEX_URL, r.text))))
     filter_links = [
         i
@@ -59,104 +72,147 @@ def get_link(link_, condition):
     return select_link
 
 
-def download_data(link, file_tmp_path, case):
-    file_save = file_tmp_path
-    block_size = 1024
-    response = requests.get(link, stream=True)
-    total_size_in_bytes = int(response.headers.get("content-length", 0))
-    # create folter
-    makedirs("/".join(file_tmp_path.split("/")[:-1]), exist_ok=True)
-    with open(file_tmp_path, "wb") as file, tqdm(
-        desc=file_tmp_path,
-        total=total_size_in_bytes,
-        unit="iB",
-        unit_scale=True,
-        unit_divisor=1024,
-    ) as bar:
-        for data in response.iter_content(block_size):
-            bar.update(len(data))
-            file.write(data)
-    if case == "zip":
-        file_save = file_tmp_path[:-4]
-        with zipfile.ZipFile(file_tmp_path, "r") as zip_ref:
-            zip_ref.extractall("/".join(file_tmp_path.split("/")[:-1]))
+def download_data(link, file_tmp_path, case, manifest=None):
+    """Download link, unless it did not change since the download recorded in manifest.
+
+    Zip archives are not extracted, the GeoPackage is read in place through /vsizip/.
 
-    return f"{file_save}"
+    Return:
+        tuple: (GDAL path of the data file, manifest entry to record once loaded or None if unchanged)
+    """
+    entry = download(link, file_tmp_path, manifest=manifest, parallel=DOWNLOAD_PARALLEL)
+    if case == "zip":
+        return vsi_path(file_tmp_path, extension=".gpkg"), entry
+    return file_tmp_path, entry
 
 
 def read_file(file_path, case):
-    if case == "csv":
-        df = pd.read_csv(file_path)
-        df["geometry"] = df["geometry"].apply(wkt.loads)
-        gdf = gpd.GeoDataFrame(df, geometry="geometry")
-        gdf = gdf.set_crs(epsg=4326)
-        gdf["id"] = list(range(gdf.shape[0]))
-    else:
-        gdf = gpd.read_file(file_path)
-        gdf = gdf.to_crs(4326)
-        gdf["id"] = list(range(gdf.shape[0]))
+    with stage("read", case=case) as span:
+        if case == "csv":
+            df = pd.read_csv(
+                file_path,
+                engine="pyarrow",
+                dtype={name: type_.to_pandas_dtype() for name, type_ in CSV_COLUMN_TYPES.items()},
+            )
+            geometry = gpd.GeoSeries.from_wkt(df.pop("geometry"), crs=4326)
+            gdf = gpd.GeoDataFrame(df, geometry=geometry)
+        else:
+            gdf = gpd.read_file(file_path)
+        span.add(rows=len(gdf))
+    gdf = prepare_geometries(gdf, 4326, **PREPARE)
+    gdf["id"] = list(range(gdf.shape[0]))
 
     return gdf
 
 
-def run(path_local):
+def run(
+    path_local,
+    optimize: dict = None,
+    artifact_format: str = "geoparquet",
+    memory_budget_mb: int = None,
+    force: bool = False,
+    tiles: dict = None,
+    partition: dict = None,
+):
     makedirs(path_local, exist_ok=True)
+    manifest = Manifest()
     #################
     # Load collection into the DB
     #################
     logger.info("\n\nLoad collection into the DB..")
     stac_collection_path = f"datasets/buildings/collection.json"
-    logger.info("Importing colletion to pgstac...")
-    output_json = run_cli(
-        ["pypgstac", "load", "collections"],
-        stac_collection_path,
-        {"--method": "insert_ignore", "--dsn": environ["DATABASE_URL"]},
-    )
+    loader = StacLoader()
+    loader.add_collections(stac_collection_path)
+    # (url, manifest entry) of the sources loaded, recorded once their items are in pgstac
+    loaded_sources = []
+    errors = []
 
     for link, v in tqdm(list(PAGE_SOURCES.items()), desc="Processing sources"):
         try:
-            source_link = get_link(link, v.get("condition"))
+            with stage("discover_link", page=link):
+                source_link = get_link(link, v.get("condition"))
             item = f"{COLLECTION}_{v.get('item')}".lower()
 
             if not source_link:
                 logger.error("no link found")
-            files_path = download_data(
+            files_path, entry = download_data(
                 source_link,
                 f"{path_local}/{v.get('filename')}.{v.get('original_extension')}",
                 v.get("case"),
+                manifest,
             )
-            gdf = read_file(files_path, v.get("case"))
+            if entry is None and not force and exist_table(item):
+                logger.info(f"{item} is up to date, skipping")
+                continue
             # ##############
             # items
             # ##############
             links_ = {"href": link, "rel": link, "title": v.get("filename")}
-            file_path = f"{path_local}/{item}.geojson"
-            gdf.to_file(file_path, driver="GeoJSON")
-            save_postgis(
-                gdf=gdf,
-                table_name=item,
-                if_exists="replace",
-                index=True,
-                schema="public",
-                table_id="id",
-            )
+            if memory_budget_mb:
+                # stream the source in chunks, peak memory stays within the budget
+                if v.get("case") == "csv":
+                    chunks = read_csv_chunks(
+                        files_path,
+                        memory_budget_mb=memory_budget_mb,
+                        column_types=CSV_COLUMN_TYPES,
+                        prepare=PREPARE,
+                    )
+                else:
+                    chunks = read_chunks(files_path, memory_budget_mb=memory_budget_mb, prepare=PREPARE)
+                loaded = save_postgis_chunks(
+                    chunks,
+                    table_name=item,
+                    path_base=f"{path_local}/{item}",
+                    artifact_format=artifact_format,
+                    if_exists="replace",
+                    schema="public",
+                    table_id="id",
+                    optimize=optimize,
+                    partition=partition,
+                )
+                gdf = None
+            else:
+                gdf = read_file(files_path, v.get("case"))
+                # the artifact is written while the data is loaded into the DB
+                artifact = write_artifact_async(gdf, f"{path_local}/{item}", artifact_format)
+                save_postgis(
+                    gdf=gdf,
+                    table_name=item,
+                    if_exists="replace",
+                    index=True,
+                    schema="public",
+                    table_id="id",
+                    optimize=optimize,
+                    partition=partition,
+                )
+                loaded = {"artifact": artifact.result(), "bounds": None, "crs": None}
             # ##############
             # save item stac
             # ##############
-            args = {
-                "--id": v.get("item"),
-                "--datetime": "2023-07-16",
-                "--collection": COLLECTION,
-                "--asset-href": link,
-            }
-
-            output_json = run_cli(["fio", "stac"], file_path, args)
-
-            output_json["output"]["title"] = v.get("title")
-            output_json["output"]["description"] = v.get("description")
-            output_json["output"]["license"] = v.get("license")
-            output_json["output"]["table"] = item
-            output_json["output"]["links"] = {
+            file_path = loaded["artifact"]
+            extra_assets = {"source": {"href": source_link, "roles": ["source"]}}
+            if tiles:
+                # vector tile pyramid for map clients, see `tiles.build_pmtiles`
+                extra_assets.update(
+                    tiles_stage(gdf, item, f"{path_local}/{item}", item, **tiles)
+                )
+            stac_item = create_stac_item(
+                gdf,
+                bounds=loaded["bounds"],
+                crs=loaded["crs"],
+                item_id=v.get("item"),
+                collection=COLLECTION,
+                datetime="2023-07-16",
+                asset_href=file_path,
+                asset_media_type=media_type(artifact_format),
+                asset_roles=["data"],
+                extra_assets=extra_assets,
+            )
+            stac_item["title"] = v.get("title")
+            stac_item["description"] = v.get("description")
+            stac_item["license"] = v.get("license")
+            stac_item["table"] = item
+            stac_item["links"] = {
                 "href": link,
                 "rel": links_,
                 "title": v.get("title"),
@@ -164,14 +220,20 @@ def run(path_local):
             stac_item_path = f"{path_local}/{item}_stac_item_.json"
 
             with open(stac_item_path, "w") as file:
-                file.write(json.dumps(output_json["output"]))
-            #################
-            # Run: pypgstac load collections
-            #################
-            output_json = run_cli(
-                ["pypgstac", "load", "items"],
-                stac_item_path,
-                {"--method": "insert_ignore", "--dsn": environ["DATABASE_URL"]},
-            )
+                file.write(json.dumps(stac_item))
+            loader.add_item(stac_item)
+            if entry:
+                loaded_sources.append((source_link, entry))
         except Exception as ex:
-            logger.error(ex)
+            # the other sources are still loaded, the run fails at the end
+            logger.error(f"Could not load {link}: {ex}")
+            errors.append(link)
+    #################
+    # Load collection and items into pgstac
+    #################
+    logger.info("Importing colletion/items to pgstac...")
+    loader.flush()
+    for source_link, entry in loaded_sources:
+        manifest.record(source_link, entry)
+    if errors:
+        raise RuntimeError(f"Buildings ingest failed for {errors}")
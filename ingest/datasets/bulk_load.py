@@ -0,0 +1,378 @@
+"""Bulk load GeoDataFrames into PostGIS with binary COPY."""
+
+import os
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from psycopg import sql
+from .db import get_pool
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COPY_WORKERS = int(os.environ.get("INGEST_COPY_WORKERS", 4))
+COPY_MIN_ROWS_PER_WORKER = 50_000
+
+# pandas inferred dtype -> postgres type used both for the DDL and the binary COPY
+INFERRED_TYPES = {
+    "integer": "int8",
+    "floating": "float8",
+    "mixed-integer-float": "float8",
+    "decimal": "float8",
+    "boolean": "bool",
+    "datetime64": "timestamp",
+    "datetime": "timestamp",
+    "date": "date",
+}
+
+
+def _pg_type(series: pd.Series) -> str:
+    """Return the postgres type for a column, following pandas `to_sql` mapping."""
+    dtype = series.dtype
+    if isinstance(series, gpd.GeoSeries) or isinstance(dtype, gpd.array.GeometryDtype):
+        return "geometry"
+    if pd.api.types.is_bool_dtype(dtype):
+        return "bool"
+    if pd.api.types.is_integer_dtype(dtype):
+        # unsigned integers need the next signed size up
+        size = dtype.itemsize * (2 if dtype.kind == "u" else 1)
+        return "int2" if size <= 2 else "int4" if size == 4 else "int8"
+    if pd.api.types.is_float_dtype(dtype):
+        return "float4" if dtype.itemsize == 4 else "float8"
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return "timestamptz"
+    if pd.api.types.is_datetime64_dtype(dtype):
+        return "timestamp"
+    if dtype == object:
+        return INFERRED_TYPES.get(pd.api.types.infer_dtype(series, skipna=True), "text")
+    return "text"
+
+
+def _geometry_type(geoseries: gpd.GeoSeries) -> str:
+    """Return the typmod for a geometry column (e.g. `MultiPolygon`), or `Geometry` if mixed."""
+    geom_types = geoseries.geom_type.dropna().unique()
+    if len(geom_types) != 1:
+        return "Geometry"
+    return f"{geom_types[0]}Z" if geoseries.has_z.any() else geom_types[0]
+
+
+def _column_values(series: pd.Series, pg_type: str, srid: int) -> list:
+    """Convert a column into a list of python values ready for the binary COPY."""
+    if pg_type == "geometry":
+        geoms = shapely.set_srid(np.asarray(series.values, dtype=object), srid)
+        return shapely.to_wkb(geoms, include_srid=True).tolist()
+    mask = series.isna().to_numpy()
+    values = series.astype(object).tolist()
+    if pg_type == "text":
+        values = [v if isinstance(v, str) else str(v) for v in values]
+    if mask.any():
+        values = [None if m else v for v, m in zip(values, mask)]
+    return values
+
+
+def _srid(gdf: gpd.GeoDataFrame, table_name: str) -> int:
+    """SRID of the geometries of gdf, 0 without CRS."""
+    if gdf.crs is None:
+        return 0
+    srid = gdf.crs.to_epsg()
+    if srid is None:
+        raise ValueError(f"The CRS of {table_name} has no EPSG code, reproject it (e.g. to EPSG:4326) to load it")
+    return srid
+
+
+def _identifier(schema: str, name: str):
+    return sql.Identifier(schema, name)
+
+
+def _short_name(name: str, suffix: str) -> str:
+    """Build an identifier <= 63 chars (postgres NAMEDATALEN)."""
+    return f"{name[: 63 - len(suffix)]}{suffix}"
+
+
+class BulkLoader:
+    """Stream GeoDataFrames into a PostGIS table through `COPY ... FROM STDIN (FORMAT BINARY)`.
+
+    Rows are written into an UNLOGGED staging table, split across several pooled
+    connections. Primary key and GiST index are built once the data is loaded, and
+    the staging table then replaces (or is appended to) the target table in a
+    single transaction, so readers never see a half-loaded table.
+
+    Every loader has its own staging table (and staging index names), so
+    concurrent loads of the same table (e.g. two queue workers) do not drop each
+    other's rows: the last one to finish replaces the table.
+
+    Usage:
+        with BulkLoader("population_hexbins_afghanistan") as loader:
+            loader.write(gdf)
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        database_url: str = "",
+        if_exists: str = "replace",
+        schema: str = "public",
+        table_id: str = "id",
+        workers: int = COPY_WORKERS,
+        column_types: dict = None,
+        geometry_type: str = None,
+    ):
+        if if_exists not in ("fail", "replace", "append"):
+            raise ValueError(f"'{if_exists}' is not valid for if_exists")
+        self.table_name = table_name
+        self.schema = schema
+        self.if_exists = if_exists
+        self.table_id = table_id
+        self.pool = get_pool(database_url)
+        # more threads than pooled connections would only wait on the pool
+        self.workers = max(1, min(workers, self.pool.max_size))
+        # unique per load, the table name may be truncated but not the token
+        self.token = uuid.uuid4().hex[:8]
+        self.staging_name = _short_name(table_name, f"_staging_{self.token}")
+        # forced postgres types, e.g. for tables that must match a parent table
+        self.column_types = column_types or {}
+        self.geometry_type = geometry_type
+        self.columns = None
+        self.geometry_column = None
+        self.srid = 0
+        self.rows = 0
+        self.has_table = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abort()
+        return False
+
+    def _staging_index_name(self, suffix: str) -> str:
+        return _short_name(self.table_name, f"_{self.token}{suffix}")
+
+    def _exists(self, conn, name: str) -> bool:
+        return (
+            conn.execute(
+                "SELECT to_regclass(%s) IS NOT NULL",
+                (f'"{self.schema}"."{name}"',),
+            ).fetchone()[0]
+        )
+
+    def _create_staging(self, gdf: gpd.GeoDataFrame):
+        self.geometry_column = gdf.geometry.name
+        self.srid = _srid(gdf, self.table_name)
+        self.columns = {col: self.column_types.get(col) or _pg_type(gdf[col]) for col in gdf.columns}
+
+        column_defs = []
+        for col, pg_type in self.columns.items():
+            if pg_type == "geometry":
+                geom_type = self.geometry_type or _geometry_type(gdf[col])
+                pg_type = f"geometry({geom_type}, {self.srid or 0})"
+            column_defs.append(sql.SQL("{} {}").format(sql.Identifier(col), sql.SQL(pg_type)))
+
+        with self.pool.connection() as conn:
+            self.has_table = self._exists(conn, self.table_name)
+            if self.has_table and self.if_exists == "fail":
+                raise ValueError(f"Table '{self.table_name}' already exists.")
+            conn.execute(
+                sql.SQL("CREATE UNLOGGED TABLE {} ({})").format(
+                    _identifier(self.schema, self.staging_name),
+                    sql.SQL(", ").join(column_defs),
+                )
+            )
+        logger.debug(f"Created staging table {self.staging_name}")
+
+    def _copy(self, columns: list, types: list, rows) -> int:
+        statement = sql.SQL("COPY {} ({}) FROM STDIN (FORMAT BINARY)").format(
+            _identifier(self.schema, self.staging_name),
+            sql.SQL(", ").join(map(sql.Identifier, columns)),
+        )
+        count = 0
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur, cur.copy(statement) as copy:
+                copy.set_types(types)
+                for row in rows:
+                    copy.write_row(row)
+                    count += 1
+        return count
+
+    def _copy_frame(self, gdf: gpd.GeoDataFrame) -> int:
+        columns = list(self.columns)
+        # geometries travel as (E)WKB, which geometry_recv accepts in binary COPY
+        types = ["bytea" if self.columns[c] == "geometry" else self.columns[c] for c in columns]
+        values = [_column_values(gdf[c], self.columns[c], self.srid) for c in columns]
+        return self._copy(columns, types, zip(*values))
+
+    def write(self, gdf: gpd.GeoDataFrame) -> int:
+        """COPY a GeoDataFrame into the staging table.
+
+        Can be called several times with frames sharing the same columns.
+
+        Return:
+            int: Number of rows written.
+        """
+        if self.columns is None:
+            self._create_staging(gdf)
+        missing = set(self.columns) ^ set(gdf.columns)
+        if missing:
+            raise ValueError(f"Columns do not match the staging table: {sorted(missing)}")
+
+        start = time.perf_counter()
+        n_chunks = min(self.workers, max(1, len(gdf) // COPY_MIN_ROWS_PER_WORKER))
+        if n_chunks == 1:
+            count = self._copy_frame(gdf)
+        else:
+            bounds = np.linspace(0, len(gdf), n_chunks + 1, dtype=int)
+            with ThreadPoolExecutor(max_workers=n_chunks) as executor:
+                count = sum(
+                    executor.map(
+                        self._copy_frame,
+                        [gdf.iloc[a:b] for a, b in zip(bounds[:-1], bounds[1:])],
+                    )
+                )
+        self.rows += count
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"COPY {count} rows into {self.table_name} in {elapsed:.1f}s "
+            f"({count / max(elapsed, 1e-6):.0f} rows/s, {n_chunks} connection(s))"
+        )
+        return count
+
+    def _build_indexes(self, conn, create_pk: bool) -> list:
+        """Create primary key and indexes on the staging table.
+
+        Index names must be unique per schema while the old table (or the staging
+        table of a concurrent load) still exists, so they are created with the
+        token of this load and renamed during the swap.
+
+        Return:
+            list: (staging index name, final index name) pairs.
+        """
+        staging = _identifier(self.schema, self.staging_name)
+        indexes = []
+        if create_pk and self.table_id in self.columns:
+            name = self._staging_index_name("_pkey")
+            conn.execute(
+                sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY ({})").format(
+                    staging, sql.Identifier(name), sql.Identifier(self.table_id)
+                )
+            )
+            indexes.append((name, _short_name(self.table_name, "_pkey")))
+        if "index" in self.columns and self.table_id != "index":
+            name = self._staging_index_name("_ix_index")
+            conn.execute(
+                sql.SQL("CREATE INDEX {} ON {} ({})").format(
+                    sql.Identifier(name), staging, sql.Identifier("index")
+                )
+            )
+            indexes.append((name, _short_name(f"ix_{self.table_name}", "_index")))
+        name = self._staging_index_name(f"_{self.geometry_column}_idx")
+        conn.execute(
+            sql.SQL("CREATE INDEX {} ON {} USING GIST ({})").format(
+                sql.Identifier(name), staging, sql.Identifier(self.geometry_column)
+            )
+        )
+        indexes.append((name, _short_name(self.table_name, f"_{self.geometry_column}_idx")))
+        return indexes
+
+    def _swap(self, conn, indexes: list):
+        """Replace the target table with the indexed staging table, in the caller's transaction."""
+        conn.execute(
+            sql.SQL("DROP TABLE IF EXISTS {}").format(_identifier(self.schema, self.table_name))
+        )
+        conn.execute(
+            sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                _identifier(self.schema, self.staging_name), sql.Identifier(self.table_name)
+            )
+        )
+        for name, final_name in indexes:
+            conn.execute(
+                sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                    _identifier(self.schema, name), sql.Identifier(final_name)
+                )
+            )
+
+    def finish(self):
+        """Index the staging table and move it into place."""
+        if self.columns is None:
+            logger.info(f"No rows to load into {self.table_name}")
+            return
+        staging = _identifier(self.schema, self.staging_name)
+        target = _identifier(self.schema, self.table_name)
+        start = time.perf_counter()
+        with self.pool.connection() as conn:
+            if self.if_exists == "append" and self.has_table:
+                columns = sql.SQL(", ").join(map(sql.Identifier, self.columns))
+                with conn.transaction():
+                    conn.execute(
+                        sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(
+                            target, columns, columns, staging
+                        )
+                    )
+                    conn.execute(sql.SQL("DROP TABLE {}").format(staging))
+            else:
+                conn.execute(sql.SQL("ALTER TABLE {} SET LOGGED").format(staging))
+                indexes = self._build_indexes(conn, create_pk=bool(self.table_id))
+                with conn.transaction():
+                    # concurrent loads of the table swap one after the other
+                    conn.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (target.as_string(conn),))
+                    self._swap(conn, indexes)
+        logger.info(
+            f"Table {self.schema}.{self.table_name} ready ({self.rows} rows, "
+            f"indexes built in {time.perf_counter() - start:.1f}s)"
+        )
+
+    def abort(self):
+        """Drop the staging table, leaving the target table untouched."""
+        if self.columns is None:
+            return
+        with self.pool.connection() as conn:
+            conn.execute(
+                sql.SQL("DROP TABLE IF EXISTS {}").format(
+                    _identifier(self.schema, self.staging_name)
+                )
+            )
+
+
+def copy_postgis(
+    gdf: gpd.GeoDataFrame,
+    table_name: str,
+    database_url: str = "",
+    if_exists: str = "replace",
+    index: bool = True,
+    schema: str = "public",
+    table_id: str = "id",
+    workers: int = COPY_WORKERS,
+) -> int:
+    """Load a GeoDataFrame into PostGIS with binary COPY.
+
+    Args:
+        gdf (object): A GeoDataFrame object.
+        table_name (str): The name of the table to be created in PostGIS.
+        database_url (str, optional): The URL for the database connection. Defaults to an environment variable called DATABASE_URL if not provided explicitly.
+        if_exists (str, optional): "fail", "replace", or "append". Defaults to 'replace'.
+        index (bool, optional): Save the index of the dataframe as an `index` column, like `to_postgis`.
+        schema (str, optional): Used to Specify the schema of the table. Defaults to 'public'
+        table_id (str, optional): Primary key column, created when the table is (re)created. Defaults to 'id'
+        workers (int, optional): Maximum number of connections used for the COPY.
+    Return:
+        int: Number of rows loaded.
+    """
+    if index:
+        gdf = gdf.reset_index(names=gdf.index.name or "index")
+    with BulkLoader(
+        table_name,
+        database_url=database_url,
+        if_exists=if_exists,
+        schema=schema,
+        table_id=table_id,
+        workers=workers,
+    ) as loader:
+        loader.write(gdf)
+    return loader.rows
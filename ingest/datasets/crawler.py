@@ -0,0 +1,249 @@
+"""Asynchronous, optionally incremental, crawler for static STAC catalogs."""
+
+import asyncio
+import json
+import logging
+import os
+from collections import namedtuple
+from datetime import datetime, timezone
+from urllib.parse import urljoin
+import aiohttp
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CONCURRENCY = 32
+RETRIES = 3
+TIMEOUT = aiohttp.ClientTimeout(total=60, connect=10)
+
+# body is None when the catalog did not change since the previous crawl (304),
+# items only lists the item urls that were not fetched by a previous crawl
+Catalog = namedtuple("Catalog", ["url", "body", "children", "items", "new"])
+
+
+def link_hrefs(stac_object: dict, rel: str, base_url: str) -> list:
+    """Return the absolute hrefs of the links of stac_object with the given rel."""
+    hrefs = [
+        urljoin(base_url, link["href"])
+        for link in stac_object.get("links", [])
+        if link.get("rel") == rel
+    ]
+    return list(dict.fromkeys(hrefs))
+
+
+class CrawlState:
+    """ETag, Last-Modified, child links and fetched items of every catalog of a crawl.
+
+    With a state, catalogs are requested conditionally: an unchanged catalog
+    costs a 304 and its children are taken from the state, and only items
+    that were never fetched are requested.
+    """
+
+    def __init__(self, path: str, reset: bool = False):
+        self.path = path
+        self.entries = {}
+        if not reset:
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+        self._items = {url: set(e.get("items", [])) for url, e in self.entries.items()}
+
+    def get(self, url: str) -> dict:
+        return self.entries.get(url, {})
+
+    def known_items(self, url: str) -> set:
+        return self._items.get(url, set())
+
+    def conditional_headers(self, url: str) -> dict:
+        entry = self.get(url)
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def update(self, url: str, headers, children: list, stac_id: str = None):
+        self.entries[url] = {
+            **self.get(url),
+            "id": stac_id,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "children": children,
+            "crawled_at": datetime.now(timezone.utc).isoformat(),
+        }
+        self._items.setdefault(url, set())
+
+    def add_item(self, url: str, item_url: str):
+        self._items.setdefault(url, set()).add(item_url)
+
+    def invalidate(self, url: str):
+        """Forget the validators of url, so that the next crawl fetches it again."""
+        if url in self.entries:
+            self.entries[url]["etag"] = None
+            self.entries[url]["last_modified"] = None
+
+    def save(self):
+        for url, items in self._items.items():
+            self.entries.setdefault(url, {})["items"] = sorted(items)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+
+class CatalogCrawler:
+    """Walk a static STAC catalog with a bounded number of concurrent requests.
+
+    Child catalogs and items of a catalog are requested concurrently, at most
+    `concurrency` requests are in flight. Items are handed to a callback as
+    soon as they arrive, nothing is kept in memory by the crawler. Documents
+    that cannot be fetched are logged and recorded in `errors`.
+
+    With a `CrawlState`, the crawl is incremental: only catalogs that changed
+    and items that are new since the previous crawl are fetched. The state is
+    updated in memory, save it once the items are safely stored.
+
+    Usage:
+        async with CatalogCrawler(concurrency=32) as crawler:
+            await crawler.walk_items(url, on_item)
+    """
+
+    def __init__(self, concurrency: int = CONCURRENCY, retries: int = RETRIES, state: CrawlState = None):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.state = state
+        self.requests = 0
+        self.not_modified = 0
+        self.errors = []
+        self._semaphore = None
+        self.session = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            timeout=TIMEOUT, connector=aiohttp.TCPConnector(limit=self.concurrency)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+        return False
+
+    async def _get(self, url: str, headers: dict = None):
+        """GET a JSON document, retrying connection errors, timeouts and 5xx/429 responses.
+
+        Return:
+            tuple: (status, JSON document or None on 304, response headers)
+        """
+        for attempt in range(self.retries):
+            try:
+                async with self._semaphore:
+                    async with self.session.get(url, headers=headers) as response:
+                        self.requests += 1
+                        if response.status == 304:
+                            self.not_modified += 1
+                            return 304, None, response.headers
+                        response.raise_for_status()
+                        # S3 serves STAC files as binary/octet-stream
+                        data = await response.json(content_type=None)
+                        return response.status, data, response.headers
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                retryable = not isinstance(ex, aiohttp.ClientResponseError) or (
+                    ex.status >= 500 or ex.status == 429
+                )
+                if not retryable or attempt == self.retries - 1:
+                    raise
+                await asyncio.sleep(2**attempt)
+
+    async def get_json(self, url: str) -> dict:
+        _, data, _ = await self._get(url)
+        return data
+
+    def _record_error(self, url: str, ex: Exception):
+        logger.info(f"Error: {url}: {ex}")
+        self.errors.append({"url": url, "error": repr(ex)})
+
+    async def get_catalog(self, url: str) -> Catalog:
+        """Fetch a catalog or collection, conditionally when the crawl has a state."""
+        if self.state is None:
+            body = await self.get_json(url)
+            children = link_hrefs(body, "child", url)
+            return Catalog(url, body, children, link_hrefs(body, "item", url), True)
+
+        previous = self.state.get(url)
+        status, body, headers = await self._get(url, self.state.conditional_headers(url))
+        if status == 304:
+            return Catalog(url, None, previous.get("children", []), [], False)
+        children = link_hrefs(body, "child", url)
+        known = self.state.known_items(url)
+        items = [u for u in link_hrefs(body, "item", url) if u not in known]
+        self.state.update(url, headers, children, body.get("id"))
+        return Catalog(url, body, children, items, not previous)
+
+    async def children(self, catalog: Catalog) -> list:
+        """Fetch the child catalogs/collections of catalog.
+
+        Return:
+            list: Catalog tuples, children that could not be fetched are left out.
+        """
+
+        async def fetch(url):
+            try:
+                return await self.get_catalog(url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+                self._record_error(url, ex)
+                return None
+
+        children = await asyncio.gather(*[fetch(u) for u in catalog.children])
+        return [child for child in children if child is not None]
+
+    async def items(self, catalog: Catalog, on_item) -> int:
+        """Fetch the (new) items of catalog, calling on_item(item, item_url) as they arrive."""
+
+        async def fetch(item_url):
+            try:
+                return item_url, await self.get_json(item_url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+                self._record_error(item_url, ex)
+                return item_url, None
+
+        count = 0
+        failed = False
+        for future in asyncio.as_completed([fetch(u) for u in catalog.items]):
+            item_url, item = await future
+            if item is None:
+                failed = True
+                continue
+            on_item(item, item_url)
+            if self.state is not None:
+                self.state.add_item(catalog.url, item_url)
+            count += 1
+        if failed and self.state is not None:
+            # a 304 next time would hide the items that could not be fetched
+            self.state.invalidate(catalog.url)
+        return count
+
+    async def walk_items(self, url: str, on_item, catalog: Catalog = None) -> int:
+        """Call on_item for every (new) item below the catalog at url.
+
+        Items of a catalog and its child catalogs are crawled concurrently.
+
+        Return:
+            int: Number of items.
+        """
+        if catalog is None:
+            catalog = await self.get_catalog(url)
+
+        async def walk_children():
+            children = await self.children(catalog)
+            counts = await asyncio.gather(
+                *[self.walk_items(child.url, on_item, catalog=child) for child in children]
+            )
+            return sum(counts)
+
+        counts = await asyncio.gather(self.items(catalog, on_item), walk_children())
+        return sum(counts)
@@ -0,0 +1,67 @@
+import os
+import logging
+from psycopg_pool import ConnectionPool
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+POOL_MIN_SIZE = int(os.environ.get("DB_MIN_CONN_SIZE", 1))
+POOL_MAX_SIZE = int(os.environ.get("DB_MAX_CONN_SIZE", 8))
+
+_pools = {}
+
+
+def forget_pools():
+    """Drop the pools inherited from a parent process, without closing their (shared) connections."""
+    _pools.clear()
+
+
+# a forked process (e.g. a worker of `scheduler.run_tasks`) must not share the
+# sockets of its parent: the inherited pool has no worker threads in the child
+# and its connections are in use by the parent, it opens its own pools
+os.register_at_fork(after_in_child=forget_pools)
+
+
+def conninfo(database_url: str = "") -> str:
+    """Return a libpq connection string from a SQLAlchemy style database URL.
+
+    Args:
+        database_url (str, optional): The URL for the database connection. Defaults to an environment variable called DATABASE_URL if not provided explicitly.
+    Return:
+        str: URL without the SQLAlchemy driver suffix (e.g. `postgresql+psycopg2://`).
+    """
+    if not database_url:
+        database_url = os.environ["DATABASE_URL"]
+    scheme, sep, rest = database_url.partition("://")
+    return f"{scheme.split('+')[0]}{sep}{rest}"
+
+
+def _reset(conn):
+    """Give connections back to the pool in their default (transactional) mode."""
+    conn.autocommit = False
+
+
+def get_pool(database_url: str = "") -> ConnectionPool:
+    """Return a shared psycopg connection pool for database_url.
+
+    The pool is created on first use and kept for the lifetime of the process.
+    """
+    dsn = conninfo(database_url)
+    if dsn not in _pools:
+        logger.debug(f"Opening connection pool ({POOL_MIN_SIZE}-{POOL_MAX_SIZE})")
+        _pools[dsn] = ConnectionPool(
+            dsn, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, reset=_reset, open=True
+        )
+    return _pools[dsn]
+
+
+def set_pool_size(min_size: int, max_size: int):
+    """Set the size of the pools opened from now on by this process (e.g. a worker process)."""
+    global POOL_MIN_SIZE, POOL_MAX_SIZE
+    POOL_MIN_SIZE, POOL_MAX_SIZE = min_size, max(min_size, max_size)
+
+
+def close_pools():
+    """Close every pool opened by get_pool."""
+    for dsn in list(_pools):
+        _pools.pop(dsn).close()
@@ -0,0 +1,212 @@
+"""Shared HTTP downloader: pooled session, large chunks, resume and parallel byte ranges."""
+
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from urllib3.util.retry import Retry
+from .instrument import stage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 8 * 1024 * 1024
+# files smaller than this are not worth splitting into byte ranges
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+POOL_SIZE = 16
+TIMEOUT = (10, 120)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _forget_session():
+    global _session, _session_lock
+    _session, _session_lock = None, threading.Lock()
+
+
+# connections of the parent are not shared with forked processes
+os.register_at_fork(after_in_child=_forget_session)
+
+
+def get_session() -> requests.Session:
+    """Return the process wide requests session, with retries and a connection pool."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=5,
+                backoff_factor=1,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["HEAD", "GET"],
+            )
+            adapter = HTTPAdapter(max_retries=retry, pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def _validators(headers) -> dict:
+    return {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+
+
+def _read_part_meta(part_path: str) -> dict:
+    try:
+        with open(f"{part_path}.json") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_part_meta(part_path: str, headers, **extra):
+    with open(f"{part_path}.json", "w") as f:
+        json.dump({**_validators(headers), **extra}, f)
+
+
+def _remove_part(part_path: str):
+    for path in (part_path, f"{part_path}.json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _progress(file_path: str, total: int, initial: int = 0):
+    return tqdm(
+        desc=os.path.basename(file_path),
+        total=total or None,
+        initial=initial,
+        unit="iB",
+        unit_scale=True,
+        unit_divisor=1024,
+    )
+
+
+def _fetch_range(url: str, part_path: str, start: int, end: int, bar, chunk_size: int):
+    headers = {"Range": f"bytes={start}-{end}"}
+    with get_session().get(url, stream=True, headers=headers, timeout=TIMEOUT) as response:
+        if response.status_code != 206:
+            raise IOError(f"{url} did not honor the byte range {start}-{end}")
+        with open(part_path, "r+b") as f:
+            f.seek(start)
+            for data in response.iter_content(chunk_size):
+                f.write(data)
+                bar.update(len(data))
+
+
+def _download_parallel(url: str, part_path: str, size: int, parallel: int, chunk_size: int, headers):
+    """Fetch url over byte ranges into a `.part` file pre-allocated to size.
+
+    The size of such a file is not the size downloaded: it is marked as parallel
+    (never resumed) and removed if a range fails.
+    """
+    _write_part_meta(part_path, headers, parallel=True)
+    try:
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+        step = -(-size // parallel)
+        ranges = [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+        with _progress(part_path, size) as bar, ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = [
+                executor.submit(_fetch_range, url, part_path, start, end, bar, chunk_size)
+                for start, end in ranges
+            ]
+            for future in futures:
+                future.result()
+    except BaseException:
+        _remove_part(part_path)
+        raise
+
+
+def download(
+    url: str,
+    file_path: str,
+    manifest=None,
+    chunk_size: int = CHUNK_SIZE,
+    parallel: int = 1,
+) -> dict:
+    """Download url into file_path.
+
+    - conditional request from the manifest, nothing is transferred if the source did not change
+    - interrupted transfers are resumed from the `.part` file with an HTTP Range request
+    - files larger than PARALLEL_MIN_SIZE can be fetched over `parallel` byte ranges,
+      an interrupted parallel transfer starts over
+    - data is written to `<file_path>.part` and renamed into place once complete
+
+    Args:
+        url (str): Source URL.
+        file_path (str): Destination path.
+        manifest (Manifest, optional): Download manifest, see `manifest.Manifest`.
+        chunk_size (int, optional): Read size of the response stream. Defaults to 8 MiB
+        parallel (int, optional): Number of concurrent byte range requests. Defaults to 1
+    Return:
+        dict: Manifest entry of the download, None if the content did not change. Record it
+            with `manifest.record(url, entry)` once the source is loaded, so that a failed
+            load is retried by the next run.
+    """
+    with stage("download", url=url) as span:
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        session = get_session()
+        part_path = f"{file_path}.part"
+
+        headers = manifest.conditional_headers(url, file_path) if manifest else {}
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        part_meta = _read_part_meta(part_path) if offset else {}
+        # a parallel .part is pre-allocated, its size says nothing of what was fetched
+        if offset and not part_meta.get("parallel") and (part_meta.get("etag") or part_meta.get("last_modified")):
+            # resume only if the remote file is still the one we started downloading
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = part_meta.get("etag") or part_meta["last_modified"]
+        else:
+            offset = 0
+
+        response = session.get(url, stream=True, headers=headers, timeout=TIMEOUT)
+        if response.status_code == 304:
+            response.close()
+            logger.info(f"{url} not modified since the last download")
+            return None
+        response.raise_for_status()
+
+        size = int(response.headers.get("Content-Length", 0))
+        if response.status_code == 206:
+            logger.info(f"Resuming {url} at byte {offset}")
+            total = offset + size
+        else:
+            offset = 0
+            total = size
+            _write_part_meta(part_path, response.headers)
+
+        ranges_supported = response.headers.get("Accept-Ranges") == "bytes"
+        if not offset and parallel > 1 and ranges_supported and size >= PARALLEL_MIN_SIZE:
+            response.close()
+            _download_parallel(url, part_path, size, parallel, chunk_size, response.headers)
+        else:
+            with response, open(part_path, "ab" if offset else "wb") as f, _progress(
+                file_path, total, offset
+            ) as bar:
+                for data in response.iter_content(chunk_size):
+                    f.write(data)
+                    bar.update(len(data))
+
+        encoded = response.headers.get("Content-Encoding", "identity") != "identity"
+        if total and not encoded and os.path.getsize(part_path) != total:
+            raise IOError(
+                f"Incomplete download of {url}: {os.path.getsize(part_path)} of {total} bytes, "
+                "run again to resume"
+            )
+        os.replace(part_path, file_path)
+        span.add(bytes=os.path.getsize(file_path) - offset)
+        _remove_part(part_path)
+
+        if manifest is None:
+            return {"file_path": file_path}
+        entry = manifest.entry(file_path, response.headers)
+        if not manifest.changed(url, entry):
+            logger.info(f"{url} downloaded again but its content did not change")
+            # the recorded content is loaded, only its validators are new
+            manifest.record(url, entry)
+            return None
+        return entry
@@ -0,0 +1,317 @@
+import geopandas as gpd
+import pandas as pd
+import numpy as np
+import logging
+import json
+import time
+from os import makedirs
+from psycopg import sql
+from ..db import get_pool
+from ..hexgrid import h3_resolution, load_cells, polygons_to_cells
+from ..utils import exist_table, save_postgis
+from ..pgstac_loader import StacLoader
+from ..stac import create_stac_item
+from ..artifacts import media_type, write_artifact_async
+from ..instrument import stage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STAC_VERSION = "1.0.0"
+COLLECTION = "exposure"
+ITEM = f"{COLLECTION}_shakemap_afg"
+TITLE = "Earthquake Exposure, Afghanistan"
+DESCRIPTION = (
+    "Population and buildings per Shakemap intensity band (MMI, PGA) and administrative unit "
+    "for the M 6.3 - 34 km NNW of Herat, Afghanistan earthquake."
+)
+LICENSE = "Creative Commons Attribution International"
+DATETIME = "2023-12-20"
+
+# Every source feature is counted once, at a point on its surface, in the
+# highest band of the hazard layer covering that point and in the admin unit
+# containing it. The hazard bbox filter and the point-in-polygon joins use the
+# GiST indexes of the source, hazard and admin tables.
+COUNT_QUERY = """
+WITH points AS (
+    SELECT s.id, {weight} AS weight, ST_PointOnSurface(s.geometry) AS geometry
+    FROM {source} s
+    WHERE s.geometry && (SELECT ST_Envelope(ST_Collect(h.geometry)) FROM {hazard} h)
+),
+banded AS (
+    SELECT DISTINCT ON (p.id) p.weight, p.geometry, h.paramvalue::float8 AS band
+    FROM points p
+    JOIN {hazard} h ON ST_Intersects(h.geometry, p.geometry)
+    ORDER BY p.id, h.paramvalue DESC
+)
+SELECT b.band, a.id AS admin_id, sum(b.weight)::float8 AS {column}
+FROM banded b
+LEFT JOIN LATERAL (
+    SELECT a.id FROM {admin} a WHERE ST_Intersects(a.geometry, b.geometry) LIMIT 1
+) a ON true
+GROUP BY 1, 2
+"""
+
+# Same counts for sources keyed by H3 cells (population hexbins): the hazard
+# bands and admin units are turned into cell tables once, then it is all
+# integer joins on the btree/primary key indexes.
+H3_COUNT_QUERY = """
+SELECT hz.band, ad.admin_id, sum({weight})::float8 AS {column}
+FROM {source} s
+JOIN {hazard_cells} hz ON hz.h3 = s.h3
+LEFT JOIN {admin_cells} ad ON ad.h3 = s.h3
+GROUP BY 1, 2
+"""
+
+POLYGON_QUERY = """
+SELECT {columns}, ST_AsBinary(geometry) AS geometry FROM {table}
+"""
+
+# Contours are nested, a band covers the higher ones: the zone of a band is its
+# area minus the higher bands, the area where the counts above put a feature in it.
+ZONE_QUERY = """
+WITH bands AS (
+    SELECT h.paramvalue::float8 AS band, ST_Union(h.geometry) AS geometry
+    FROM {hazard} h
+    GROUP BY 1
+),
+zones AS (
+    SELECT
+        b.band,
+        coalesce(
+            ST_Difference(b.geometry, (SELECT ST_Union(u.geometry) FROM bands u WHERE u.band > b.band)),
+            b.geometry
+        ) AS geometry
+    FROM bands b
+),
+pieces AS (
+    SELECT
+        z.band,
+        a.id AS admin_id,
+        {admin_columns},
+        ST_CollectionExtract(ST_Intersection(z.geometry, a.geometry), 3) AS geometry
+    FROM zones z
+    JOIN {admin} a ON ST_Intersects(z.geometry, a.geometry)
+)
+SELECT band, admin_id, {piece_columns}, ST_AsBinary(ST_Multi(geometry)) AS geometry
+FROM pieces
+WHERE NOT ST_IsEmpty(geometry)
+"""
+
+
+def _query(query, **identifiers) -> pd.DataFrame:
+    composed = sql.SQL(query).format(**identifiers)
+    with get_pool().connection() as conn:
+        cur = conn.execute(composed)
+        columns = [d.name for d in cur.description]
+        return pd.DataFrame(cur.fetchall(), columns=columns)
+
+
+def hazard_zones(hazard_table, admin_table, admin_columns) -> gpd.GeoDataFrame:
+    """Intersection of every band of the hazard layer (without the higher bands) with the admin units."""
+    df = _query(
+        ZONE_QUERY,
+        hazard=sql.Identifier(hazard_table),
+        admin=sql.Identifier(admin_table),
+        admin_columns=sql.SQL(", ").join(sql.Identifier("a", c) for c in admin_columns),
+        piece_columns=sql.SQL(", ").join(map(sql.Identifier, admin_columns)),
+    )
+    geometry = gpd.GeoSeries.from_wkb(df.pop("geometry").map(bytes), crs=4326)
+    return gpd.GeoDataFrame(df, geometry=geometry.values, crs=4326)
+
+
+def _read_polygons(table, columns) -> gpd.GeoDataFrame:
+    df = _query(
+        POLYGON_QUERY,
+        table=sql.Identifier(table),
+        columns=sql.SQL(", ").join(
+            sql.SQL("{} AS {}").format(sql.Identifier(c), sql.Identifier(alias))
+            for c, alias in columns.items()
+        ),
+    )
+    geometry = gpd.GeoSeries.from_wkb(df.pop("geometry").map(bytes), crs=4326)
+    return gpd.GeoDataFrame(df, geometry=geometry.values, crs=4326)
+
+
+def source_resolution(source_table) -> int:
+    df = _query("SELECT h3 FROM {source} LIMIT 1", source=sql.Identifier(source_table))
+    return int(h3_resolution(df["h3"].to_numpy(dtype="int64"))[0])
+
+
+def cell_table(table, res, columns, value_column) -> str:
+    """Load the H3 cells (at res) covered by the polygons of table into `<table>_h3`."""
+    cells = polygons_to_cells(_read_polygons(table, columns), res, value_column)
+    load_cells(cells, f"{table}_h3")
+    return f"{table}_h3"
+
+
+def exposure_counts_h3(hazard_cells, source_table, admin_cells, column, weight=None) -> pd.DataFrame:
+    """Sum of weight of the H3 keyed source_table per band and admin unit, with integer joins."""
+    start = time.perf_counter()
+    df = _query(
+        H3_COUNT_QUERY,
+        hazard_cells=sql.Identifier(hazard_cells),
+        source=sql.Identifier(source_table),
+        admin_cells=sql.Identifier(admin_cells),
+        weight=sql.Identifier("s", weight) if weight else sql.Literal(1),
+        column=sql.Identifier(column),
+    )
+    logger.info(
+        f"{column} of {source_table} per {hazard_cells} band (h3): "
+        f"{df[column].sum():.0f} in {time.perf_counter() - start:.1f}s"
+    )
+    return df
+
+
+def exposure_counts(hazard_table, source_table, admin_table, column, weight=None) -> pd.DataFrame:
+    """Sum of weight (count of features if None) of source_table per band and admin unit."""
+    start = time.perf_counter()
+    df = _query(
+        COUNT_QUERY,
+        hazard=sql.Identifier(hazard_table),
+        source=sql.Identifier(source_table),
+        admin=sql.Identifier(admin_table),
+        weight=sql.Identifier("s", weight) if weight else sql.Literal(1),
+        column=sql.Identifier(column),
+    )
+    logger.info(
+        f"{column} of {source_table} per {hazard_table} band: "
+        f"{df[column].sum():.0f} in {time.perf_counter() - start:.1f}s"
+    )
+    return df
+
+
+def compute_exposure(
+    hazard_tables: dict,
+    admin_table: str,
+    admin_columns: list,
+    population_table: str = None,
+    buildings_table: str = None,
+    method: str = "spatial",
+) -> gpd.GeoDataFrame:
+    """Return population and building counts per hazard band and admin unit.
+
+    Args:
+        hazard_tables (dict): Hazard layer name -> table, e.g. {"mi": "earthquake_usgs_gov_shakemap_afg_mi"}
+        admin_table (str): Admin boundaries table.
+        admin_columns (list): Columns of the admin table copied to the exposure table.
+        population_table (str, optional): Table with a `population` column.
+        buildings_table (str, optional): Buildings footprints table.
+        method (str, optional): "spatial" (point in polygon joins) or "h3" (integer joins on the
+            H3 cells of the population table). Defaults to 'spatial'
+    Return:
+        GeoDataFrame: One row per hazard layer, band and admin unit.
+    """
+    # (table, column, weight, keyed by H3 cells)
+    sources = [
+        source
+        for source in [
+            (population_table, "population", "population", method == "h3"),
+            (buildings_table, "buildings", None, False),
+        ]
+        if source[0]
+    ]
+    admin_cells = None
+    if method == "h3" and exist_table(population_table):
+        res = source_resolution(population_table)
+        admin_cells = cell_table(admin_table, res, {"id": "admin_id"}, "admin_id")
+
+    layers = []
+    for layer, hazard_table in hazard_tables.items():
+        zones = hazard_zones(hazard_table, admin_table, admin_columns)
+        hazard_cells = None
+        if admin_cells:
+            hazard_cells = cell_table(hazard_table, res, {"paramvalue": "band"}, "band")
+        for table, column, weight, h3_keyed in sources:
+            if not exist_table(table):
+                logger.warning(f"{table} does not exist, no {column} exposure")
+                zones[column] = np.nan
+                continue
+            if h3_keyed:
+                counts = exposure_counts_h3(hazard_cells, table, admin_cells, column, weight)
+            else:
+                counts = exposure_counts(hazard_table, table, admin_table, column, weight)
+            outside = counts.loc[counts["admin_id"].isna(), column].sum()
+            if outside:
+                logger.warning(f"{outside:.0f} {column} of {hazard_table} outside of {admin_table}")
+            zones = zones.merge(counts, on=["band", "admin_id"], how="left")
+            zones[column] = zones[column].fillna(0)
+        zones.insert(0, "hazard", layer)
+        layers.append(zones)
+
+    gdf = gpd.GeoDataFrame(pd.concat(layers, ignore_index=True), crs=4326)
+    gdf["id"] = np.arange(len(gdf))
+    return gdf
+
+
+def run(
+    path_local: str,
+    hazard_tables: dict,
+    admin_table: str,
+    admin_columns: list,
+    population_table: str = None,
+    buildings_table: str = None,
+    artifact_format: str = "geoparquet",
+    optimize: dict = None,
+    method: str = "spatial",
+):
+    #################
+    # Load collection into the DB
+    #################
+    logger.info("\n\nLoad collection into the DB..")
+    stac_collection_path = f"datasets/exposure/collection.json"
+    makedirs(path_local, exist_ok=True)
+    with StacLoader() as loader:
+        loader.add_collections(stac_collection_path)
+        # #################
+        # Join the hazard, population and buildings tables in the DB
+        # #################
+        with stage("compute_exposure", method=method) as span:
+            gdf = compute_exposure(
+                hazard_tables,
+                admin_table,
+                admin_columns,
+                population_table=population_table,
+                buildings_table=buildings_table,
+                method=method,
+            )
+            span.add(rows=len(gdf))
+        logger.info(f"{len(gdf)} exposure rows")
+        # the artifact is written while the data is loaded into the DB
+        artifact = write_artifact_async(gdf, f"{path_local}/{ITEM}", artifact_format)
+        save_postgis(
+            gdf=gdf,
+            table_name=ITEM,
+            if_exists="replace",
+            index=False,
+            schema="public",
+            table_id="id",
+            optimize=optimize,
+        )
+        # #################
+        # save item stac
+        # #################
+        file_path = artifact.result()
+        stac_item = create_stac_item(
+            gdf,
+            item_id=ITEM,
+            collection=COLLECTION,
+            datetime=DATETIME,
+            asset_href=file_path,
+            asset_media_type=media_type(artifact_format),
+            asset_roles=["data"],
+            properties={
+                "exposure:hazard_tables": hazard_tables,
+                "exposure:admin_table": admin_table,
+                "exposure:population_table": population_table,
+                "exposure:buildings_table": buildings_table,
+            },
+        )
+        stac_item["title"] = TITLE
+        stac_item["description"] = DESCRIPTION
+        stac_item["license"] = LICENSE
+        stac_item["table"] = ITEM
+        stac_item_path = f"{path_local}/{ITEM}_stac_item_.json"
+        with open(stac_item_path, "w") as file:
+            file.write(json.dumps(stac_item))
+        loader.add_item(stac_item)
@@ -0,0 +1,56 @@
+"""Topology preserving generalization of polygon coverages (e.g. admin boundaries) for low zooms."""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import geopandas as gpd
+import shapely
+from pyproj import CRS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_ZOOMS = (4, 8)
+TOLERANCE_PX = 1
+
+
+def zoom_tolerance(z: int, crs=4326) -> float:
+    """Simplification tolerance matching TOLERANCE_PX pixels of a 256px tile at zoom z, in CRS units."""
+    if CRS.from_user_input(crs).is_geographic:
+        return TOLERANCE_PX * 360 / (256 * 2**z)
+    return TOLERANCE_PX * 2 * 20037508.342789244 / (256 * 2**z)
+
+
+def simplify_coverage(gdf: gpd.GeoDataFrame, tolerance: float) -> gpd.GeoDataFrame:
+    """Simplify the polygons of gdf together, so shared borders stay shared (no gaps or overlaps).
+
+    Falls back to per-feature topology preserving simplification when the
+    polygons do not form a valid coverage.
+    """
+    geometries = gdf.geometry.to_numpy()
+    try:
+        simplified = shapely.coverage_simplify(geometries, tolerance)
+    except shapely.errors.GEOSException as ex:
+        logger.warning(f"Not a valid coverage ({ex}), simplifying features one by one")
+        simplified = shapely.simplify(geometries, tolerance, preserve_topology=True)
+    return gdf.set_geometry(gpd.GeoSeries(simplified, index=gdf.index, crs=gdf.crs))
+
+
+def coverage_variants(gdf: gpd.GeoDataFrame, zooms=DEFAULT_ZOOMS, workers: int = None) -> dict:
+    """Return a generalized copy of gdf per zoom level, computed in parallel.
+
+    Return:
+        dict: zoom -> GeoDataFrame.
+    """
+    if not zooms:
+        return {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers or len(zooms)) as executor:
+        futures = {z: executor.submit(simplify_coverage, gdf, zoom_tolerance(z, gdf.crs)) for z in zooms}
+        variants = {z: future.result() for z, future in futures.items()}
+    vertices = {z: int(shapely.get_num_coordinates(v.geometry.to_numpy()).sum()) for z, v in variants.items()}
+    logger.info(
+        f"Generalized {len(gdf)} features ({int(shapely.get_num_coordinates(gdf.geometry.to_numpy()).sum())} "
+        f"vertices) to {vertices} in {time.perf_counter() - start:.1f}s"
+    )
+    return variants
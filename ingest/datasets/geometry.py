@@ -0,0 +1,126 @@
+"""Geometry preparation shared by the read paths: reprojection, validity repair and metric area.
+
+Shapely 2 and pyproj release the GIL in their vectorized functions, so large
+frames are split in row chunks prepared by a thread pool, with no copy
+between processes.
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import CRS, Geod, Transformer
+from .instrument import stage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# World Cylindrical Equal Area, areas in m² anywhere on the globe
+EQUAL_AREA_CRS = 6933
+PREP_WORKERS = int(os.environ.get("INGEST_PREP_WORKERS", os.cpu_count() or 1))
+# below this, a chunk is not worth a thread
+MIN_ROWS_PER_WORKER = 10000
+AREA_METHODS = ("equal_area", "geodesic")
+
+
+def same_crs(a, b) -> bool:
+    if a is None or b is None:
+        return a is None and b is None
+    return CRS.from_user_input(a).equals(CRS.from_user_input(b))
+
+
+def _transform(geometries: np.ndarray, src, dst) -> np.ndarray:
+    # a transformer per call, pyproj transformers are not shared between threads
+    transformer = Transformer.from_crs(src, dst, always_xy=True)
+
+    def project(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
+
+    return shapely.transform(geometries, project)
+
+
+def _make_valid(geometries: np.ndarray) -> np.ndarray:
+    invalid = ~shapely.is_valid(geometries) & ~shapely.is_missing(geometries)
+    if not invalid.any():
+        return geometries
+    geometries = geometries.copy()
+    # "structure" keeps polygons polygonal instead of returning collections with their collapsed parts
+    geometries[invalid] = shapely.make_valid(geometries[invalid], method="structure", keep_collapsed=False)
+    return geometries
+
+
+def _area(geometries: np.ndarray, crs, method: str) -> np.ndarray:
+    if method == "geodesic":
+        geod = Geod(ellps="WGS84")
+        if not same_crs(crs, 4326):
+            geometries = _transform(geometries, crs, 4326)
+        return np.array([abs(geod.geometry_area_perimeter(g)[0]) if g is not None else np.nan for g in geometries])
+    if not same_crs(crs, EQUAL_AREA_CRS):
+        geometries = _transform(geometries, crs, EQUAL_AREA_CRS)
+    return shapely.area(geometries)
+
+
+def _prepare_chunk(geometries, src, dst, make_valid, area_method):
+    area = None
+    if make_valid:
+        geometries = _make_valid(geometries)
+    if area_method:
+        area = _area(geometries, src, area_method)
+    if not same_crs(src, dst):
+        geometries = _transform(geometries, src, dst)
+    return geometries, area
+
+
+def prepare_geometries(
+    gdf: gpd.GeoDataFrame,
+    crs=4326,
+    make_valid: bool = False,
+    area_column: str = None,
+    area_method: str = "equal_area",
+    workers: int = None,
+) -> gpd.GeoDataFrame:
+    """Reproject gdf to crs, repair invalid geometries and add their area in m², on all cores.
+
+    The transform is skipped when gdf is already in crs, and nothing is done
+    (gdf is returned as is) when there is nothing to do.
+
+    Args:
+        gdf (GeoDataFrame): Frame to prepare.
+        crs (optional): Output CRS. Defaults to EPSG:4326
+        make_valid (bool, optional): Repair invalid geometries with `shapely.make_valid`. Defaults to False
+        area_column (str, optional): Column receiving the area in m². Defaults to None (no area)
+        area_method (str, optional): "equal_area" (planar area in EPSG:6933) or "geodesic" (on the WGS84 ellipsoid, slower). Defaults to 'equal_area'
+        workers (int, optional): Number of threads. Defaults to INGEST_PREP_WORKERS
+    Return:
+        GeoDataFrame: gdf prepared, in crs.
+    """
+    if area_method not in AREA_METHODS:
+        raise ValueError(f"'{area_method}' is not a valid area method, use one of {AREA_METHODS}")
+    src = gdf.crs
+    if src is None:
+        raise ValueError("Cannot prepare geometries without a CRS")
+    reproject = crs is not None and not same_crs(src, crs)
+    if not (reproject or make_valid or area_column):
+        return gdf
+    dst = crs if reproject else src
+
+    with stage("prepare_geometry", reproject=reproject, make_valid=make_valid) as span:
+        geometries = gdf.geometry.to_numpy()
+        workers = max(1, min(workers or PREP_WORKERS, len(geometries) // MIN_ROWS_PER_WORKER))
+        chunks = np.array_split(geometries, workers) if workers > 1 else [geometries]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(
+                    lambda g: _prepare_chunk(g, src, dst, make_valid, area_column and area_method),
+                    chunks,
+                )
+            )
+        prepared = np.concatenate([g for g, _ in results]) if results else geometries
+        gdf = gdf.set_geometry(gpd.GeoSeries(prepared, index=gdf.index, crs=dst))
+        if area_column:
+            gdf[area_column] = np.concatenate([a for _, a in results])
+        span.add(rows=len(gdf))
+    return gdf
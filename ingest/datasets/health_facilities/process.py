@@ -1,12 +1,17 @@
 import geopandas as gpd
 import logging
-import requests
 import re
-from tqdm import tqdm
 import json
-from os import makedirs, environ
-import zipfile
-from ..utils import run_cli, save_postgis
+from os import makedirs
+from ..utils import exist_table, save_postgis
+from ..manifest import Manifest
+from ..archive import vsi_path
+from ..download import download, get_session
+from ..pgstac_loader import StacLoader
+from ..stac import create_stac_item
+from ..artifacts import media_type, write_artifact_async
+from ..instrument import stage
+from ..geometry import prepare_geometries
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,56 +30,52 @@ LICENSE = "Open Database License (ODC-ODbL)"
 
 
 def get_link():
-    r = requests.get(PAGE_LINK)
+    r = get_session().get(PAGE_LINK)
     all_links = re.findall(REGEX_URL, r.text)
     filter_links = [i for i in all_links if "health_facilities_gpkg.zip" in i]
     return filter_links[-1]
 
 
-def download_data(link, file_tmp_path):
-    block_size = 1024
-    response = requests.get(link, stream=True)
-    extract_path = "/".join(file_tmp_path.split("/")[:-1]).split(".")[0]
-    total_size_in_bytes = int(response.headers.get("content-length", 0))
-    # create folter
-    makedirs(extract_path, exist_ok=True)
-    with open(file_tmp_path, "wb") as file, tqdm(
-        desc=file_tmp_path,
-        total=total_size_in_bytes,
-        unit="iB",
-        unit_scale=True,
-        unit_divisor=1024,
-    ) as bar:
-        for data in response.iter_content(block_size):
-            bar.update(len(data))
-            file.write(data)
+def download_data(link, file_tmp_path, manifest=None):
+    """Download link, unless it did not change since the download recorded in manifest.
 
-    file_names = ""
-    with zipfile.ZipFile(file_tmp_path, "r") as zip_ref:
-        file_names = [i for i in list(zip_ref.namelist()) if i.endswith(".gpkg")][0]
-        zip_ref.extractall(extract_path)
+    The zip archive is not extracted, the GeoPackage is read in place through /vsizip/.
 
-    return f"{extract_path}/{file_names}"
+    Return:
+        tuple: (GDAL path of the GeoPackage, manifest entry to record once loaded or None if unchanged)
+    """
+    entry = download(link, file_tmp_path, manifest=manifest)
+    return vsi_path(file_tmp_path, extension=".gpkg"), entry
 
 
-def run(path_local):
+def run(
+    path_local,
+    optimize: dict = None,
+    artifact_format: str = "geoparquet",
+    force: bool = False,
+):
     makedirs(path_local, exist_ok=True)
     #################
     # Load collection into the DB
     #################
     logger.info("\n\nLoad collection into the DB..")
     stac_collection_path = f"datasets/health_facilities/collection.json"
-    logger.info("Importing colletion to pgstac...")
-    output_json = run_cli(
-        ["pypgstac", "load", "collections"],
-        stac_collection_path,
-        {"--method": "insert_ignore", "--dsn": environ["DATABASE_URL"]},
-    )
-    link = get_link()
+    loader = StacLoader()
+    loader.add_collections(stac_collection_path)
+    with stage("discover_link"):
+        link = get_link()
     file_name = link.split("/")[-1]
-    file_gpkg = download_data(link, f"{path_local}/{file_name}")
-    gdf = gpd.read_file(file_gpkg)
-    gdf = gdf.to_crs(4326)
+    manifest = Manifest()
+    file_gpkg, entry = download_data(link, f"{path_local}/{file_name}", manifest)
+    if entry is None and not force and exist_table(ITEM):
+        logger.info(f"{ITEM} is up to date, skipping")
+        # the collection may still have changed
+        loader.flush()
+        return
+    with stage("read") as span:
+        gdf = gpd.read_file(file_gpkg)
+        span.add(rows=len(gdf))
+    gdf = prepare_geometries(gdf, 4326)
     gdf["id"] = list(range(gdf.shape[0]))
     gdf = gdf.rename(columns={'addr:city': 'addr_city'})
     gdf = gdf.rename(columns={'capacity:persons':'capacity_persons'})
@@ -82,17 +83,8 @@ def run(path_local):
     gdf = gdf.rename(columns={'operator:type':'operator_type'})
     gdf = gdf.rename(columns={'addr:full':'addr_full'})
     
-    # ##############
-    # metadata
-    # ##############
-    args = {
-        "--id": ITEM,
-        "--datetime": "2023-11-16",
-        "--collection": COLLECTION,
-        "--asset-href": link,
-    }
-    file_path = f"{path_local}/{ITEM}.geojson"
-    gdf.to_file(file_path, driver="GeoJSON")
+    # the artifact is written while the data is loaded into the DB
+    artifact = write_artifact_async(gdf, f"{path_local}/{ITEM}", artifact_format)
 
     save_postgis(
         gdf=gdf,
@@ -101,19 +93,29 @@ def run(path_local):
         index=True,
         schema="public",
         table_id="id",
+        optimize=optimize,
     )
 
     # ##############
     # save item stac
     # ##############
 
-    output_json = run_cli(["fio", "stac"], file_path, args)
-
-    output_json["output"]["title"] = TITLE
-    output_json["output"]["description"] = DESCRIPTION
-    output_json["output"]["license"] = LICENSE
-    output_json["output"]["table"] = ITEM
-    output_json["output"]["links"] = {
+    file_path = artifact.result()
+    stac_item = create_stac_item(
+        gdf,
+        item_id=ITEM,
+        collection=COLLECTION,
+        datetime="2023-11-16",
+        asset_href=file_path,
+        asset_media_type=media_type(artifact_format),
+        asset_roles=["data"],
+        extra_assets={"source": {"href": link, "roles": ["source"]}},
+    )
+    stac_item["title"] = TITLE
+    stac_item["description"] = DESCRIPTION
+    stac_item["license"] = LICENSE
+    stac_item["table"] = ITEM
+    stac_item["links"] = {
         "href": link,
         "rel": link,
         "title": TITLE,
@@ -121,12 +123,12 @@ def run(path_local):
     stac_item_path = f"{path_local}/{ITEM}_stac_item_.json"
 
     with open(stac_item_path, "w") as file:
-        file.write(json.dumps(output_json["output"]))
+        file.write(json.dumps(stac_item))
     #################
-    # Run: pypgstac load collections
+    # Load collection and item into pgstac
     #################
-    output_json = run_cli(
-        ["pypgstac", "load", "items"],
-        stac_item_path,
-        {"--method": "insert_ignore", "--dsn": environ["DATABASE_URL"]},
-    )
+    logger.info("Importing colletion/item to pgstac...")
+    loader.add_item(stac_item)
+    loader.flush()
+    if entry:
+        manifest.record(link, entry)
@@ -0,0 +1,106 @@
+"""H3 cell indexes as BIGINT keys, for integer joins and roll-ups instead of polygon overlays."""
+
+import logging
+import time
+import h3
+import numpy as np
+import pandas as pd
+from psycopg import sql
+from .db import get_pool
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# H3 index layout: resolution in bits 52-55, then one 3 bit digit per
+# resolution (res 1 in bits 42-44 ... res 15 in bits 0-2), unused digits are 7.
+RES_OFFSET = 52
+RES_MASK = np.int64(0xF << RES_OFFSET)
+MAX_RES = 15
+
+
+def h3_to_int(cells) -> np.ndarray:
+    """Convert H3 hexadecimal strings to int64, vectorized."""
+    cells = pd.Series(cells, dtype=str).str.zfill(16)
+    if cells.empty:
+        return np.array([], dtype=np.int64)
+    return np.frombuffer(bytes.fromhex("".join(cells)), dtype=">i8").astype(np.int64)
+
+
+def h3_resolution(cells: np.ndarray) -> np.ndarray:
+    return (cells & RES_MASK) >> RES_OFFSET
+
+
+def h3_parent(cells: np.ndarray, res: int) -> np.ndarray:
+    """Parent cells at resolution res of int64 H3 cells (at a finer resolution), with bit operations."""
+    unused_digits = np.int64((1 << (3 * (MAX_RES - res))) - 1)
+    return (cells & ~RES_MASK) | np.int64(res << RES_OFFSET) | unused_digits
+
+
+def add_h3_columns(gdf, column: str = "h3", parents: tuple = ()):
+    """Store the H3 cells of column as int64 and add `<column>_res<r>` parent columns."""
+    if gdf[column].dtype != np.int64:
+        gdf[column] = h3_to_int(gdf[column])
+    for res in parents:
+        gdf[f"{column}_res{res}"] = h3_parent(gdf[column].to_numpy(), res)
+    return gdf
+
+
+def polygons_to_cells(gdf, res: int, value_column: str = None) -> pd.DataFrame:
+    """Return the H3 cells (int64) whose center is inside the polygons of gdf.
+
+    Args:
+        gdf (GeoDataFrame): Polygons in EPSG:4326, e.g. hazard contours or admin units.
+        res (int): H3 resolution.
+        value_column (str, optional): Column copied to the cells; a cell covered by several
+            polygons keeps the highest value.
+    Return:
+        DataFrame: `h3` column, plus value_column.
+    """
+    start = time.perf_counter()
+    frames = []
+    for geometry, value in zip(gdf.geometry, gdf[value_column] if value_column else [None] * len(gdf)):
+        if geometry is None or geometry.is_empty:
+            continue
+        cells = [h3.str_to_int(c) for c in h3.geo_to_cells(geometry, res)]
+        frame = pd.DataFrame({"h3": np.array(cells, dtype=np.uint64).astype(np.int64)})
+        if value_column:
+            frame[value_column] = value
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame({"h3": np.array([], dtype=np.int64)})
+    df = pd.concat(frames, ignore_index=True)
+    if value_column:
+        df = df.sort_values(value_column, ascending=False)
+    df = df.drop_duplicates("h3").sort_values("h3", ignore_index=True)
+    logger.info(f"{len(gdf)} polygons -> {len(df)} H3 cells at res {res} in {time.perf_counter() - start:.1f}s")
+    return df
+
+
+def load_cells(df: pd.DataFrame, table_name: str, schema: str = "public", database_url: str = ""):
+    """Replace table_name with the cells of df (`h3` BIGINT primary key plus numeric/text columns)."""
+    types = {
+        col: "bigint" if col == "h3" else "double precision" if pd.api.types.is_numeric_dtype(df[col]) else "text"
+        for col in df.columns
+    }
+    table = sql.Identifier(schema, table_name)
+    with get_pool(database_url).connection() as conn:
+        with conn.transaction():
+            conn.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(table))
+            conn.execute(
+                sql.SQL("CREATE TABLE {} ({}, PRIMARY KEY (h3))").format(
+                    table,
+                    sql.SQL(", ").join(
+                        sql.SQL("{} {}").format(sql.Identifier(col), sql.SQL(pg_type))
+                        for col, pg_type in types.items()
+                    ),
+                )
+            )
+            with conn.cursor().copy(
+                sql.SQL("COPY {} ({}) FROM STDIN").format(
+                    table, sql.SQL(", ").join(map(sql.Identifier, df.columns))
+                )
+            ) as copy:
+                for row in df.itertuples(index=False, name=None):
+                    copy.write_row(row)
+        conn.execute(sql.SQL("ANALYZE {}").format(table))
+    logger.info(f"Loaded {len(df)} cells into {schema}.{table_name}")
@@ -0,0 +1,248 @@
+"""Spans around the stages of an ingest: wall time, rows, bytes and peak memory.
+
+Every finished span is logged as one JSON line (logger `ingest.metrics`).
+Spans of a dataset run are also summed up per stage and written, when the
+run ends, to a Prometheus textfile (`INGEST_METRICS_DIR/ingest_<dataset>.prom`),
+for the node exporter textfile collector.
+
+Usage:
+    with instrument.run("population"):
+        with instrument.stage("download", url=url) as span:
+            ...
+            span.add(bytes=size)
+
+Stages run in worker processes (e.g. admin boundary levels) are logged but
+only counted in the textfile through the span around the pool in the parent.
+"""
+
+import json
+import logging
+import os
+import re
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+metrics_logger = logging.getLogger("ingest.metrics")
+
+METRICS_DIR = os.environ.get("INGEST_METRICS_DIR", "")
+SAMPLE_INTERVAL = float(os.environ.get("INGEST_RSS_SAMPLE_INTERVAL", 0.2))
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+_current = None
+_open_spans = set()
+_lock = threading.Lock()
+_sampler = None
+
+
+def rss_bytes() -> int:
+    """Resident memory of this process, or its peak if /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        # ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _sample():
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        rss = rss_bytes()
+        with _lock:
+            for span in _open_spans:
+                span.peak_rss = max(span.peak_rss, rss)
+
+
+def _reset_after_fork():
+    """Start the child of a fork with its own lock and no sampler.
+
+    Only the forking thread survives a fork: the lock may be held by the sampler
+    of the parent, which would never release it in the child.
+    """
+    global _lock, _sampler, _open_spans
+    _lock = threading.Lock()
+    _sampler = None
+    _open_spans = set()
+
+
+# e.g. the process pools of scheduler.run_tasks, tiles and the orchestrator
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _start_sampler():
+    global _sampler
+    with _lock:
+        if _sampler is None or not _sampler.is_alive():
+            _sampler = threading.Thread(target=_sample, name="rss-sampler", daemon=True)
+            _sampler.start()
+
+
+class Span:
+    """One stage execution. Add the rows and bytes it processed with `add`."""
+
+    def __init__(self, stage: str, dataset: str = None, **attrs):
+        self.stage = stage
+        self.dataset = dataset
+        self.attrs = attrs
+        self.rows = 0
+        self.bytes = 0
+        self.status = "ok"
+        self.seconds = 0.0
+        self.peak_rss = rss_bytes()
+        self._start = time.perf_counter()
+
+    def add(self, rows: int = 0, bytes: int = 0):
+        self.rows += int(rows or 0)
+        self.bytes += int(bytes or 0)
+
+    def end(self):
+        self.seconds = time.perf_counter() - self._start
+        self.peak_rss = max(self.peak_rss, rss_bytes())
+
+    def to_dict(self) -> dict:
+        return {
+            "event": "span",
+            "dataset": self.dataset,
+            "stage": self.stage,
+            "status": self.status,
+            "seconds": round(self.seconds, 3),
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "rows_per_s": round(self.rows / self.seconds, 1) if self.seconds and self.rows else None,
+            "bytes_per_s": round(self.bytes / self.seconds, 1) if self.seconds and self.bytes else None,
+            "peak_rss_mb": round(self.peak_rss / 1024**2, 1),
+            **self.attrs,
+        }
+
+
+class Run:
+    """Spans of one dataset run, summed per stage for the Prometheus textfile."""
+
+    def __init__(self, dataset: str):
+        self.dataset = dataset
+        self.stages = {}
+        self.started_at = time.time()
+
+    def record(self, span: Span):
+        with _lock:
+            stage = self.stages.setdefault(
+                span.stage, {"count": 0, "errors": 0, "seconds": 0.0, "rows": 0, "bytes": 0, "peak_rss": 0}
+            )
+            stage["count"] += 1
+            stage["errors"] += span.status != "ok"
+            stage["seconds"] += span.seconds
+            stage["rows"] += span.rows
+            stage["bytes"] += span.bytes
+            stage["peak_rss"] = max(stage["peak_rss"], span.peak_rss)
+
+    def textfile(self, success: bool, seconds: float) -> str:
+        """Prometheus text exposition of the run."""
+        dataset = _label(self.dataset)
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{name}{{{labels}}} {value}" for labels, value in samples)
+
+        per_stage = sorted(self.stages.items())
+        for name, key, help_text in [
+            ("ingest_stage_seconds", "seconds", "Wall time of the stage in the last run."),
+            ("ingest_stage_rows", "rows", "Rows processed by the stage in the last run."),
+            ("ingest_stage_bytes", "bytes", "Bytes processed by the stage in the last run."),
+            ("ingest_stage_calls", "count", "Number of spans of the stage in the last run."),
+            ("ingest_stage_errors", "errors", "Failed spans of the stage in the last run."),
+            ("ingest_stage_peak_rss_bytes", "peak_rss", "Peak resident memory during the stage."),
+        ]:
+            metric(
+                name,
+                "gauge",
+                help_text,
+                [(f'dataset="{dataset}",stage="{_label(s)}"', round(v[key], 3)) for s, v in per_stage],
+            )
+        metric("ingest_run_seconds", "gauge", "Wall time of the last run.", [(f'dataset="{dataset}"', round(seconds, 3))])
+        metric("ingest_run_success", "gauge", "1 if the last run succeeded.", [(f'dataset="{dataset}"', int(success))])
+        metric(
+            "ingest_run_timestamp_seconds",
+            "gauge",
+            "End of the last run, as a Unix timestamp.",
+            [(f'dataset="{dataset}"', round(time.time(), 3))],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, success: bool, seconds: float, directory: str = None):
+        directory = directory or METRICS_DIR
+        if not directory:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"ingest_{re.sub(r'[^A-Za-z0-9_]', '_', self.dataset)}.prom")
+        # written then renamed, the collector must never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.textfile(success, seconds))
+        os.replace(tmp_path, path)
+        return path
+
+
+def _label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@contextmanager
+def stage(name: str, **attrs):
+    """Time the block as stage name of the current run, yield the `Span`."""
+    span = Span(name, _current.dataset if _current else os.environ.get("INGEST_DATASET"), **attrs)
+    _start_sampler()
+    with _lock:
+        _open_spans.add(span)
+    try:
+        yield span
+    except BaseException:
+        span.status = "error"
+        raise
+    finally:
+        with _lock:
+            _open_spans.discard(span)
+        span.end()
+        metrics_logger.info(json.dumps(span.to_dict(), default=str))
+        if _current is not None:
+            _current.record(span)
+
+
+def timed(name: str):
+    """Decorator: run the function in a stage span."""
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def run(dataset: str, metrics_dir: str = None):
+    """Collect the spans of a dataset run, write its Prometheus textfile when it ends."""
+    global _current
+    previous, _current = _current, Run(dataset)
+    current = _current
+    start = time.perf_counter()
+    success = False
+    try:
+        with stage("total"):
+            yield current
+        success = True
+    finally:
+        _current = previous
+        try:
+            current.write_textfile(success, time.perf_counter() - start, metrics_dir)
+        except OSError as ex:
+            logger.warning(f"Could not write the metrics of {dataset}: {ex}")
@@ -0,0 +1,119 @@
+"""Local manifest of downloaded sources, for conditional and incremental ingests."""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MANIFEST_PATH = os.environ.get("INGEST_MANIFEST_PATH", "/data/.ingest_manifest.json")
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def sha256sum(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """ETag, Last-Modified, size and content hash of every loaded source URL.
+
+    The manifest lives on the data volume next to the downloads, so a new run
+    can send conditional requests and skip sources that have not changed. An
+    entry is only recorded once its source is loaded (tables and items), so a
+    failed load is retried by the next run.
+
+    Several processes share the file (orchestrator stages, scheduler workers),
+    so it is re-read and merged under an exclusive lock on `<path>.lock` on
+    every save.
+    """
+
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._recorded = {}
+        self.entries = self._read()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, url: str) -> dict:
+        return self.entries.get(url, {})
+
+    def conditional_headers(self, url: str, file_path: str) -> dict:
+        """Return If-None-Match/If-Modified-Since headers for url.
+
+        Headers are only sent when the previous download is still on disk,
+        otherwise a 304 would leave us without the file.
+        """
+        entry = self.get(url)
+        if not entry or entry.get("file_path") != file_path or not os.path.exists(file_path):
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def entry(self, file_path: str, headers=None) -> dict:
+        """Entry of a completed download into file_path, to `record` once it is loaded."""
+        headers = headers or {}
+        return {
+            "file_path": file_path,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "size": os.path.getsize(file_path),
+            "sha256": sha256sum(file_path),
+            "downloaded_at": datetime.now(timezone.utc).isoformat(),
+        }
+
+    def changed(self, url: str, entry: dict) -> bool:
+        """True if the content of entry differs from the one recorded for url."""
+        return self.get(url).get("sha256") != entry["sha256"]
+
+    def record(self, url: str, entry: dict):
+        """Record entry for url, e.g. once the source is loaded, and save the manifest."""
+        with self._lock:
+            self._recorded[url] = entry
+            self.save()
+
+    def save(self):
+        """Merge the entries recorded by this process into the manifest file."""
+        with self._file_lock():
+            entries = self._read()
+            entries.update(self._recorded)
+            # unique per writer, os.replace is atomic
+            tmp_path = f"{self.path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(entries, f, indent=2)
+                os.replace(tmp_path, self.path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        self.entries = entries
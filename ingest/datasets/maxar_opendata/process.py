@@ -1,96 +1,143 @@
 """Create STAC Collections and Items files."""
 
+import asyncio
 import json
 import logging
-import pystac
-from os import makedirs, environ
-import geopandas as gpd
-from ..utils import run_cli, save_postgis
+import time
+from os import makedirs
+from urllib.parse import urljoin
+from ..crawler import CONCURRENCY, CatalogCrawler, CrawlState
+from ..pgstac_loader import StacLoader
+from ..instrument import stage
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def generate(output_dir, limit):
-    """Generate STAC Collections and Items files for Maxar Open Data."""
+CATALOG_URL = "https://maxar-opendata.s3.amazonaws.com/events/catalog.json"
 
-    # #################
-    # # Load collection into the DB
-    # #################
-    logger.info("Connecting to static catalog...")
-    makedirs(output_dir, exist_ok=True)
-    catalog = pystac.Catalog.from_file(
-        "https://maxar-opendata.s3.amazonaws.com/events/catalog.json"
-    )
 
-    collections = list(catalog.get_collections())
-    logger.info(f"Found {len(collections)} collections")
+def collection_id(event_id):
+    return "MAXAR_" + event_id.replace("-", "_")
+
+
+def normalize_collection(collection: dict) -> dict:
+    c = dict(collection)
+    c["links"] = []
+    c["id"] = collection_id(c["id"])
+    c["description"] = "Maxar OpenData | " + c["description"]
+    c["table"] = f"MAXAR_{c['id']}".replace("-", "_").lower()
+    return c
+
+
+def normalize_item(item: dict, item_url: str, collection: str) -> dict:
+    item["links"] = []
+    item["collection"] = collection
+    item["id"] = item["id"].replace("/", "_")
+    for asset in item.get("assets", {}).values():
+        asset["href"] = urljoin(item_url, asset["href"])
+    return item
+
+
+async def crawl_event(crawler, event, output_dir):
+    """Stream the normalized (new) items of one event collection to `<collection>_items.json` (NDJSON).
+
+    The file is only written when the event has new items.
+
+    Return:
+        str: Path of the items file, None if there was no new item.
+    """
+    event_id = event.body["id"] if event.body else crawler.state.get(event.url)["id"]
+    cid = collection_id(event_id)
+    file_path = f"{output_dir}/{cid}_items.json"
+    logger.info(f"Processing items for {cid}")
+    f = None
 
-    if limit:
-        collections = collections[:limit]
-    logger.info(f"Loading collections: {len(collections)}")
+    def on_item(item, item_url):
+        nonlocal f
+        if f is None:
+            f = open(file_path, "w")
+        f.write(json.dumps(normalize_item(item, item_url, cid)) + "\n")
+
+    try:
+        count = await crawler.walk_items(event.url, on_item, catalog=event)
+    finally:
+        if f is not None:
+            f.close()
+    logger.info(f"{cid}: {count} new items")
+    return file_path if count else None
+
+
+async def crawl(output_dir, limit, catalog_url, concurrency, state):
+    """Crawl the event collections of the catalog and their items concurrently.
+
+    Return:
+        list: (collection or None if it was loaded by a previous run, items file path or None) tuples.
+    """
+    async with CatalogCrawler(concurrency=concurrency, state=state) as crawler:
+        catalog = await crawler.get_catalog(catalog_url)
+        events = await crawler.children(catalog)
+        logger.info(f"Found {len(events)} collections")
+        if limit:
+            events = events[:limit]
+        logger.info(f"Loading collections: {len(events)}")
+
+        start = time.perf_counter()
+        file_paths = await asyncio.gather(
+            *[crawl_event(crawler, event, output_dir) for event in events]
+        )
+        logger.info(
+            f"Crawled {crawler.requests} documents in {time.perf_counter() - start:.1f}s "
+            f"({crawler.not_modified} not modified, {len(crawler.errors)} errors)"
+        )
+    return [
+        (normalize_collection(event.body) if event.new else None, path)
+        for event, path in zip(events, file_paths)
+    ]
+
+
+def generate(
+    output_dir,
+    limit=None,
+    catalog_url=CATALOG_URL,
+    concurrency=CONCURRENCY,
+    full=False,
+):
+    """Generate STAC Collections and Items files for Maxar Open Data.
+
+    The crawl is incremental: the state of the previous crawl
+    (`<output_dir>/.crawl_state.json`) is used to only fetch the catalogs that
+    changed and the items that are new, and only those are loaded into pgstac.
+
+    Args:
+        output_dir (str): Directory of the NDJSON item files.
+        limit (int, optional): Only load the first `limit` event collections.
+        catalog_url (str, optional): Root catalog, e.g. a local static file server for tests.
+        concurrency (int, optional): Maximum number of requests in flight. Defaults to 32
+        full (bool, optional): Ignore the previous crawl and load every item. Defaults to False
+    """
+    logger.info("Connecting to static catalog...")
+    makedirs(output_dir, exist_ok=True)
+    state = CrawlState(f"{output_dir}/.crawl_state.json", reset=full)
+    with stage("crawl", url=catalog_url):
+        collections = asyncio.run(crawl(output_dir, limit, catalog_url, concurrency, state))
 
     logger.info("Creating collections.json file...")
+    loader = StacLoader()
     stac_collection_path = f"./collections.json"
     with open(stac_collection_path, "w") as f:
-        for collection in collections:
-            c = collection.to_dict()
-            c["links"] = []
-            c["id"] = "MAXAR_" + c["id"].replace("-", "_")
-            c["description"] = "Maxar OpenData | " + c["description"]
-            c["table"] = f"MAXAR_{c['id']}".replace("-", "_").lower()
-            f.write(json.dumps(c) + "\n")
-    run_cli(
-        ["pypgstac", "load", "collections"],
-        stac_collection_path,
-        {"--method": "insert_ignore", "--dsn": environ["DATABASE_URL"]},
-    )
+        for c, _ in collections:
+            if c is not None:
+                f.write(json.dumps(c) + "\n")
+                loader.add_collection(c)
     # #################
     # Save Item stac in the DB
     # #################
-    logger.info("Creating items .json files...")
-    errors = []
-    for collection in collections:
-        collection_id = "MAXAR_" + collection.id.replace("-", "_")
-        table = collection_id.lower()
-        logger.info(f"Processing items for {collection_id}")
-        file_path = f"{output_dir}/{collection_id}_items.json"
-
-        features = []
-        with open(file_path, "w") as f:
-            # Each Collection has collections
-            try:
-                for c in collection.get_collections():
-                    try:
-                        # Loop through each items
-                        # edit items and save into a top level collection JSON file
-                        for item in c.get_all_items():
-                            item_dict = item.make_asset_hrefs_absolute().to_dict()
-                            item_dict["links"] = []
-                            item_dict["collection"] = collection_id
-                            item_dict["id"] = item.id.replace("/", "_")
-                            features.append(item_dict)
-                            item_str = json.dumps(item_dict)
-                            f.write(item_str + "\n")
-                    except Exception as e:
-                        logger.info(f"Error: {e}")
-                        errors.append(
-                            {
-                                "collection": collection_id,
-                                "child_collection": c.id,
-                                "error": e,
-                            }
-                        )
-                        continue
-            except Exception as e:
-                logger.info(f"Error: {e}")
-                errors.append(
-                    {"collection": collection_id, "child_collection": None, "error": e}
-                )
-                continue
-            else:
-                output_json = run_cli(
-                    ["pypgstac", "load", "items"],
-                    file_path,
-                    {"--method": "insert_ignore", "--dsn": environ["DATABASE_URL"]},
-                )
+    for _, file_path in collections:
+        if file_path is not None:
+            # items are flushed to pgstac in batches, together with pending collections
+            loader.add_items(file_path)
+    loader.flush()
+    # only remember what was crawled once it is in pgstac
+    state.save()
+    logger.info(f"Loaded {loader.loaded['collections']} new collection(s) and {loader.loaded['items']} new item(s)")
@@ -0,0 +1,175 @@
+"""Post-load spatial optimization of ingested tables."""
+
+import logging
+import time
+from psycopg import sql
+from .db import get_pool
+from .instrument import timed
+from .partition import PARTITIONS_QUERY
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# "hilbert" rows are sorted by the loader before the COPY (see `hilbert_sort`)
+# "geohash" rows are rewritten server side in geohash order
+# "cluster" rows are rewritten with CLUSTER on the GiST index
+CLUSTER_METHODS = ("hilbert", "geohash", "cluster", None)
+
+EXTENT_TABLE = sql.Identifier("ingest", "table_extents")
+
+
+def hilbert_sort(gdf):
+    """Return gdf ordered along a Hilbert curve, so the COPY writes spatially contiguous heap pages."""
+    if gdf.empty:
+        return gdf
+    order = gdf.geometry.hilbert_distance().argsort(kind="stable")
+    return gdf.iloc[order.to_numpy()]
+
+
+def _gist_index(conn, table, geometry_column: str) -> str:
+    """Return the name of a GiST index on geometry_column, if any."""
+    row = conn.execute(
+        """
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_am am ON am.oid = c.relam
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND am.amname = 'gist' AND a.attname = %s
+        LIMIT 1
+        """,
+        (table.as_string(conn), geometry_column),
+    ).fetchone()
+    return row[0] if row else ""
+
+
+def _record_extent(conn, table, schema: str, table_name: str, geometry_column: str) -> dict:
+    row = conn.execute(
+        sql.SQL(
+            """
+            SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e), n
+            FROM (SELECT ST_Extent({geom}) AS e, count(*) AS n FROM {table}) AS t
+            """
+        ).format(geom=sql.Identifier(geometry_column), table=table)
+    ).fetchone()
+    bbox = list(row[:4]) if row[0] is not None else None
+    conn.execute("CREATE SCHEMA IF NOT EXISTS ingest")
+    conn.execute(
+        sql.SQL(
+            """
+            CREATE TABLE IF NOT EXISTS {} (
+                schema_name text,
+                table_name text,
+                bbox double precision[],
+                row_count bigint,
+                updated_at timestamptz DEFAULT now(),
+                PRIMARY KEY (schema_name, table_name)
+            )
+            """
+        ).format(EXTENT_TABLE)
+    )
+    conn.execute(
+        sql.SQL(
+            """
+            INSERT INTO {} (schema_name, table_name, bbox, row_count)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (schema_name, table_name) DO UPDATE
+            SET bbox = EXCLUDED.bbox, row_count = EXCLUDED.row_count, updated_at = now()
+            """
+        ).format(EXTENT_TABLE),
+        (schema, table_name, bbox, row[4]),
+    )
+    return {"bbox": bbox, "rows": row[4]}
+
+
+@timed("optimize")
+def optimize_table(
+    table_name: str,
+    geometry_column: str = "geometry",
+    schema: str = "public",
+    cluster: str = None,
+    btree: list = None,
+    analyze: bool = True,
+    database_url: str = "",
+) -> dict:
+    """Finish a loaded table so bbox queries touch as few heap pages as possible.
+
+    Makes sure a GiST index exists on the geometry column, optionally reorders
+    the rows spatially, runs ANALYZE and records the table extent in
+    `ingest.table_extents`. Partitions of a partitioned table are reordered
+    (and their extents recorded) one by one.
+
+    Args:
+        table_name (str): Table to optimize.
+        geometry_column (str, optional): Geometry column. Defaults to 'geometry'
+        schema (str, optional): Schema of the table. Defaults to 'public'
+        cluster (str, optional): One of "hilbert", "geohash", "cluster" or None. Defaults to None
+        btree (list, optional): Columns to index with a btree, e.g. integer keys used in joins.
+        analyze (bool, optional): Run ANALYZE on the table. Defaults to True
+        database_url (str, optional): The URL for the database connection. Defaults to an environment variable called DATABASE_URL if not provided explicitly.
+    Return:
+        dict: Table extent as {"bbox": [xmin, ymin, xmax, ymax], "rows": n}.
+    """
+    if cluster not in CLUSTER_METHODS:
+        raise ValueError(f"'{cluster}' is not a valid cluster method, use one of {CLUSTER_METHODS}")
+
+    table = sql.Identifier(schema, table_name)
+    start = time.perf_counter()
+    with get_pool(database_url).connection() as conn:
+        partitions = [row[0] for row in conn.execute(PARTITIONS_QUERY, (table.as_string(conn),)).fetchall()]
+    if partitions and cluster in ("geohash", "cluster"):
+        # CLUSTER is run partition by partition, not all servers support it on a partitioned table
+        for partition in partitions:
+            optimize_table(
+                partition, geometry_column, schema, cluster=cluster, analyze=False, database_url=database_url
+            )
+        cluster = None
+
+    with get_pool(database_url).connection() as conn:
+        conn.autocommit = True
+        index_name = _gist_index(conn, table, geometry_column)
+        if not index_name:
+            index_name = f"{table_name[:50]}_{geometry_column[:8]}_idx"
+            logger.info(f"Creating GiST index {index_name}")
+            conn.execute(
+                sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING GIST ({})").format(
+                    sql.Identifier(index_name), table, sql.Identifier(geometry_column)
+                )
+            )
+
+        if cluster == "geohash":
+            # CLUSTER needs an index, use a temporary expression index in geohash order
+            geohash_index = f"{table_name[:50]}_geohash_tmp"
+            conn.execute(
+                sql.SQL(
+                    "CREATE INDEX {} ON {} (ST_GeoHash(ST_Transform(ST_PointOnSurface({}), 4326)))"
+                ).format(sql.Identifier(geohash_index), table, sql.Identifier(geometry_column))
+            )
+            conn.execute(
+                sql.SQL("CLUSTER {} USING {}").format(table, sql.Identifier(geohash_index))
+            )
+            conn.execute(sql.SQL("DROP INDEX {}").format(sql.Identifier(schema, geohash_index)))
+        elif cluster == "cluster":
+            conn.execute(
+                sql.SQL("CLUSTER {} USING {}").format(table, sql.Identifier(index_name))
+            )
+
+        for column in btree or []:
+            conn.execute(
+                sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} ({})").format(
+                    sql.Identifier(f"{table_name[:50]}_{column[:8]}_idx"),
+                    table,
+                    sql.Identifier(column),
+                )
+            )
+
+        if analyze:
+            conn.execute(sql.SQL("ANALYZE {}").format(table))
+
+        extent = _record_extent(conn, table, schema, table_name, geometry_column)
+
+    logger.info(
+        f"Optimized {schema}.{table_name} (cluster={cluster}, analyze={analyze}) "
+        f"in {time.perf_counter() - start:.1f}s, extent={extent['bbox']}"
+    )
+    return extent
@@ -0,0 +1,539 @@
+"""Declaratively partitioned PostGIS tables: one LIST partition per admin unit or coarse spatial cell.
+
+Rows are keyed by a partition column computed on load:
+    {"by": "h3", "level": 3}        `h3_res3` BIGINT, H3 parent cell of the feature (or of its `h3` column)
+    {"by": "quadkey", "level": 6}   `quadkey_z6` text, web mercator tile of the feature
+    {"by": "column", "column": "GID_1"}  an existing column, e.g. an admin unit id
+
+Every partition is an ordinary table (`<table>_<key>`) loaded through its own
+`BulkLoader` staging table, so partitions are loaded in parallel on separate
+pooled connections, and one partition is swapped in (DETACH old, ATTACH new)
+without touching the others. A table that is not partitioned the same way
+(e.g. a single table from before) is replaced as a whole: a new partitioned
+table is loaded under a staging name and renamed into place on finish.
+Queries get partition pruning when they filter on the partition column, e.g.
+with the keys of `partition_keys`:
+
+    SELECT * FROM buildings_hotosm_afg_osm
+    WHERE h3_res3 = ANY(%s) AND geometry && ST_MakeEnvelope(61.9, 34.5, 62.2, 34.7, 4326)
+"""
+
+import logging
+import os
+import re
+import threading
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import h3
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from h3.api import basic_int
+from psycopg import sql
+from .bulk_load import BulkLoader, _identifier, _pg_type, _short_name, _srid
+from .db import get_pool
+from .geometry import same_crs
+from .hexgrid import h3_parent, h3_resolution
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PARTITION_BY = ("h3", "quadkey", "column")
+PARTITION_WORKERS = int(os.environ.get("INGEST_PARTITION_WORKERS", 4))
+# room left in partition names for the BulkLoader suffixes (e.g. `_geometry_idx`)
+PARTITION_NAME_LENGTH = 48
+MAX_LATITUDE = 85.05112878
+
+PARTITIONS_QUERY = """
+SELECT c.relname
+FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = to_regclass(%s)
+"""
+
+PARENT_QUERY = """
+SELECT c.relkind, pg_get_partkeydef(c.oid)
+FROM pg_class c
+WHERE c.oid = to_regclass(%s)
+"""
+
+COLUMNS_QUERY = """
+SELECT a.attname, a.atttypid::regtype::text
+FROM pg_attribute a
+WHERE a.attrelid = to_regclass(%s) AND a.attnum > 0 AND NOT a.attisdropped
+"""
+
+
+def partition_column(by: str = "h3", level: int = 3, column: str = None) -> str:
+    """Name of the partition key column."""
+    if by not in PARTITION_BY:
+        raise ValueError(f"'{by}' is not a valid partition key, use one of {PARTITION_BY}")
+    if by == "column":
+        if not column:
+            raise ValueError("Partitioning by column needs a column name")
+        return column
+    if by == "quadkey" and level < 1:
+        raise ValueError("Quadkey partitions need a zoom level of 1 or more")
+    return f"{by}_res{level}" if by == "h3" else f"{by}_z{level}"
+
+
+def _points(gdf: gpd.GeoDataFrame) -> tuple:
+    """Lon, lat of a point inside every feature (NaN for missing or empty geometries)."""
+    points = gdf.geometry.representative_point()
+    if gdf.crs is not None and not same_crs(gdf.crs, 4326):
+        points = points.to_crs(4326)
+    return shapely.get_x(points.to_numpy()), shapely.get_y(points.to_numpy())
+
+
+def h3_keys(gdf: gpd.GeoDataFrame, level: int) -> pd.Series:
+    """H3 cells (int64) at level of the features, from their `h3` column when it is fine enough."""
+    if "h3" in gdf.columns and gdf["h3"].dtype == np.int64 and (h3_resolution(gdf["h3"].to_numpy()) >= level).all():
+        return pd.Series(h3_parent(gdf["h3"].to_numpy(), level), index=gdf.index, dtype="Int64")
+    x, y = _points(gdf)
+    cells = [None if np.isnan(lng) else basic_int.latlng_to_cell(lat, lng, level) for lng, lat in zip(x, y)]
+    return pd.Series(cells, index=gdf.index, dtype="Int64")
+
+
+def _tiles(x: np.ndarray, y: np.ndarray, zoom: int) -> tuple:
+    """Web mercator tile numbers of lon/lat points."""
+    n = 2**zoom
+    lat = np.radians(np.clip(y, -MAX_LATITUDE, MAX_LATITUDE))
+    tx = np.clip(np.floor((x + 180) / 360 * n), 0, n - 1).astype(np.int64)
+    ty = np.clip(np.floor((1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * n), 0, n - 1).astype(np.int64)
+    return tx, ty
+
+
+def _quadkeys(tx: np.ndarray, ty: np.ndarray, zoom: int) -> np.ndarray:
+    # one ascii digit per zoom level, 0-3 from the x and y bits
+    digits = np.empty((len(tx), zoom), dtype=np.uint8)
+    for i in range(zoom):
+        bit = zoom - 1 - i
+        digits[:, i] = ord("0") + ((tx >> bit) & 1) + 2 * ((ty >> bit) & 1)
+    return digits.view(f"S{zoom}").ravel().astype(str).astype(object)
+
+
+def quadkeys(x: np.ndarray, y: np.ndarray, zoom: int) -> np.ndarray:
+    """Quadkeys of the web mercator tiles containing the lon/lat points, None for NaN."""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    missing = np.isnan(x) | np.isnan(y)
+    keys = _quadkeys(*_tiles(np.where(missing, 0, x), np.where(missing, 0, y), zoom), zoom)
+    keys[missing] = None
+    return keys
+
+
+def add_partition_key(gdf: gpd.GeoDataFrame, by: str = "h3", level: int = 3, column: str = None) -> tuple:
+    """Add the partition column to gdf.
+
+    Return:
+        tuple: (gdf, name of the partition column)
+    """
+    key = partition_column(by, level, column)
+    if by == "column":
+        if key not in gdf.columns:
+            raise ValueError(f"Partition column '{key}' is not in the data")
+    elif by == "h3":
+        gdf = gdf.assign(**{key: h3_keys(gdf, level)})
+    else:
+        gdf = gdf.assign(**{key: quadkeys(*_points(gdf), level)})
+    return gdf, key
+
+
+def partition_keys(bounds, by: str = "h3", level: int = 3) -> list:
+    """Partition keys that may hold features intersecting bounds (EPSG:4326), for partition pruning.
+
+    Features are keyed by a point inside them, so this holds for features
+    smaller than a cell: pad bounds by the size of the largest feature otherwise.
+    """
+    minx, miny, maxx, maxy = bounds
+    if by == "h3":
+        cells = set(h3.geo_to_cells(shapely.box(minx, miny, maxx, maxy), level))
+        cells.add(h3.latlng_to_cell((miny + maxy) / 2, (minx + maxx) / 2, level))
+        # cells overlapping the edges have their center outside bounds
+        cells = set().union(*(h3.grid_disk(c, 1) for c in cells))
+        return sorted(h3.str_to_int(c) for c in cells)
+    if by == "quadkey":
+        tx, ty = _tiles(np.array([minx, maxx]), np.array([maxy, miny]), level)
+        tx, ty = np.meshgrid(np.arange(tx[0], tx[1] + 1), np.arange(ty[0], ty[1] + 1))
+        return sorted(_quadkeys(tx.ravel(), ty.ravel(), level))
+    raise ValueError(f"Keys of '{by}' partitions can't be derived from bounds")
+
+
+def partition_name(table_name: str, value) -> str:
+    """Table name of the partition of table_name holding value."""
+    if value is None:
+        slug = "null"
+    elif isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+        slug = f"{int(value):x}"
+        if h3.is_valid_cell(slug):
+            # without the unused (all ones) trailing digits of the cell
+            slug = slug.rstrip("f")
+    else:
+        slug = re.sub(r"[^a-z0-9]+", "_", str(value).lower()).strip("_")
+        if slug != str(value) or len(slug) > 24:
+            # different values can have the same slug
+            slug = f"{slug[:15]}_{zlib.crc32(str(value).encode()):08x}"
+    return f"{table_name[: PARTITION_NAME_LENGTH - len(slug) - 1]}_{slug}"
+
+
+class PartitionLoader(BulkLoader):
+    """BulkLoader of one partition: the staging table replaces the partition of value and is attached to parent.
+
+    A CHECK constraint matching the partition bound is added before the swap,
+    so ATTACH does not scan the table while holding its lock.
+
+    With deferred, parent is a new (staging) parent table: the staging table is
+    attached to it as it is, and renamed by `rename` when the parent replaces
+    the table.
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        parent: str,
+        key: str,
+        value,
+        lock: threading.Lock = None,
+        deferred: bool = False,
+        **kwargs,
+    ):
+        super().__init__(table_name, if_exists="replace", **kwargs)
+        self.parent = parent
+        self.key = key
+        self.value = value
+        self.lock = lock or threading.Lock()
+        self.deferred = deferred
+        self.indexes = []
+        self.check_name = _short_name(self.staging_name, "_key_check")
+
+    def _bound(self):
+        return sql.SQL("NULL") if self.value is None else sql.Literal(self.value)
+
+    def _build_indexes(self, conn, create_pk: bool) -> list:
+        indexes = super()._build_indexes(conn, create_pk)
+        key = sql.Identifier(self.key)
+        condition = (
+            sql.SQL("{} IS NULL").format(key)
+            if self.value is None
+            else sql.SQL("{} IS NOT NULL AND {} = {}").format(key, key, self._bound())
+        )
+        conn.execute(
+            sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} CHECK ({})").format(
+                _identifier(self.schema, self.staging_name), sql.Identifier(self.check_name), condition
+            )
+        )
+        return indexes
+
+    def _swap(self, conn, indexes: list):
+        parent = _identifier(self.schema, self.parent)
+        target = _identifier(self.schema, self.table_name)
+        if self.deferred:
+            staging = _identifier(self.schema, self.staging_name)
+            self.indexes = indexes
+            with self.lock:
+                conn.execute(
+                    sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES IN ({})").format(
+                        parent, staging, self._bound()
+                    )
+                )
+                conn.execute(
+                    sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(staging, sql.Identifier(self.check_name))
+                )
+            return
+        # swaps of partitions of the same parent are serialized, they lock the parent
+        with self.lock:
+            attached = conn.execute(
+                "SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s))",
+                (target.as_string(conn),),
+            ).fetchone()[0]
+            if attached:
+                conn.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(parent, target))
+            super()._swap(conn, indexes)
+            conn.execute(
+                sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES IN ({})").format(
+                    parent, target, self._bound()
+                )
+            )
+            conn.execute(
+                sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(target, sql.Identifier(self.check_name))
+            )
+
+    def rename(self, conn):
+        """Give the attached staging table (deferred) and its indexes their final names."""
+        conn.execute(
+            sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                _identifier(self.schema, self.staging_name), sql.Identifier(self.table_name)
+            )
+        )
+        for name, final_name in self.indexes:
+            conn.execute(
+                sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                    _identifier(self.schema, name), sql.Identifier(final_name)
+                )
+            )
+
+
+class PartitionedLoader:
+    """Stream GeoDataFrames into a table partitioned by LIST on a partition key.
+
+    Rows are split by key and COPYed into one `PartitionLoader` per key, in
+    parallel. On finish every loaded partition replaces its previous version;
+    with prune, the partitions that received no rows are dropped (full reload),
+    otherwise they are left as they are (reload of some regions).
+
+    When the table does not exist, or is not partitioned by key with the same
+    columns, the partitions are attached to a new parent with a staging name,
+    which replaces the table in one transaction on finish: readers see the old
+    table until then. The old table is dropped without CASCADE, so a load over a
+    table with dependent views fails instead of silently dropping them.
+
+    Usage:
+        with PartitionedLoader("buildings_hotosm_afg_osm", {"by": "h3", "level": 3}) as loader:
+            loader.write(gdf)
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        partition: dict,
+        database_url: str = "",
+        if_exists: str = "replace",
+        schema: str = "public",
+        table_id: str = "id",
+        workers: int = PARTITION_WORKERS,
+    ):
+        if if_exists not in ("fail", "replace"):
+            raise ValueError(f"'{if_exists}' is not valid for if_exists of a partitioned table")
+        self.table_name = table_name
+        self.by = partition.get("by", "h3")
+        self.level = partition.get("level", 3)
+        self.column = partition.get("column")
+        self.prune = partition.get("prune", True)
+        self.key = partition_column(self.by, self.level, self.column)
+        self.database_url = database_url
+        self.if_exists = if_exists
+        self.schema = schema
+        self.table_id = table_id
+        self.pool = get_pool(database_url)
+        self.workers = max(1, min(partition.get("workers", workers), self.pool.max_size))
+        self.columns = None
+        self.geometry_column = None
+        self.srid = 0
+        self.loaders = {}
+        self.rows = 0
+        self._lock = threading.Lock()
+        # parent the partitions are attached to, a staging parent when the table is replaced
+        self.parent = table_name
+        self.token = uuid.uuid4().hex[:8]
+        self.staging_parent = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abort()
+        return False
+
+    def _parent_columns(self, conn) -> dict:
+        """Columns of the existing parent table, or None if it has to be created (or replaced)."""
+        parent = _identifier(self.schema, self.table_name).as_string(conn)
+        row = conn.execute(PARENT_QUERY, (parent,)).fetchone()
+        if row is None:
+            return None
+        if self.if_exists == "fail":
+            raise ValueError(f"Table '{self.table_name}' already exists.")
+        columns = dict(conn.execute(COLUMNS_QUERY, (parent,)).fetchall())
+        partitioned = row[0] == "p" and row[1].replace('"', "") == f"LIST ({self.key})"
+        if partitioned and set(columns) == set(self.columns):
+            return columns
+        if not self.prune:
+            raise ValueError(
+                f"{self.table_name} is not partitioned by {self.key} with these columns, "
+                "it can only be replaced by a full load (prune=True)"
+            )
+        logger.warning(f"{self.table_name} will be replaced by a table partitioned by {self.key}")
+        return None
+
+    def _create_parent(self, gdf: gpd.GeoDataFrame):
+        self.geometry_column = gdf.geometry.name
+        self.srid = _srid(gdf, self.table_name)
+        self.columns = {col: _pg_type(gdf[col]) for col in gdf.columns}
+        with self.pool.connection() as conn:
+            existing = self._parent_columns(conn)
+            if existing:
+                # partitions must match the parent exactly, whatever this load infers
+                self.columns = existing
+                return
+            self.parent = _short_name(self.table_name, f"_staging_{self.token}")
+            self.staging_parent = True
+            parent = _identifier(self.schema, self.parent)
+            conn.execute(
+                sql.SQL("CREATE TABLE {} ({}) PARTITION BY LIST ({})").format(
+                    parent,
+                    sql.SQL(", ").join(
+                        sql.SQL("{} {}").format(
+                            sql.Identifier(col),
+                            sql.SQL(f"geometry(Geometry, {self.srid or 0})" if t == "geometry" else t),
+                        )
+                        for col, t in self.columns.items()
+                    ),
+                    sql.Identifier(self.key),
+                ),
+            )
+            # partitioned index, the GiST index of every partition is attached to it
+            conn.execute(
+                sql.SQL("CREATE INDEX {} ON {} USING GIST ({})").format(
+                    sql.Identifier(self._parent_index(staging=True)),
+                    parent,
+                    sql.Identifier(self.geometry_column),
+                )
+            )
+        logger.info(f"Created {self.schema}.{self.parent} partitioned by {self.key}")
+
+    def _parent_index(self, staging: bool = False) -> str:
+        suffix = f"_{self.geometry_column}_idx"
+        return _short_name(self.table_name, f"_{self.token}{suffix}" if staging else suffix)
+
+    def _loader(self, value) -> PartitionLoader:
+        if value not in self.loaders:
+            self.loaders[value] = PartitionLoader(
+                partition_name(self.table_name, value),
+                self.parent,
+                self.key,
+                value,
+                lock=self._lock,
+                deferred=self.staging_parent,
+                database_url=self.database_url,
+                schema=self.schema,
+                table_id=self.table_id,
+                workers=1,
+                column_types=self.columns,
+                geometry_type="Geometry",
+            )
+        return self.loaders[value]
+
+    def write(self, gdf: gpd.GeoDataFrame) -> int:
+        """Add the partition key to gdf and COPY its rows into their partitions.
+
+        Return:
+            int: Number of rows written.
+        """
+        gdf, _ = add_partition_key(gdf, self.by, self.level, self.column)
+        if self.columns is None:
+            self._create_parent(gdf)
+        parts = [
+            (self._loader(None if pd.isna(value) else value.item() if hasattr(value, "item") else value), part)
+            for value, part in gdf.groupby(self.key, dropna=False, sort=False)
+        ]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            count = sum(executor.map(lambda lp: lp[0].write(lp[1]), parts))
+        self.rows += count
+        return count
+
+    def partitions(self) -> list:
+        """Names of the partitions attached to the table."""
+        with self.pool.connection() as conn:
+            parent = _identifier(self.schema, self.table_name).as_string(conn)
+            return [row[0] for row in conn.execute(PARTITIONS_QUERY, (parent,)).fetchall()]
+
+    def _replace(self):
+        """Replace the table by the staging parent and its partitions, in one transaction."""
+        target = _identifier(self.schema, self.table_name)
+        with self.pool.connection() as conn:
+            with conn.transaction():
+                conn.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (target.as_string(conn),))
+                # no CASCADE: dependent views make the load fail rather than disappear
+                conn.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(target))
+                conn.execute(
+                    sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                        _identifier(self.schema, self.parent), sql.Identifier(self.table_name)
+                    )
+                )
+                conn.execute(
+                    sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                        _identifier(self.schema, self._parent_index(staging=True)),
+                        sql.Identifier(self._parent_index()),
+                    )
+                )
+                for loader in self.loaders.values():
+                    loader.rename(conn)
+
+    def finish(self):
+        """Index the loaded partitions and swap them in, then drop the stale ones if prune."""
+        if self.columns is None:
+            logger.info(f"No rows to load into {self.table_name}")
+            return
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(lambda loader: loader.finish(), self.loaders.values()))
+            if self.staging_parent:
+                self._replace()
+        except Exception:
+            if self.staging_parent:
+                self.abort()
+            raise
+        if self.prune and not self.staging_parent:
+            loaded = {loader.table_name for loader in self.loaders.values()}
+            for name in set(self.partitions()) - loaded:
+                drop_partition(self.table_name, name, schema=self.schema, database_url=self.database_url)
+        logger.info(f"Table {self.schema}.{self.table_name} ready ({self.rows} rows, {len(self.loaders)} partitions)")
+
+    def abort(self):
+        """Drop the staging tables (and staging parent), leaving the table and its partitions untouched."""
+        for loader in self.loaders.values():
+            loader.abort()
+        if self.staging_parent:
+            with self.pool.connection() as conn:
+                conn.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(_identifier(self.schema, self.parent)))
+
+
+def drop_partition(table_name: str, partition: str, schema: str = "public", database_url: str = ""):
+    """Detach partition from table_name and drop it."""
+    parent = _identifier(schema, table_name)
+    target = _identifier(schema, partition)
+    with get_pool(database_url).connection() as conn:
+        with conn.transaction():
+            conn.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(parent, target))
+            conn.execute(sql.SQL("DROP TABLE {}").format(target))
+    logger.info(f"Dropped partition {schema}.{partition}")
+
+
+def copy_postgis_partitioned(
+    gdf: gpd.GeoDataFrame,
+    table_name: str,
+    partition: dict,
+    database_url: str = "",
+    if_exists: str = "replace",
+    index: bool = True,
+    schema: str = "public",
+    table_id: str = "id",
+) -> int:
+    """Load a GeoDataFrame into a partitioned table with binary COPY, see `copy_postgis`.
+
+    Args:
+        gdf (object): A GeoDataFrame object.
+        table_name (str): The name of the partitioned table.
+        partition (dict): {"by": "h3" | "quadkey" | "column", "level": int, "column": str, "prune": bool, "workers": int}
+        database_url (str, optional): The URL for the database connection. Defaults to an environment variable called DATABASE_URL if not provided explicitly.
+        if_exists (str, optional): "fail" or "replace". Defaults to 'replace'.
+        index (bool, optional): Save the index of the dataframe as an `index` column, like `to_postgis`.
+        schema (str, optional): Used to Specify the schema of the table. Defaults to 'public'
+        table_id (str, optional): Primary key column of every partition. Defaults to 'id'
+    Return:
+        int: Number of rows loaded.
+    """
+    if index:
+        gdf = gdf.reset_index(names=gdf.index.name or "index")
+    with PartitionedLoader(
+        table_name,
+        partition,
+        database_url=database_url,
+        if_exists=if_exists,
+        schema=schema,
+        table_id=table_id,
+    ) as loader:
+        loader.write(gdf)
+    return loader.rows
@@ -0,0 +1,136 @@
+"""Load STAC collections and items into pgstac from a shared connection pool."""
+
+import json
+import logging
+import time
+from pypgstac.db import PgstacDB
+from pypgstac.load import Loader, Methods
+from .db import get_pool
+from .instrument import stage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+ITEM_PROPERTY_QUERY = """
+SELECT id, content->'properties'->>%s FROM pgstac.items WHERE collection = %s AND id = ANY(%s)
+"""
+
+
+def _unwrap(data):
+    if isinstance(data, list):
+        return data
+    if data.get("type") == "FeatureCollection":
+        return data["features"]
+    return [data]
+
+
+def read_json(path: str):
+    """Yield STAC objects from a JSON file, a FeatureCollection, or a NDJSON file.
+
+    NDJSON files are read line by line, never fully loaded in memory.
+    """
+    with open(path) as f:
+        first_line = f.readline()
+        try:
+            data = json.loads(first_line)
+        except json.JSONDecodeError:
+            # pretty printed JSON document
+            f.seek(0)
+            yield from _unwrap(json.load(f))
+            return
+        yield from _unwrap(data)
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class StacLoader:
+    """Queue STAC collections and items and load them in batches with pypgstac's `Loader`.
+
+    Every flush uses one pooled connection and one transaction: pending
+    collections are upserted first, then the queued items, so items never
+    reference a collection that is not committed with them.
+
+    Usage:
+        with StacLoader() as loader:
+            loader.add_collections("datasets/population/collection.json")
+            loader.add_item(item)
+    """
+
+    def __init__(
+        self,
+        database_url: str = "",
+        method: str = "insert_ignore",
+        batch_size: int = BATCH_SIZE,
+    ):
+        self.pool = get_pool(database_url)
+        self.method = Methods[method]
+        self.batch_size = batch_size
+        self.collections = []
+        self.items = []
+        self.loaded = {"collections": 0, "items": 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        return False
+
+    def add_collection(self, collection: dict):
+        self.collections.append(collection)
+
+    def add_collections(self, path: str):
+        """Queue every collection of a JSON/NDJSON file."""
+        for collection in read_json(path):
+            self.add_collection(collection)
+
+    def add_item(self, item: dict):
+        self.items.append(item)
+        if len(self.items) >= self.batch_size:
+            self.flush()
+
+    def add_items(self, items):
+        """Queue items from an iterable of dicts or from a JSON/NDJSON file path."""
+        if isinstance(items, str):
+            items = read_json(items)
+        for item in items:
+            self.add_item(item)
+
+    def flush(self):
+        """Load queued collections and items in a single transaction."""
+        if not self.collections and not self.items:
+            return
+        collections, self.collections = self.collections, []
+        items, self.items = self.items, []
+
+        start = time.perf_counter()
+        with stage("pgstac_load") as span, self.pool.connection() as conn:
+            conn.execute("SET search_path TO pgstac, public")
+            with conn.transaction():
+                loader = Loader(db=PgstacDB(connection=conn))
+                if collections:
+                    loader.load_collections(iter(collections), insert_mode=self.method)
+                if items:
+                    loader.load_items(iter(items), insert_mode=self.method)
+            span.add(rows=len(collections) + len(items))
+        elapsed = time.perf_counter() - start
+
+        self.loaded["collections"] += len(collections)
+        self.loaded["items"] += len(items)
+        logger.info(
+            f"pgstac batch: {len(collections)} collection(s), {len(items)} item(s) "
+            f"in {elapsed:.2f}s ({len(items) / max(elapsed, 1e-6):.0f} items/s)"
+        )
+
+
+def item_properties(collection: str, item_ids: list, name: str, database_url: str = "") -> dict:
+    """Property name of the items of collection already loaded into pgstac.
+
+    Return:
+        dict: item id -> property value (as text), the items that are not loaded are left out.
+    """
+    with get_pool(database_url).connection() as conn:
+        return dict(conn.execute(ITEM_PROPERTY_QUERY, (name, collection, list(item_ids))).fetchall())
@@ -1,13 +1,21 @@
-from os import makedirs, environ
+from os import makedirs, path, remove
+from contextlib import contextmanager
 import geopandas as gpd
 import logging
-import requests
 import re
-from tqdm import tqdm
-import gzip
-import shutil
 import json
-from ..utils import run_cli, save_postgis
+from ..utils import exist_table, save_postgis, save_postgis_chunks
+from ..manifest import Manifest
+from ..archive import decompressed, vsi_path
+from ..download import download, get_session
+from ..readers import read_chunks
+from ..hexgrid import add_h3_columns
+from ..pgstac_loader import StacLoader
+from ..stac import create_stac_item
+from ..artifacts import media_type, write_artifact_async
+from ..tiles import tiles_stage
+from ..instrument import stage
+from ..geometry import prepare_geometries
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,89 +29,145 @@ TITLE = "Afghanistan, Population Density for 400m H3 Hexagons"
 DESCRIPTION = "Built from Kontur Population, Global Population Density for 400m H3 Hexagons Vector H3 hexagons with population counts at 400m resolution"
 LICENSE = "Creative Commons Attribution International"
 DATETIME = "2022-06-30"
+DOWNLOAD_PARALLEL = 4
 
 
 def get_link():
-    r = requests.get(PAGE_LINK)
+    r = get_session().get(PAGE_LINK)
     all_links = re.findall(REGEX_URL, r.text)
     filter_links = [i for i in all_links if ".gpkg.gz" in i]
     return filter_links[-1]
 
 
-def download_data(link, file_tmp_path):
-    file_gpkg = file_tmp_path[:-3]
-    block_size = 1024
-    response = requests.get(link, stream=True)
+def download_data(link, file_tmp_path, manifest=None):
+    """Download link, unless it did not change since the download recorded in manifest.
 
-    total_size_in_bytes = int(response.headers.get("content-length", 0))
-    # create folter
-    with open(file_tmp_path, "wb") as file, tqdm(
-        desc=file_tmp_path,
-        total=total_size_in_bytes,
-        unit="iB",
-        unit_scale=True,
-        unit_divisor=1024,
-    ) as bar:
-        for data in response.iter_content(block_size):
-            bar.update(len(data))
-            file.write(data)
+    The archive is kept compressed, see `open_gpkg`.
 
-    with gzip.open(file_tmp_path, "rb") as f_in:
-        with open(file_gpkg, "wb") as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    return file_gpkg
+    Return:
+        tuple: (path of the .gpkg.gz archive, manifest entry to record once loaded or None if unchanged)
+    """
+    entry = download(link, file_tmp_path, manifest=manifest, parallel=DOWNLOAD_PARALLEL)
+    # remove the uncompressed copy left by older versions of this module
+    if path.exists(file_tmp_path[:-3]):
+        remove(file_tmp_path[:-3])
+    return file_tmp_path, entry
 
 
-def run(path_local):
+@contextmanager
+def open_gpkg(file_gz, read_in_place=False):
+    """Yield a GDAL readable path for the compressed GeoPackage.
+
+    Read through /vsigzip/ (decompression overlaps with parsing) or, as SQLite
+    seeks backwards a lot, from a temporary uncompressed copy removed on exit.
+    """
+    if read_in_place:
+        yield vsi_path(file_gz)
+    else:
+        with decompressed(file_gz) as file_gpkg:
+            yield file_gpkg
+
+
+def run(
+    path_local,
+    optimize: dict = None,
+    artifact_format: str = "geoparquet",
+    memory_budget_mb: int = None,
+    force: bool = False,
+    read_in_place: bool = False,
+    h3_parents: list = (),
+    tiles: dict = None,
+    partition: dict = None,
+):
     #################
     # Load collection into the DB
     #################
     logger.info("\n\nLoad collection into the DB..")
     stac_collection_path = f"datasets/population/collection.json"
-    output_json = run_cli(
-        ["pypgstac", "load", "collections"],
-        stac_collection_path,
-        {"--method": "insert_ignore", "--dsn": environ["DATABASE_URL"]},
-    )
+    loader = StacLoader()
+    loader.add_collections(stac_collection_path)
     # #################
     # Read and Save geo data in the DB
     # #################
     logger.info("\n\nRead and Save geo data in the DB...")
-    link = get_link()
+    with stage("discover_link"):
+        link = get_link()
     makedirs(path_local, exist_ok=True)
     file_name = link.split("/")[-1]
-    file_gpkg = download_data(link, f"{path_local}/{file_name}")
-    gdf = gpd.read_file(file_gpkg)
-    gdf = gdf.to_crs(4326)
-    gdf["id"] = gdf.index
-    file_path = f"{path_local}/{ITEM}.geojson"
-    gdf.to_file(file_path, driver="GeoJSON")
-    save_postgis(
-        gdf=gdf,
-        table_name=ITEM,
-        if_exists="replace",
-        index=False,
-        schema="public",
-        table_id="id",
-    )
+    manifest = Manifest()
+    file_gz, entry = download_data(link, f"{path_local}/{file_name}", manifest)
+    if entry is None and not force and exist_table(ITEM):
+        logger.info(f"{ITEM} is up to date, skipping")
+        # the collection may still have changed
+        loader.flush()
+        return
+    with open_gpkg(file_gz, read_in_place) as file_gpkg:
+        if memory_budget_mb:
+            # stream the source in chunks, peak memory stays within the budget
+            # H3 cells are stored as BIGINT, with their parents, for integer joins
+            chunks = (
+                add_h3_columns(chunk, "h3", h3_parents)
+                for chunk in read_chunks(file_gpkg, memory_budget_mb=memory_budget_mb)
+            )
+            loaded = save_postgis_chunks(
+                chunks,
+                table_name=ITEM,
+                path_base=f"{path_local}/{ITEM}",
+                artifact_format=artifact_format,
+                if_exists="replace",
+                schema="public",
+                table_id="id",
+                optimize=optimize,
+                partition=partition,
+            )
+            gdf = None
+        else:
+            with stage("read") as span:
+                gdf = gpd.read_file(file_gpkg)
+                span.add(rows=len(gdf))
+            gdf = prepare_geometries(gdf, 4326)
+            gdf["id"] = gdf.index
+            gdf = add_h3_columns(gdf, "h3", h3_parents)
+            # the artifact is written while the data is loaded into the DB
+            artifact = write_artifact_async(gdf, f"{path_local}/{ITEM}", artifact_format)
+            save_postgis(
+                gdf=gdf,
+                table_name=ITEM,
+                if_exists="replace",
+                index=False,
+                schema="public",
+                table_id="id",
+                optimize=optimize,
+                partition=partition,
+            )
+            loaded = {"artifact": artifact.result(), "bounds": None, "crs": None}
 
     # #################
     # Save Item stac in the DB
     # #################
+    file_path = loaded["artifact"]
+    extra_assets = {"source": {"href": link, "roles": ["source"]}}
+    if tiles:
+        # vector tile pyramid for map clients, see `tiles.build_pmtiles`
+        extra_assets.update(tiles_stage(gdf, ITEM, f"{path_local}/{ITEM}", ITEM, **tiles))
     logger.info("\n\nSave Item stac in the DB...")
-    args = {
-        "--id": ITEM,
-        "--datetime": DATETIME,
-        "--collection": COLLECTION,
-        "--asset-href": link,
-    }
-
-    output_json = run_cli(["fio", "stac"], file_path, args)
-    output_json["output"]["title"] = TITLE
-    output_json["output"]["description"] = DESCRIPTION
-    output_json["output"]["license"] = LICENSE
-    output_json["output"]["table"] = ITEM
-    output_json["output"]["links"] = [
+    stac_item = create_stac_item(
+        gdf,
+        bounds=loaded["bounds"],
+        crs=loaded["crs"],
+        item_id=ITEM,
+        collection=COLLECTION,
+        datetime=DATETIME,
+        asset_href=file_path,
+        asset_media_type=media_type(artifact_format),
+        asset_roles=["data"],
+        extra_assets=extra_assets,
+    )
+    stac_item["title"] = TITLE
+    stac_item["description"] = DESCRIPTION
+    stac_item["license"] = LICENSE
+    stac_item["table"] = ITEM
+    stac_item["links"] = [
         {
             "href": link,
             "rel": link,
@@ -112,9 +176,8 @@ def run(path_local):
     ]
     stac_item_path = f"{file_path}_.json"
     with open(stac_item_path, "w") as file:
-        file.write(json.dumps(output_json["output"]))
-    output_json = run_cli(
-        ["pypgstac", "load", "items"],
-        stac_item_path,
-        {"--method": "insert_ignore", "--dsn": environ["DATABASE_URL"]},
-    )
+        file.write(json.dumps(stac_item))
+    loader.add_item(stac_item)
+    loader.flush()
+    if entry:
+        manifest.record(link, entry)
@@ -0,0 +1,155 @@
+"""Stack gridded sources into multi-band Cloud-Optimized GeoTIFFs, for the eoAPI raster service."""
+
+import logging
+import os
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as rio_copy, copyfiles
+from .instrument import stage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPE = "image/tiff; application=geotiff; profile=cloud-optimized"
+RASTER_EXTENSION = "https://stac-extensions.github.io/raster/v1.1.0/schema.json"
+NODATA = -9999.0
+# where COGs are published for the raster service: a directory it mounts too, or
+# an object store prefix (s3://bucket/prefix, gs://bucket/prefix), written through GDAL
+RASTER_STORE = os.environ.get("INGEST_RASTER_STORE", "")
+# RASTER_STORE as the raster service reads it (e.g. https://storage.googleapis.com/bucket/prefix)
+RASTER_BASE_HREF = os.environ.get("INGEST_RASTER_BASE_HREF", "")
+VSI_PREFIXES = {"s3://": "/vsis3/", "gs://": "/vsigs/", "az://": "/vsiaz/"}
+# creation options of the GDAL COG driver
+COG_OPTIONS = {
+    "BLOCKSIZE": 256,
+    "COMPRESS": "DEFLATE",
+    "PREDICTOR": "YES",
+    "OVERVIEWS": "AUTO",
+    "OVERVIEW_RESAMPLING": "AVERAGE",
+    "BIGTIFF": "IF_SAFER",
+    "NUM_THREADS": "ALL_CPUS",
+}
+
+
+def _statistics(data: np.ndarray) -> dict:
+    valid = data[np.isfinite(data) & (data != NODATA)]
+    if not valid.size:
+        return {}
+    return {
+        "minimum": float(valid.min()),
+        "maximum": float(valid.max()),
+        "mean": float(valid.mean()),
+        "stddev": float(valid.std()),
+        "valid_percent": round(100 * valid.size / data.size, 2),
+    }
+
+
+def write_cog(sources: dict, path: str, crs=4326) -> dict:
+    """Write single band rasters as the bands of one tiled, compressed COG with overviews.
+
+    Args:
+        sources (dict): Band name -> GDAL readable path (e.g. a `/vsizip/` member). All on the same grid.
+        path (str): Output .tif path.
+        crs (optional): CRS of sources that do not declare one (e.g. ESRI .flt grids). Defaults to EPSG:4326
+    Return:
+        dict: {"path", "bounds", "crs", "shape", "transform", "bands": STAC `raster:bands`}
+    """
+    bands, names = [], list(sources)
+    profile = None
+    with stage("write_artifact", format="cog") as span:
+        for name in names:
+            with rasterio.open(sources[name]) as src:
+                if profile is None:
+                    profile = {
+                        "crs": src.crs or CRS.from_user_input(crs),
+                        "transform": src.transform,
+                        "width": src.width,
+                        "height": src.height,
+                    }
+                elif (src.width, src.height, src.transform) != (
+                    profile["width"],
+                    profile["height"],
+                    profile["transform"],
+                ):
+                    raise ValueError(f"{sources[name]} is not on the grid of {sources[names[0]]}")
+                data = src.read(1, masked=True).astype(np.float32).filled(NODATA)
+            bands.append(data)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with MemoryFile() as memfile:
+            with memfile.open(
+                driver="GTiff", count=len(bands), dtype="float32", nodata=NODATA, **profile
+            ) as dst:
+                for i, (name, data) in enumerate(zip(names, bands), start=1):
+                    dst.write(data, i)
+                    dst.set_band_description(i, name)
+            # the COG driver only creates copies: tiles, overviews and the IFD layout in one pass
+            rio_copy(memfile.name, path, driver="COG", **COG_OPTIONS)
+        span.add(rows=len(bands), bytes=os.path.getsize(path))
+
+    with rasterio.open(path) as cog:
+        bounds = tuple(cog.bounds)
+        crs = cog.crs
+    logger.info(f"Wrote {path}: {len(bands)} band(s) of {profile['width']}x{profile['height']}")
+    return {
+        "path": path,
+        "bounds": bounds,
+        "crs": crs.to_epsg() or crs.to_wkt(),
+        "shape": [profile["height"], profile["width"]],
+        "transform": list(profile["transform"])[:6],
+        "bands": [
+            {"name": name, "nodata": NODATA, "data_type": "float32", "statistics": _statistics(data)}
+            for name, data in zip(names, bands)
+        ],
+    }
+
+
+def _gdal_path(url: str) -> str:
+    for scheme, prefix in VSI_PREFIXES.items():
+        if url.startswith(scheme):
+            return prefix + url[len(scheme) :]
+    return url
+
+
+def publish_cog(cog: dict, name: str, store: str = None, base_href: str = None) -> dict:
+    """Copy a COG written by `write_cog` to the store the raster service reads from.
+
+    Args:
+        cog (dict): Output of `write_cog`.
+        name (str): File name in the store, e.g. `<item id>.tif`.
+        store (str, optional): Directory or object store prefix. Defaults to INGEST_RASTER_STORE
+        base_href (str, optional): Href of store for the raster service. Defaults to INGEST_RASTER_BASE_HREF, or store
+    Return:
+        dict: cog, with the "href" of the published copy.
+    """
+    store = (RASTER_STORE if store is None else store).rstrip("/")
+    base_href = ((RASTER_BASE_HREF if base_href is None else base_href) or store).rstrip("/")
+    if not store:
+        logger.warning(f"INGEST_RASTER_STORE is not set, {cog['path']} can only be read from this host")
+        return {**cog, "href": cog["path"]}
+    target = f"{store}/{name}"
+    destination = _gdal_path(target)
+    with stage("write_artifact", format="cog", destination=store) as span:
+        if destination == target:
+            # a directory, e.g. a volume shared with the raster service
+            os.makedirs(store, exist_ok=True)
+        # byte copy, the COG layout is kept
+        copyfiles(cog["path"], destination)
+        span.add(bytes=os.path.getsize(cog["path"]))
+    logger.info(f"Published {cog['path']} to {target}")
+    return {**cog, "href": f"{base_href}/{name}"}
+
+
+def cog_asset(cog: dict, title: str = None) -> dict:
+    """STAC asset of a COG written by `write_cog`, at its published href if any (see `publish_cog`)."""
+    asset = {
+        "href": cog.get("href", cog["path"]),
+        "type": MEDIA_TYPE,
+        "roles": ["data"],
+        "raster:bands": cog["bands"],
+    }
+    if title:
+        asset["title"] = title
+    return asset
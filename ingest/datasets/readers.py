@@ -0,0 +1,148 @@
+"""Chunked, bounded-memory readers for large vector sources."""
+
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import geopandas as gpd
+import pyogrio
+import shapely
+from pyogrio.raw import open_arrow
+from .geometry import prepare_geometries
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_BUDGET_MB = 512
+# A chunk is held several times while in flight: arrow batch, pandas frame,
+# shapely geometries, reprojected copy and the rows of the COPY.
+CHUNK_OVERHEAD = 6
+SAMPLE_SIZE = 1000
+MIN_BATCH_SIZE = 1000
+# pandas dtypes of the arrow types of a source: with nullable integers and booleans
+# a column has the same dtype (and staging table type) in every chunk, whether or
+# not it has nulls, instead of e.g. int64 in a chunk and float64 in the next one
+ARROW_DTYPES = {
+    pa.int8(): pd.Int8Dtype(),
+    pa.int16(): pd.Int16Dtype(),
+    pa.int32(): pd.Int32Dtype(),
+    pa.int64(): pd.Int64Dtype(),
+    pa.uint8(): pd.UInt8Dtype(),
+    pa.uint16(): pd.UInt16Dtype(),
+    pa.uint32(): pd.UInt32Dtype(),
+    pa.uint64(): pd.UInt64Dtype(),
+    pa.bool_(): pd.BooleanDtype(),
+}
+
+
+def estimate_batch_size(path: str, memory_budget_mb: int, layer=None) -> int:
+    """Estimate how many records fit in memory_budget_mb from a sample of the source."""
+    sample = pyogrio.read_dataframe(path, layer=layer, max_features=SAMPLE_SIZE)
+    if sample.empty:
+        return MIN_BATCH_SIZE
+    row_bytes = sample.drop(columns=sample.geometry.name).memory_usage(deep=True).sum()
+    row_bytes += sample.geometry.to_wkb().map(len).sum()
+    row_bytes = row_bytes / len(sample)
+    batch_size = int(memory_budget_mb * 1024**2 / (row_bytes * CHUNK_OVERHEAD))
+    return max(MIN_BATCH_SIZE, batch_size)
+
+
+def _to_pandas(batch: pa.RecordBatch) -> pd.DataFrame:
+    """DataFrame of a batch, with dtypes given by the arrow schema of the source (see ARROW_DTYPES)."""
+    return batch.to_pandas(types_mapper=ARROW_DTYPES.get)
+
+
+def _to_geodataframe(batch: pa.RecordBatch, geometry_name: str, crs) -> gpd.GeoDataFrame:
+    df = _to_pandas(batch)
+    geometry = gpd.GeoSeries.from_wkb(df.pop(geometry_name).to_numpy(), crs=crs)
+    return gpd.GeoDataFrame(df, geometry=geometry.values, crs=crs)
+
+
+def read_chunks(
+    path: str,
+    memory_budget_mb: int = DEFAULT_MEMORY_BUDGET_MB,
+    layer=None,
+    crs=4326,
+    id_column: str = "id",
+    columns: list = None,
+    prepare: dict = None,
+):
+    """Read a vector source as a stream of GeoDataFrames.
+
+    Record batches are read through pyogrio/Arrow, sized so that a chunk in flight
+    stays within memory_budget_mb, whatever the size of the source.
+
+    Args:
+        path (str): Path of the source (any GDAL readable path).
+        memory_budget_mb (int, optional): Memory budget for a chunk in flight. Defaults to 512
+        layer (optional): Layer name or index.
+        crs (optional): Output CRS, chunks are reprojected when needed. Defaults to EPSG:4326
+        id_column (str, optional): Column filled with ids from a running offset. Defaults to 'id'
+        columns (list, optional): Subset of columns to read.
+        prepare (dict, optional): Other arguments of `geometry.prepare_geometries`, e.g. {"make_valid": True}
+    Return:
+        Generator of GeoDataFrames.
+    """
+    batch_size = estimate_batch_size(path, memory_budget_mb, layer=layer)
+    logger.info(f"Reading {path} in chunks of {batch_size} records (budget {memory_budget_mb} MB)")
+    offset = 0
+    with open_arrow(path, layer=layer, columns=columns, batch_size=batch_size, use_pyarrow=True) as (meta, reader):
+        geometry_name = meta.get("geometry_name") or "wkb_geometry"
+        for batch in reader:
+            gdf = _to_geodataframe(batch, geometry_name, meta["crs"])
+            if gdf.crs is not None:
+                gdf = prepare_geometries(gdf, crs, **(prepare or {}))
+            if id_column:
+                gdf[id_column] = np.arange(offset, offset + len(gdf))
+            offset += len(gdf)
+            yield gdf
+    logger.info(f"Read {offset} records from {path}")
+
+
+def read_csv_chunks(
+    path: str,
+    memory_budget_mb: int = DEFAULT_MEMORY_BUDGET_MB,
+    geometry_column: str = "geometry",
+    column_types: dict = None,
+    crs=4326,
+    id_column: str = "id",
+    prepare: dict = None,
+):
+    """Read a CSV file with a WKT geometry column as a stream of GeoDataFrames.
+
+    The CSV is parsed by pyarrow in blocks sized from memory_budget_mb and the
+    geometries of a block are decoded at once with `shapely.from_wkt`.
+
+    Args:
+        path (str): Path of the CSV file.
+        memory_budget_mb (int, optional): Memory budget for a chunk in flight. Defaults to 512
+        geometry_column (str, optional): Column holding WKT geometries. Defaults to 'geometry'
+        column_types (dict, optional): pyarrow types of some columns, e.g. {"confidence": pa.float32()}
+        crs (optional): CRS of the geometries. Defaults to EPSG:4326
+        id_column (str, optional): Column filled with ids from a running offset. Defaults to 'id'
+        prepare (dict, optional): Arguments of `geometry.prepare_geometries`, e.g. {"make_valid": True}
+    Return:
+        Generator of GeoDataFrames.
+    """
+    block_size = int(memory_budget_mb * 1024**2 / CHUNK_OVERHEAD)
+    logger.info(f"Reading {path} in blocks of {block_size / 1024**2:.0f} MB (budget {memory_budget_mb} MB)")
+    reader = pa_csv.open_csv(
+        path,
+        read_options=pa_csv.ReadOptions(block_size=block_size),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={**(column_types or {}), geometry_column: pa.string()}
+        ),
+    )
+    offset = 0
+    for batch in reader:
+        df = _to_pandas(batch)
+        geometry = shapely.from_wkt(df.pop(geometry_column).to_numpy(), on_invalid="warn")
+        gdf = gpd.GeoDataFrame(df, geometry=geometry, crs=crs)
+        if prepare:
+            gdf = prepare_geometries(gdf, crs, **prepare)
+        if id_column:
+            gdf[id_column] = np.arange(offset, offset + len(gdf))
+        offset += len(gdf)
+        yield gdf
+    logger.info(f"Read {offset} records from {path}")
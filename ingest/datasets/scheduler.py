@@ -0,0 +1,120 @@
+"""Run tasks in worker processes within a memory and database connection budget.
+
+Unlike `joblib.Parallel(n_jobs=-1)`, which starts one task per CPU whatever
+their size, a task is only started when its estimated memory and its DB
+connections fit in what is left of the budget. Every worker process keeps one
+small connection pool for all the tasks it runs.
+"""
+
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from .db import forget_pools, get_pool, set_pool_size
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MEMORY_LIMIT_MB = int(os.environ.get("INGEST_MEMORY_LIMIT_MB", 4096))
+DB_CONNECTIONS = int(os.environ.get("INGEST_DB_CONNECTIONS", 4))
+# connections of the pool of a worker process
+WORKER_CONNECTIONS = 2
+
+# fn must be importable (module level) to be sent to a worker process,
+# memory_mb is the estimated peak memory of the task, db its connections
+Task = namedtuple("Task", ["name", "fn", "args", "memory_mb", "db"], defaults=[(), 0, WORKER_CONNECTIONS])
+
+
+class TasksFailed(RuntimeError):
+    """Raised by `run_tasks` once every task ran, if some failed.
+
+    Attributes:
+        failed (list): Names of the failed tasks.
+        results (list): Result of every task, in the order of tasks (None for a task that failed).
+    """
+
+    def __init__(self, failed: list, results: list):
+        super().__init__(f"{len(failed)} task(s) failed: {', '.join(failed)}")
+        self.failed = failed
+        self.results = results
+
+
+def _init_worker(connections: int):
+    # the parent (e.g. admin `run`, with its StacLoader) may have opened its pool before the fork
+    forget_pools()
+    set_pool_size(1, connections)
+    try:
+        get_pool()
+    except Exception as ex:
+        # the tasks will raise the error themselves
+        logger.warning(f"Could not open the worker connection pool: {ex}")
+
+
+def run_tasks(
+    tasks: list,
+    memory_limit_mb: int = MEMORY_LIMIT_MB,
+    db_connections: int = DB_CONNECTIONS,
+    workers: int = None,
+) -> list:
+    """Run tasks in a process pool, bounded by memory_limit_mb and db_connections.
+
+    Largest tasks are started first, smaller ones fill the remaining budget. A
+    task larger than the whole budget runs alone.
+
+    Args:
+        tasks (list): `Task` tuples.
+        memory_limit_mb (int, optional): Memory for the tasks running at once. Defaults to INGEST_MEMORY_LIMIT_MB
+        db_connections (int, optional): DB connections for the tasks running at once. Defaults to INGEST_DB_CONNECTIONS
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs
+    Return:
+        list: Result of every task, in the order of tasks.
+    Raise:
+        TasksFailed: once all the tasks ran, if any failed. It holds the results of the others.
+    """
+    workers = max(1, min(workers or os.cpu_count(), db_connections // WORKER_CONNECTIONS or 1, len(tasks) or 1))
+    pending = sorted(range(len(tasks)), key=lambda i: tasks[i].memory_mb, reverse=True)
+    results = [None] * len(tasks)
+    failed = []
+    running = {}
+    memory = db = 0
+    start = time.perf_counter()
+
+    def fits(task):
+        if not running:
+            return True
+        return (
+            len(running) < workers
+            and memory + task.memory_mb <= memory_limit_mb
+            and db + task.db <= db_connections
+        )
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(WORKER_CONNECTIONS,)
+    ) as executor:
+        while pending or running:
+            for i in list(pending):
+                task = tasks[i]
+                if not fits(task):
+                    continue
+                pending.remove(i)
+                memory += task.memory_mb
+                db += task.db
+                logger.info(f"Starting {task.name} (~{task.memory_mb} MB, {memory}/{memory_limit_mb} MB in use)")
+                running[executor.submit(task.fn, *task.args)] = i
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                memory -= tasks[i].memory_mb
+                db -= tasks[i].db
+                try:
+                    results[i] = future.result()
+                except Exception as ex:
+                    logger.error(f"{tasks[i].name} failed: {ex!r}")
+                    failed.append(tasks[i].name)
+
+    logger.info(f"Ran {len(tasks)} tasks with {workers} workers in {time.perf_counter() - start:.1f}s")
+    if failed:
+        raise TasksFailed(failed, results)
+    return results
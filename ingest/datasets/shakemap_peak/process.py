@@ -1,19 +1,39 @@
-from tqdm import tqdm
 import geopandas as gpd
 from os import makedirs, environ
 import logging
-from joblib import Parallel, delayed
-from ..utils import run_cli, save_postgis
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from functools import partial
+from urllib.parse import urljoin
+from ..utils import exist_table, save_postgis
+from ..manifest import Manifest
+from ..archive import vsi_path, zip_members
+from ..download import TIMEOUT, download, get_session
+from ..pgstac_loader import StacLoader, item_properties
+from ..stac import create_stac_item
+from ..raster import RASTER_EXTENSION, cog_asset, publish_cog, write_cog
+from .. import instrument
+from ..instrument import stage
+from ..geometry import prepare_geometries
 import json
+import numpy as np
 import os
-import requests
-import zipfile
-import os
+import re
+import shutil
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-LINK = "https://earthquake.usgs.gov/product/shakemap/us6000lfn5/us/1703038955396/download/shape.zip"
+# event page of the FDSN event service, lists the shakemap products and their files
+DETAIL_URL = "https://earthquake.usgs.gov/fdsnws/event/1/query?eventid={event_id}&format=geojson"
+# real-time feed, updated every minute, see https://earthquake.usgs.gov/earthquakes/feed/v1.0/geojson.php
+FEED_URL = "https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/significant_week.geojson"
+SHAPE_ZIP = "download/shape.zip"
+# gridded product: one ESRI .flt grid per metric (mean and standard deviation)
+RASTER_ZIP = "download/raster.zip"
+# event id -> slug used in the table and item names
+EVENTS = {"us6000lfn5": "afg"}
 basename_files = [
     "psa1p0",
     "mi",
@@ -22,91 +42,412 @@ basename_files = [
     "psa0p3",
     "psa3p0",
 ]
+# layers of every event are read, loaded and indexed at the same time
+LAYER_WORKERS = int(environ.get("INGEST_SHAKEMAP_WORKERS", 6))
+POLL_INTERVAL = 60
 
 STAC_VERSION = "1.0.0"
 COLLECTION = "earthquake_usgs_gov"
-ITEM = f"{COLLECTION}_shakemap_afg"
-TITLE = "Shakemap Peak Ground Acceleration, Afghanistan"
-DESCRIPTION = "Shakemap  - M 6.3 - 34 km NNW of Herat, Afghanistan"
+ITEM = f"{COLLECTION}_shakemap"
 LICENSE = "Creative Commons Attribution International"
-DATETIME = "2023-12-20"
-
-
-def dowload_and_process(path_local):
-    response = requests.get(LINK)
-    zip_file_path = f"{path_local}/shapefiles.zip"
-    with open(zip_file_path, "wb") as file:
-        file.write(response.content)
-
-    # Extract the ZIP file
-    with zipfile.ZipFile(zip_file_path, "r") as zip_ref:
-        zip_ref.extractall(f"{path_local}/shapefiles")
-
-    # Read each shapefile into GeoPandas
-    shapefile_dir = f"{path_local}/shapefiles"
-    for filename in os.listdir(shapefile_dir):
-        if filename.endswith(".shp"):
-            file_basename, file_extension = os.path.splitext(filename)
-            file_path = os.path.join(shapefile_dir, filename)
-            gdf = gpd.read_file(file_path)
-            logger.info(f"Loaded {filename} into GeoDataFrame:")
-            logger.info("Saving dataset in DB...")
-            gdf["id"] = gdf.index
-            gdf.columns = [col.lower() for col in gdf.columns]
-            gdf['area'] = gdf.area
-            save_postgis(
-                gdf=gdf,
-                table_name=f"{ITEM}_{file_basename}",
-                if_exists="replace",
-                index=False,
-                schema="public",
-                table_id="id",
-            )
-            args = {
-                "--id": f"{ITEM}_{file_basename}",
-                "--datetime": DATETIME,
-                "--collection": COLLECTION,
-                "--asset-href": LINK,
-            }
-            # #################
-            # save item stac
-            # #################
-            logger.info("Running fio stac for dataset...")
-            output_json = run_cli(["fio", "stac"], file_path, args)
-            output_json["output"]["title"] = TITLE
-            output_json["output"]["description"] = DESCRIPTION
-            output_json["output"]["license"] = LICENSE
-            output_json["output"]["table"] = f"{ITEM}_{file_basename}"
-            output_json["output"]["links"] = {
-                "href": LINK,
-                "rel": LINK,
-                "title": TITLE,
-            }
-            stac_item_path = f"{file_path}_.json"
-            with open(stac_item_path, "w") as file:
-                file.write(json.dumps(output_json["output"]))
-
-            #################
-            # Run: pypgstac load collections
-            #################
-            logger.info("Importing item/colletion to pgstac...")
-            output_json = run_cli(
-                ["pypgstac", "load", "items"],
-                stac_item_path,
-                {"--method": "insert_ignore"},
+
+
+def get_json(url: str) -> dict:
+    """GET a JSON document, or read it from a local file (e.g. a stub of the USGS feed)."""
+    if not re.match(r"^https?://", url):
+        with open(url[len("file://") :] if url.startswith("file://") else url) as f:
+            return json.load(f)
+    response = get_session().get(url, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def event_slug(event_id: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", event_id.lower())
+
+
+def feed_events(feed_url: str = FEED_URL, min_magnitude: float = None) -> dict:
+    """Events of a USGS GeoJSON feed that have a shakemap.
+
+    Return:
+        dict: event id -> {"detail": detail URL, "updated": last update (ms)}
+    """
+    with stage("discover_link", feed=feed_url):
+        feed = get_json(feed_url)
+    events = {}
+    for feature in feed.get("features", []):
+        properties = feature.get("properties", {})
+        if "shakemap" not in (properties.get("types") or "").split(","):
+            continue
+        if min_magnitude is not None and (properties.get("mag") or 0) < min_magnitude:
+            continue
+        events[feature["id"]] = {
+            "detail": urljoin(feed_url, properties.get("detail") or DETAIL_URL.format(event_id=feature["id"])),
+            "updated": properties.get("updated"),
+        }
+    return events
+
+
+def shakemap_product(event_id: str, detail_url: str = None) -> dict:
+    """Preferred shakemap version of an event, from its detail document.
+
+    Return:
+        dict: event id, version, shape.zip URL, title, datetime and magnitude, or None without shakemap.
+    """
+    detail_url = detail_url or DETAIL_URL.format(event_id=event_id)
+    detail = get_json(detail_url)
+    properties = detail.get("properties", {})
+    products = properties.get("products", {}).get("shakemap", [])
+    products = [p for p in products if SHAPE_ZIP in p.get("contents", {}) and p.get("status") != "DELETE"]
+    if not products:
+        logger.warning(f"{event_id} has no shakemap contours")
+        return None
+    product = max(products, key=lambda p: (p.get("preferredWeight", 0), p.get("updateTime", 0)))
+    return {
+        "event_id": event_id,
+        "version": product.get("updateTime"),
+        # stubs of the event service can use relative links
+        "url": urljoin(detail_url, product["contents"][SHAPE_ZIP]["url"]),
+        "raster_url": (
+            urljoin(detail_url, product["contents"][RASTER_ZIP]["url"])
+            if RASTER_ZIP in product["contents"]
+            else None
+        ),
+        "title": properties.get("title") or event_id,
+        "datetime": datetime.fromtimestamp(properties.get("time", 0) / 1000, timezone.utc).isoformat(),
+        "magnitude": properties.get("mag"),
+        "max_mmi": product.get("properties", {}).get("maximum-mmi"),
+    }
+
+
+class EventsFailed(RuntimeError):
+    """Some events could not be loaded, `events` holds their ids."""
+
+    def __init__(self, events: set):
+        super().__init__(f"Shakemap ingest failed for {sorted(events)}")
+        self.events = events
+
+
+def is_loaded(product: dict, item_ids: list) -> bool:
+    """True if every item is in pgstac with the shakemap version of product.
+
+    The version is read from the items, which are loaded after their tables:
+    a download that was never loaded (or failed to) is loaded again.
+    """
+    if not item_ids or product["version"] is None:
+        return False
+    versions = item_properties(COLLECTION, item_ids, "usgs:shakemap_version")
+    return all(versions.get(item_id) == str(product["version"]) for item_id in item_ids)
+
+
+def download_event(
+    product: dict, path_local: str, slug: str, manifest, force: bool = False, optimize: dict = None, grid: bool = True
+) -> list:
+    """Download the contours (and grid) of an event, unless this version was already loaded.
+
+    The manifest only avoids downloading a file again, whether a layer is up to
+    date is decided by the `usgs:shakemap_version` of its item (see `is_loaded`).
+
+    Return:
+        list: (name, function, (url, manifest entry)) of the jobs loading the layers and the grid,
+            empty if up to date. The entry of a download is recorded once all its jobs succeeded.
+    """
+    jobs = []
+    zip_file_path = f"{path_local}/shakemap_{slug}.zip"
+    entry = download(product["url"], zip_file_path, manifest=manifest)
+    # layer item id (and table) -> member of the zip
+    layers = {
+        f"{ITEM}_{slug}_{os.path.splitext(os.path.basename(member))[0]}": member
+        for member in zip_members(zip_file_path, ".shp")
+    }
+    if not force and is_loaded(product, list(layers)) and all(exist_table(table) for table in layers):
+        logger.info(f"Version {product['version']} of {product['event_id']} is already loaded, skipping")
+    else:
+        jobs += [
+            (member, partial(process_layer, zip_file_path, member, product, slug, optimize), (product["url"], entry))
+            for member in layers.values()
+        ]
+    if grid and product["raster_url"]:
+        raster_zip_path = f"{path_local}/shakemap_{slug}_raster.zip"
+        entry = download(product["raster_url"], raster_zip_path, manifest=manifest)
+        if not force and is_loaded(product, [f"{ITEM}_{slug}_grid"]):
+            logger.info(f"Version {product['version']} of the {product['event_id']} grid is already loaded, skipping")
+        else:
+            jobs.append(
+                (
+                    "grid",
+                    partial(process_grid, raster_zip_path, product, slug, path_local),
+                    (product["raster_url"], entry),
+                )
             )
+    return jobs
+
 
+def grid_path(path_local: str, slug: str) -> str:
+    return f"{path_local}/{ITEM}_{slug}_grid.tif"
 
-def run(path_local: str):
+
+def process_layer(zip_file_path: str, member: str, product: dict, slug: str, optimize: dict = None) -> dict:
+    """Load one contour layer of an event into its table.
+
+    Return:
+        dict: STAC item of the layer.
+    """
+    file_basename = os.path.splitext(os.path.basename(member))[0]
+    table = f"{ITEM}_{slug}_{file_basename}"
+    with stage("read", layer=file_basename, event=product["event_id"]) as span:
+        gdf = gpd.read_file(vsi_path(zip_file_path, member))
+        span.add(rows=len(gdf))
+    gdf["id"] = gdf.index
+    gdf.columns = [col.lower() for col in gdf.columns]
+    # area in m² (equal-area projection), not in square degrees
+    gdf = prepare_geometries(gdf, 4326, make_valid=True, area_column="area")
+    save_postgis(
+        gdf=gdf,
+        table_name=table,
+        if_exists="replace",
+        index=False,
+        schema="public",
+        table_id="id",
+        optimize=optimize,
+    )
+    stac_item = create_stac_item(
+        gdf,
+        item_id=table,
+        collection=COLLECTION,
+        datetime=product["datetime"],
+        asset_href=product["url"],
+        properties={
+            "usgs:event_id": product["event_id"],
+            "usgs:shakemap_version": product["version"],
+            "usgs:magnitude": product["magnitude"],
+            "usgs:maximum_mmi": product["max_mmi"],
+            "shakemap:layer": file_basename,
+        },
+    )
+    stac_item["title"] = f"Shakemap {file_basename}, {product['title']}"
+    stac_item["description"] = f"Shakemap - {product['title']}"
+    stac_item["license"] = LICENSE
+    stac_item["table"] = table
+    stac_item["links"] = {
+        "href": product["url"],
+        "rel": product["url"],
+        "title": stac_item["title"],
+    }
+    return stac_item
+
+
+def process_grid(zip_file_path: str, product: dict, slug: str, path_local: str) -> dict:
+    """Stack the mean grids of an event into a multi-band COG, one band per metric.
+
+    Return:
+        dict: STAC item of the grid, with `raster:bands` statistics for the raster service.
+    """
+    members = zip_members(zip_file_path, ".flt") or zip_members(zip_file_path, ".tif")
+    grids = {os.path.splitext(os.path.basename(m))[0]: m for m in members}
+    # standard deviation grids are left out when the mean grids are there
+    means = {name[: -len("_mean")]: m for name, m in grids.items() if name.endswith("_mean")}
+    grids = means or grids
+    if not grids:
+        raise ValueError(f"No grid in {zip_file_path}")
+    sources = {name: vsi_path(zip_file_path, grids[name]) for name in sorted(grids, key=lambda n: (n != "mmi", n))}
+    item_id = f"{ITEM}_{slug}_grid"
+    # the raster service reads the published copy, not the download directory of this host
+    cog = publish_cog(write_cog(sources, grid_path(path_local, slug)), f"{item_id}.tif")
+    stac_item = create_stac_item(
+        None,
+        bounds=np.array([cog["bounds"]]),
+        crs=cog["crs"],
+        item_id=item_id,
+        collection=COLLECTION,
+        datetime=product["datetime"],
+        asset_href=cog["href"],
+        asset_name="data",
+        properties={
+            "usgs:event_id": product["event_id"],
+            "usgs:shakemap_version": product["version"],
+            "usgs:magnitude": product["magnitude"],
+            "usgs:maximum_mmi": product["max_mmi"],
+            "proj:shape": cog["shape"],
+            "proj:transform": cog["transform"],
+        },
+        extra_assets={"source": {"href": product["raster_url"], "roles": ["source"]}},
+    )
+    stac_item["assets"]["data"] = cog_asset(cog, title=", ".join(sources))
+    stac_item["stac_extensions"].append(RASTER_EXTENSION)
+    stac_item["title"] = f"Shakemap grid, {product['title']}"
+    stac_item["description"] = f"Shakemap - {product['title']}, bands: {', '.join(sources)}"
+    stac_item["license"] = LICENSE
+    stac_item["links"] = {
+        "href": product["raster_url"],
+        "rel": product["raster_url"],
+        "title": stac_item["title"],
+    }
+    return stac_item
+
+
+def ingest_events(
+    events: dict,
+    path_local: str,
+    loader: StacLoader,
+    optimize: dict = None,
+    force: bool = False,
+    grid: bool = True,
+    workers: int = LAYER_WORKERS,
+) -> int:
+    """Load every layer (and the grid) of every event, concurrently.
+
+    Args:
+        events (dict): Event id -> {"slug": table/item name part, "detail": detail URL (optional)}.
+        grid (bool, optional): Also write the gridded product as a COG item. Defaults to True
+    Return:
+        int: Number of layers and grids loaded.
+    """
+    makedirs(path_local, exist_ok=True)
+    # shapefiles extracted by older versions of this module
+    shutil.rmtree(f"{path_local}/shapefiles", ignore_errors=True)
+    manifest = Manifest()
+
+    def prepare(event_id):
+        product = shakemap_product(event_id, events[event_id].get("detail"))
+        if product is None:
+            return []
+        jobs = download_event(product, path_local, events[event_id]["slug"], manifest, force, optimize, grid)
+        return [(f"{event_id}/{name}", job, source) for name, job, source in jobs]
+
+    errors = []
+    failed_events = set()
+    loaded = 0
+    # url -> manifest entry of the downloads whose jobs all succeeded
+    sources, failed_sources = {}, set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # event details and downloads first, then the layers of all events at once
+        jobs = []
+        for event_id, future in [(e, executor.submit(prepare, e)) for e in events]:
+            try:
+                jobs += future.result()
+            except Exception as ex:
+                logger.error(f"Could not download the shakemap of {event_id}: {ex}")
+                errors.append(event_id)
+                failed_events.add(event_id)
+        futures = {executor.submit(job): (name, source) for name, job, source in jobs}
+        for future in as_completed(futures):
+            name, (url, entry) = futures[future]
+            try:
+                loader.add_item(future.result())
+                loaded += 1
+                if entry:
+                    sources[url] = entry
+            except Exception as ex:
+                logger.error(f"Could not load {name}: {ex}")
+                errors.append(name)
+                failed_events.add(name.split("/")[0])
+                failed_sources.add(url)
+    # downloads are recorded once their items are in pgstac, a failed load is retried by the next run
+    loader.flush()
+    for url, entry in sources.items():
+        if url not in failed_sources:
+            manifest.record(url, entry)
+    if errors:
+        logger.error(f"Shakemap ingest failed for {errors}")
+        raise EventsFailed(failed_events)
+    return loaded
+
+
+def load_events(events: dict, path_local: str, optimize: dict = None, force: bool = False, grid: bool = True):
     #################
     # Load collection into the DB
     #################
     logger.info("\n\nLoad collection into the DB..")
     stac_collection_path = f"datasets/shakemap_peak/collection.json"
-    run_cli(
-        ["pypgstac", "load", "collections"],
-        stac_collection_path,
-        {"--method": "insert_ignore", "--dsn": environ["DATABASE_URL"]},
-    )
-    
-    dowload_and_process(path_local)
+    # upsert, an updated shakemap replaces the items of its previous version
+    with StacLoader(method="upsert") as loader:
+        loader.add_collections(stac_collection_path)
+        ingest_events(events, path_local, loader, optimize, force, grid)
+        #################
+        # Load collection and every layer item into pgstac
+        #################
+        logger.info("Importing item/colletion to pgstac...")
+
+
+def _events(event_ids) -> dict:
+    if isinstance(event_ids, dict):
+        return {e: {"slug": slug} for e, slug in event_ids.items()}
+    return {e: {"slug": EVENTS.get(e, event_slug(e))} for e in event_ids}
+
+
+def run(
+    path_local: str,
+    optimize: dict = None,
+    force: bool = False,
+    events=None,
+    feed_url: str = None,
+    min_magnitude: float = None,
+    grid: bool = True,
+):
+    """Load the shakemap contours of events into `earthquake_usgs_gov_shakemap_<slug>_<layer>` tables.
+
+    Args:
+        path_local (str): Download directory.
+        optimize (dict, optional): Arguments for `optimize.optimize_table`.
+        force (bool, optional): Load events whose shakemap did not change.
+        events (list | dict, optional): Event ids, or event id -> slug. Defaults to EVENTS
+        feed_url (str, optional): Also load the events with a shakemap in this USGS GeoJSON feed (URL or file).
+        min_magnitude (float, optional): Ignore the feed events below this magnitude.
+        grid (bool, optional): Also write the gridded product (raster.zip) as a multi-band COG item. Defaults to True
+    """
+    events = _events(EVENTS if events is None and not feed_url else events or [])
+    if feed_url:
+        for event_id, event in feed_events(feed_url, min_magnitude).items():
+            events.setdefault(event_id, {"slug": event_slug(event_id)})["detail"] = event["detail"]
+    load_events(events, path_local, optimize, force, grid)
+
+
+def watch(
+    path_local: str,
+    feed_url: str = FEED_URL,
+    interval: float = POLL_INTERVAL,
+    optimize: dict = None,
+    min_magnitude: float = None,
+    max_polls: int = None,
+    grid: bool = True,
+):
+    """Poll feed_url and load the events whose shakemap is new or was updated since the last poll.
+
+    An event is only marked as seen once all its layers are loaded, a failed
+    event is tried again at the next poll.
+    """
+    seen = {}
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        start = time.monotonic()
+        polls += 1
+        try:
+            updated = {
+                event_id: event
+                for event_id, event in feed_events(feed_url, min_magnitude).items()
+                if seen.get(event_id) != event["updated"]
+            }
+            if updated:
+                logger.info(f"{len(updated)} new or updated event(s): {sorted(updated)}")
+                failed = set()
+                try:
+                    with instrument.run("shakemap_peak"):
+                        load_events(
+                            {
+                                event_id: {"slug": EVENTS.get(event_id, event_slug(event_id)), "detail": event["detail"]}
+                                for event_id, event in updated.items()
+                            },
+                            path_local,
+                            optimize,
+                            grid=grid,
+                        )
+                except EventsFailed as ex:
+                    logger.error(f"Shakemap poll failed: {ex}")
+                    failed = ex.events
+                seen.update({e: event["updated"] for e, event in updated.items() if e not in failed})
+        except Exception as ex:
+            # the next poll tries again
+            logger.error(f"Shakemap poll failed: {ex}")
+        if max_polls is None or polls < max_polls:
+            time.sleep(max(0, interval - (time.monotonic() - start)))
@@ -0,0 +1,147 @@
+"""Build STAC items from GeoDataFrames already in memory."""
+
+from datetime import datetime as dt, timezone
+import numpy as np
+import shapely
+from shapely.geometry import mapping
+from pyproj import CRS, Transformer
+from .instrument import stage
+
+STAC_VERSION = "1.0.0"
+PROJECTION_EXTENSION = "https://stac-extensions.github.io/projection/v1.1.0/schema.json"
+
+# Simplification tolerance of the footprint, as a fraction of the bbox diagonal
+FOOTPRINT_TOLERANCE = 0.001
+
+
+def hull_points(bounds: np.ndarray) -> np.ndarray:
+    """Reduce (n, 4) feature bounds to the vertices of their convex hull.
+
+    The vertices are returned as degenerate (m, 4) bounds, so chunks of a large
+    source can be summarized as they stream by and passed to `create_stac_item`.
+    """
+    bounds = bounds[~np.isnan(bounds).any(axis=1)]
+    if not len(bounds):
+        return np.empty((0, 4))
+    corners = np.concatenate(
+        [bounds[:, [0, 1]], bounds[:, [0, 3]], bounds[:, [2, 1]], bounds[:, [2, 3]]]
+    )
+    hull = shapely.convex_hull(shapely.multipoints(np.unique(corners, axis=0)))
+    points = shapely.get_coordinates(hull)
+    return np.hstack([points, points])
+
+
+def footprint_from_bounds(bounds: np.ndarray, crs=4326, tolerance: float = FOOTPRINT_TOLERANCE):
+    """Compute bbox and footprint from an array of per-feature bounds.
+
+    The footprint is the simplified convex hull of the feature envelopes, clipped
+    to the bbox, which always contains every feature and only needs 4 points per
+    feature.
+
+    Args:
+        bounds (np.ndarray): (n, 4) array of [minx, miny, maxx, maxy].
+        crs (optional): CRS of the bounds. Defaults to EPSG:4326
+        tolerance (float, optional): Simplification tolerance as a fraction of the bbox diagonal.
+    Return:
+        tuple: (bbox list in EPSG:4326, shapely geometry in EPSG:4326)
+    """
+    points = hull_points(bounds)
+    if not len(points):
+        return None, None
+    hull = shapely.convex_hull(shapely.multipoints(points[:, :2]))
+
+    crs = CRS.from_user_input(crs)
+    if not crs.equals(CRS.from_epsg(4326)):
+        # densify before reprojecting so the hull still covers curved edges
+        transformer = Transformer.from_crs(crs, 4326, always_xy=True)
+        densified = shapely.segmentize(hull, max(hull.length / 100, 1e-9))
+        hull = shapely.convex_hull(
+            shapely.transform(
+                densified,
+                lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1])),
+            )
+        )
+
+    minx, miny, maxx, maxy = hull.bounds
+    diagonal = np.hypot(maxx - minx, maxy - miny)
+    if minx < maxx and miny < maxy:
+        # simplifying a convex polygon shrinks it by at most the tolerance, grow it back
+        tolerance = diagonal * tolerance
+        hull = shapely.buffer(shapely.simplify(hull, tolerance), tolerance, join_style="mitre")
+        # the buffer grows past the bbox, the footprint must stay within it (features still do)
+        hull = shapely.clip_by_rect(hull, minx, miny, maxx, maxy)
+    if hull.geom_type != "Polygon":
+        # single point/line features: fall back to the bbox (or the point itself)
+        hull = shapely.box(minx, miny, maxx, maxy) if diagonal else hull
+    return [minx, miny, maxx, maxy], hull
+
+
+def create_stac_item(
+    gdf,
+    item_id: str,
+    collection: str,
+    datetime: str,
+    asset_href: str,
+    asset_name: str = "asset",
+    asset_media_type: str = None,
+    asset_roles: list = None,
+    properties: dict = None,
+    bounds: np.ndarray = None,
+    extra_assets: dict = None,
+    crs=None,
+) -> dict:
+    """Create a STAC item (as a dict) describing a GeoDataFrame.
+
+    Replaces `fio stac`: bbox and geometry are computed from the frame already in
+    memory instead of re-reading the file in another process.
+
+    Args:
+        gdf (object): A GeoDataFrame object, or None when bounds and crs are given.
+        item_id (str): Item id.
+        collection (str): Collection id.
+        datetime (str): Item datetime (e.g. "2023-07-16").
+        asset_href (str): Href of the data asset.
+        asset_name (str, optional): Key of the data asset. Defaults to 'asset'
+        asset_media_type (str, optional): Media type of the data asset.
+        asset_roles (list, optional): Roles of the data asset.
+        properties (dict, optional): Additional item properties.
+        bounds (np.ndarray, optional): Precomputed (n, 4) feature bounds, e.g. accumulated over chunks.
+        extra_assets (dict, optional): Other assets of the item, e.g. the original source.
+        crs (optional): CRS of bounds. Defaults to the CRS of gdf
+    Return:
+        dict: The STAC item.
+    """
+    with stage("stac_build", item=item_id) as span:
+        if bounds is None:
+            bounds = gdf.geometry.bounds.to_numpy()
+        if crs is None:
+            crs = gdf.crs if gdf is not None else None
+        crs = crs or 4326
+        bbox, geometry = footprint_from_bounds(bounds, crs=crs)
+        span.add(rows=len(bounds))
+
+    epsg = CRS.from_user_input(crs).to_epsg()
+    item_datetime = dt.fromisoformat(datetime)
+    if item_datetime.tzinfo is None:
+        item_datetime = item_datetime.replace(tzinfo=timezone.utc)
+
+    asset = {"href": asset_href, "roles": asset_roles or []}
+    if asset_media_type:
+        asset["type"] = asset_media_type
+
+    return {
+        "type": "Feature",
+        "stac_version": STAC_VERSION,
+        "stac_extensions": [PROJECTION_EXTENSION],
+        "id": item_id,
+        "collection": collection,
+        "geometry": mapping(geometry) if geometry is not None else None,
+        "bbox": bbox,
+        "properties": {
+            "datetime": item_datetime.isoformat().replace("+00:00", "Z"),
+            "proj:epsg": epsg,
+            **(properties or {}),
+        },
+        "links": [],
+        "assets": {asset_name: asset, **(extra_assets or {})},
+    }
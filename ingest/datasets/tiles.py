@@ -0,0 +1,342 @@
+"""Build zoom-limited vector tile pyramids (MVT in a PMTiles archive) for heavy layers."""
+
+import gzip
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+import geopandas as gpd
+import mapbox_vector_tile
+import numpy as np
+import pandas as pd
+import shapely
+from pmtiles.tile import Compression, TileType, zxy_to_tileid
+from pmtiles.writer import Writer
+from psycopg import sql
+from pyproj import Transformer
+from .db import get_pool
+from .instrument import timed
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPE = "application/vnd.pmtiles"
+EXTENT = 4096
+HALF_WORLD = 20037508.342789244
+# simplification tolerance and smallest kept feature, in pixels of a 256px tile
+TOLERANCE_PX = 0.5
+MIN_SIZE_PX = 1
+# a tile keeps its largest features beyond this
+MAX_FEATURES = 20000
+# a zoom is built by windows of 2**WINDOW_ZOOMS x 2**WINDOW_ZOOMS tiles
+WINDOW_ZOOMS = 2
+
+EXTENT_QUERY = """
+SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+FROM (SELECT ST_Transform(ST_SetSRID(ST_Extent({geometry})::geometry, %(srid)s), 3857) AS e FROM {table}) s
+"""
+
+# features of a window (EPSG:3857) that are points or at least min_size wide or high in EPSG:3857
+WINDOW_QUERY = """
+SELECT {columns}ST_AsBinary(ST_Transform(t.{geometry}, 3857))
+FROM {table} t
+WHERE t.{geometry} && ST_Transform(ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 3857), %(srid)s)
+AND (
+    ST_Dimension(t.{geometry}) = 0
+    OR (
+        SELECT GREATEST(ST_XMax(b) - ST_XMin(b), ST_YMax(b) - ST_YMin(b))
+        FROM (SELECT Box2D(ST_Transform(ST_Envelope(t.{geometry}), 3857)) AS b) e
+    ) >= %(min_size)s
+)
+"""
+
+
+def pixel_size(z: int) -> float:
+    """Size in meters (EPSG:3857) of a pixel of a 256px tile at zoom z."""
+    return 2 * HALF_WORLD / (256 * 2**z)
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple:
+    size = 2 * HALF_WORLD / 2**z
+    minx = -HALF_WORLD + x * size
+    maxy = HALF_WORLD - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def _tile_pairs(bounds: np.ndarray, z: int):
+    """Return (feature index, x, y) arrays of the tiles touched by every feature bbox."""
+    n = 2**z
+    size = 2 * HALF_WORLD / n
+    x0 = np.clip(np.floor((bounds[:, 0] + HALF_WORLD) / size), 0, n - 1).astype(np.int64)
+    x1 = np.clip(np.floor((bounds[:, 2] + HALF_WORLD) / size), 0, n - 1).astype(np.int64)
+    y0 = np.clip(np.floor((HALF_WORLD - bounds[:, 3]) / size), 0, n - 1).astype(np.int64)
+    y1 = np.clip(np.floor((HALF_WORLD - bounds[:, 1]) / size), 0, n - 1).astype(np.int64)
+    nx = x1 - x0 + 1
+    counts = nx * (y1 - y0 + 1)
+    index = np.repeat(np.arange(len(bounds)), counts)
+    # position of each pair within the tile range of its feature
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    x = x0[index] + offset % nx[index]
+    y = y0[index] + offset // nx[index]
+    return index, x, y
+
+
+def _encode_tile(task):
+    """Clip, quantize and encode the features of one tile (runs in a worker process)."""
+    z, x, y, layer, wkbs, properties, sizes = task
+    bounds = tile_bounds(z, x, y)
+    # a small buffer so that polygon edges are not drawn along tile borders
+    buffer = (bounds[2] - bounds[0]) * 8 / 256
+    geometries = shapely.clip_by_rect(
+        shapely.from_wkb(wkbs),
+        bounds[0] - buffer,
+        bounds[1] - buffer,
+        bounds[2] + buffer,
+        bounds[3] + buffer,
+    )
+    keep = ~shapely.is_empty(geometries)
+    if len(geometries) > MAX_FEATURES:
+        keep &= np.asarray(sizes) >= np.sort(sizes)[-MAX_FEATURES]
+    features = [
+        {"geometry": geometry, "properties": props}
+        for geometry, props, k in zip(geometries, properties, keep)
+        if k
+    ]
+    if not features:
+        return None
+    data = mapbox_vector_tile.encode(
+        [{"name": layer, "features": features}],
+        default_options={"quantize_bounds": bounds, "extents": EXTENT},
+    )
+    return zxy_to_tileid(z, x, y), gzip.compress(data)
+
+
+def _properties(df: pd.DataFrame) -> list:
+    """Row properties as plain python values, without nulls (MVT has no null)."""
+    records = df.astype(object).where(df.notna(), None).to_dict("records")
+    return [{k: v for k, v in record.items() if v is not None} for record in records]
+
+
+def _zoom_tasks(gdf: gpd.GeoDataFrame, z: int, layer: str, columns: list, window: tuple):
+    """Yield the tile tasks of zoom z inside window (wz, wx, wy): simplified, size filtered features grouped by tile."""
+    px = pixel_size(z)
+    geometries = shapely.simplify(gdf.geometry.to_numpy(), px * TOLERANCE_PX, preserve_topology=True)
+    # feature dropping: anything smaller than a pixel does not show at this zoom
+    bounds = shapely.bounds(geometries)
+    sizes = np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1])
+    is_point = shapely.get_type_id(geometries) == 0
+    keep = (is_point | (sizes >= px * MIN_SIZE_PX)) & ~shapely.is_empty(geometries)
+    if not keep.any():
+        return
+    geometries, bounds, sizes = geometries[keep], bounds[keep], sizes[keep]
+    properties = _properties(gdf[columns].iloc[np.flatnonzero(keep)]) if columns else [{}] * len(geometries)
+    wkbs = shapely.to_wkb(geometries)
+
+    index, x, y = _tile_pairs(bounds, z)
+    # features crossing the window edge also touch tiles of the next windows, which encode them
+    wz, wx, wy = window
+    inside = ((x >> (z - wz)) == wx) & ((y >> (z - wz)) == wy)
+    index, x, y = index[inside], x[inside], y[inside]
+    order = np.lexsort((y, x))
+    index, x, y = index[order], x[order], y[order]
+    starts = np.flatnonzero(np.r_[True, (np.diff(x) != 0) | (np.diff(y) != 0)])
+    for start, end in zip(starts, np.r_[starts[1:], len(index)]):
+        rows = index[start:end]
+        yield (
+            z,
+            int(x[start]),
+            int(y[start]),
+            layer,
+            wkbs[rows],
+            [properties[i] for i in rows],
+            sizes[rows],
+        )
+
+
+def _windows(extent: tuple, wz: int) -> list:
+    """Tiles (x, y) of zoom wz covering extent (EPSG:3857), in tile id order."""
+    _, x, y = _tile_pairs(np.array([extent]), wz)
+    return sorted(zip(x.tolist(), y.tolist()), key=lambda xy: zxy_to_tileid(wz, *xy))
+
+
+def _fields(gdf: gpd.GeoDataFrame, columns: list) -> dict:
+    return {c: "Number" if pd.api.types.is_numeric_dtype(gdf[c]) else "String" for c in columns}
+
+
+class FrameSource:
+    """Windows of an in-memory layer, through its spatial index."""
+
+    def __init__(self, gdf: gpd.GeoDataFrame, columns: list):
+        gdf = gdf[[*columns, gdf.geometry.name]]
+        self.gdf = gdf[~gdf.geometry.isna()].to_crs(3857)
+
+    def extent(self) -> tuple:
+        return None if self.gdf.empty else tuple(self.gdf.total_bounds)
+
+    def window(self, bounds: tuple, min_size: float) -> gpd.GeoDataFrame:
+        # features smaller than min_size are dropped by `_zoom_tasks`
+        return self.gdf.iloc[np.sort(self.gdf.sindex.query(shapely.box(*bounds)))]
+
+
+class TableSource:
+    """Windows of a PostGIS table, read with bbox queries on its spatial index (streaming path).
+
+    Features smaller than the pixel of the zoom are filtered in the database, so
+    a window holds what shows at that zoom, never the whole layer.
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        columns: list,
+        geometry_column: str = "geometry",
+        schema: str = "public",
+        srid: int = 4326,
+        database_url: str = "",
+    ):
+        self.columns = columns
+        self.geometry = sql.Identifier(geometry_column)
+        self.table = sql.Identifier(schema, table_name)
+        self.srid = srid
+        self.pool = get_pool(database_url)
+
+    def extent(self) -> tuple:
+        query = sql.SQL(EXTENT_QUERY).format(geometry=self.geometry, table=self.table)
+        with self.pool.connection() as conn:
+            row = conn.execute(query, {"srid": self.srid}).fetchone()
+        return None if row[0] is None else row
+
+    def window(self, bounds: tuple, min_size: float) -> gpd.GeoDataFrame:
+        query = sql.SQL(WINDOW_QUERY).format(
+            columns=sql.SQL("").join(sql.SQL("{}, ").format(sql.Identifier(c)) for c in self.columns),
+            geometry=self.geometry,
+            table=self.table,
+        )
+        xmin, ymin, xmax, ymax = bounds
+        params = {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax, "srid": self.srid, "min_size": min_size}
+        with self.pool.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        df = pd.DataFrame([row[:-1] for row in rows], columns=self.columns)
+        geometry = shapely.from_wkb([bytes(row[-1]) for row in rows])
+        return gpd.GeoDataFrame(df, geometry=gpd.GeoSeries(geometry, crs=3857))
+
+
+def build_pmtiles(
+    source,
+    path_base: str,
+    layer: str,
+    minzoom: int = 0,
+    maxzoom: int = 12,
+    columns: list = None,
+    workers: int = None,
+) -> str:
+    """Write a vector tile pyramid of a layer to `<path_base>.pmtiles`.
+
+    Per zoom, geometries are simplified to half a pixel, features smaller than
+    a pixel are dropped, tiles keep at most MAX_FEATURES (the largest) and only
+    `columns` are kept as attributes. Every zoom is built window by window (the
+    tiles WINDOW_ZOOMS levels up), so only the features of one window are in
+    memory; its tiles are encoded in parallel processes and written right away.
+
+    Args:
+        source (GeoDataFrame | TableSource): Layer to tile.
+        path_base (str): Output path without extension.
+        layer (str): Name of the MVT layer.
+        minzoom (int, optional): Defaults to 0
+        maxzoom (int, optional): Defaults to 12
+        columns (list, optional): Attributes kept in the tiles. Defaults to None (no attribute)
+        workers (int, optional): Number of processes. Defaults to the number of CPUs
+    Return:
+        str: Path of the PMTiles archive.
+    """
+    path = f"{path_base}.pmtiles"
+    start = time.perf_counter()
+    columns = list(columns or [])
+    if isinstance(source, gpd.GeoDataFrame):
+        source = FrameSource(source, columns)
+    extent = source.extent()
+    if extent is None:
+        raise ValueError(f"No geometry to tile for {layer}")
+    to_lonlat = Transformer.from_crs(3857, 4326, always_xy=True)
+    (lon_min, lon_max), (lat_min, lat_max) = to_lonlat.transform(extent[::2], extent[1::2])
+
+    count = 0
+    fields = {}
+    with open(path, "wb") as f, ProcessPoolExecutor(max_workers=workers) as executor:
+        writer = Writer(f)
+        for z in range(minzoom, maxzoom + 1):
+            wz = max(0, z - WINDOW_ZOOMS)
+            tiles = 0
+            for wx, wy in _windows(extent, wz):
+                gdf = source.window(tile_bounds(wz, wx, wy), pixel_size(z) * MIN_SIZE_PX)
+                if gdf.empty:
+                    continue
+                fields.update(_fields(gdf, columns))
+                tasks = list(_zoom_tasks(gdf, z, layer, columns, (wz, wx, wy)))
+                encoded = [t for t in executor.map(_encode_tile, tasks, chunksize=4) if t]
+                # windows are visited in tile id order and hold a contiguous range of
+                # tile ids, so the tiles are written in order, for a clustered archive
+                for tileid, data in sorted(encoded, key=lambda t: t[0]):
+                    writer.write_tile(tileid, data)
+                tiles += len(encoded)
+            count += tiles
+            logger.info(f"{layer}: zoom {z}, {tiles} tiles")
+        if not count:
+            raise ValueError(f"No tile to write for {layer}")
+        writer.finalize(
+            {
+                "tile_type": TileType.MVT,
+                "tile_compression": Compression.GZIP,
+                "min_lon_e7": int(lon_min * 1e7),
+                "min_lat_e7": int(lat_min * 1e7),
+                "max_lon_e7": int(lon_max * 1e7),
+                "max_lat_e7": int(lat_max * 1e7),
+                "center_zoom": minzoom,
+                "center_lon_e7": int((lon_min + lon_max) / 2 * 1e7),
+                "center_lat_e7": int((lat_min + lat_max) / 2 * 1e7),
+            },
+            {
+                "vector_layers": [
+                    {
+                        "id": layer,
+                        "fields": {c: fields.get(c, "String") for c in columns},
+                        "minzoom": minzoom,
+                        "maxzoom": maxzoom,
+                    }
+                ]
+            },
+        )
+    logger.info(f"Wrote {count} tiles to {path} in {time.perf_counter() - start:.1f}s")
+    return path
+
+
+def tiles_asset(path: str, minzoom: int, maxzoom: int) -> dict:
+    return {
+        "href": path,
+        "type": MEDIA_TYPE,
+        "roles": ["tiles"],
+        "title": f"Vector tiles, zoom {minzoom}-{maxzoom}",
+    }
+
+
+@timed("tiles")
+def tiles_stage(
+    gdf: gpd.GeoDataFrame,
+    table_name: str,
+    path_base: str,
+    layer: str,
+    minzoom: int = 0,
+    maxzoom: int = 12,
+    columns: list = None,
+    workers: int = None,
+) -> dict:
+    """Optional dataset stage: tile a loaded layer and return its STAC asset.
+
+    gdf is None on the streaming path, the layer is then read window by window
+    from its (loaded) table, see `TableSource`.
+
+    Return:
+        dict: {"tiles": asset} to add to the item assets.
+    """
+    source = TableSource(table_name, list(columns or [])) if gdf is None else gdf
+    path = build_pmtiles(source, path_base, layer, minzoom, maxzoom, columns, workers)
+    return {"tiles": tiles_asset(path, minzoom, maxzoom)}
@@ -1,26 +1,49 @@
 import subprocess
 import json
 import os
-from sqlalchemy import create_engine as sqlalchemy_create_engine, inspect, exc
+from concurrent.futures import wait
+from sqlalchemy import create_engine as sqlalchemy_create_engine, exc
 import logging
 import geopandas as gpd
 from psycopg2 import sql, errors
 from shapely.geometry import box
+import numpy as np
+from .artifacts import ArtifactWriter
+from .bulk_load import COPY_WORKERS, BulkLoader, copy_postgis
+from .db import get_pool
+from .optimize import hilbert_sort, optimize_table
+from .partition import PartitionedLoader, copy_postgis_partitioned
+from .instrument import stage
+from .stac import hull_points
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-db_engine = sqlalchemy_create_engine(os.environ["DATABASE_URL"])
+EXIST_TABLE_QUERY = """
+SELECT EXISTS (
+    SELECT 1 FROM information_schema.tables
+    WHERE table_name = %s AND table_schema = ANY(current_schemas(false))
+)
+"""
 
+_engines = {}
 
-def create_engine(database_url: str):
+
+def create_engine(database_url: str = ""):
     """
     Simple memoized function to wrap around sqlalchemy's
     create_engine, and return a cached engine if it exists.
 
-    If we are keeping this, consider using a memoize decorator.
+    Engines are created on first use, so importing this module (e.g. in a
+    worker process) does not open anything.
     """
-    return db_engine
+    if not database_url:
+        database_url = os.environ["DATABASE_URL"]
+    if database_url not in _engines:
+        _engines[database_url] = sqlalchemy_create_engine(
+            database_url, pool_size=1, max_overflow=1, pool_pre_ping=True
+        )
+    return _engines[database_url]
 
 
 def create_pk(table_name: str, field_name: str):
@@ -64,8 +87,9 @@ def exist_table(table_name: str, database_url: str = ""):
         if not database_url:
             database_url = os.environ.get("DATABASE_URL")
 
-        insp = inspect(create_engine(database_url))
-        return insp.has_table(table_name)
+        with get_pool(database_url).connection() as conn:
+            cur = conn.execute(EXIST_TABLE_QUERY, (table_name,))
+            return cur.fetchone()[0]
     except Exception as ex:
         logger.error(ex.__str__())
         raise
@@ -79,10 +103,18 @@ def save_postgis(
     index: bool = True,
     schema: str = "public",
     table_id: str = "id",
+    method: str = "copy",
+    optimize: dict = None,
+    partition: dict = None,
+    workers: int = COPY_WORKERS,
     **kwargs,
 ):
     """Save a GeoDataFrame to PostGIS.
 
+    By default rows are bulk loaded with binary COPY (see `bulk_load.copy_postgis`),
+    the primary key and GiST index are built after the load. Other keyword
+    arguments are passed to `to_postgis` (e.g. dtype), which is used when any is given.
+
     Args:
         gdf (object): A GeoDataFrame object.
         table_name (str): The name of the table to be created in PostGIS.
@@ -91,40 +123,183 @@ def save_postgis(
         index (bool, optional): Used to Save the index of a dataframe as an additional column in the database.
         schema (str, optional): Used to Specify the schema of the table. Defaults to 'public'
         table_id (str, optional): Used to Specify the id for table. Defaults to 'id'
+        method (str, optional): "copy" for the bulk loader or "to_postgis" for `GeoDataFrame.to_postgis`. Defaults to 'copy'
+        optimize (dict, optional): Arguments for `optimize.optimize_table` (e.g. {"cluster": "hilbert"}), run once the data is loaded. Defaults to None (no optimization)
+        partition (dict, optional): Load into a LIST partitioned table, e.g. {"by": "h3", "level": 3}, see `partition.PartitionedLoader`. Defaults to None (one table)
+        workers (int, optional): Maximum number of connections used for the COPY. Defaults to COPY_WORKERS
+    Return:
+        int: Number of rows saved.
+    Raises:
+        Exception: Errors of the load are logged and raised.
     """
-    try:
-        if not database_url:
-            database_url = os.environ.get("DATABASE_URL")
+    if not database_url:
+        database_url = os.environ.get("DATABASE_URL")
 
-        # make add global bbox as a geometry to non-spatial tables so they show up in pygeoapi
-        if not isinstance(gdf, gpd.GeoDataFrame):
-            logger.debug("Adding geometry field to non-geo dataframe")
-            gdf["geometry"] = box(-180, -90, 180, 90)
-            gdf = gpd.GeoDataFrame(gdf, crs="EPSG:4326", geometry="geometry")
+    # make add global bbox as a geometry to non-spatial tables so they show up in pygeoapi
+    if not isinstance(gdf, gpd.GeoDataFrame):
+        logger.debug("Adding geometry field to non-geo dataframe")
+        gdf["geometry"] = box(-180, -90, 180, 90)
+        gdf = gpd.GeoDataFrame(gdf, crs="EPSG:4326", geometry="geometry")
 
-        engine = create_engine(database_url)
-        has_table = exist_table(table_name)
+    if kwargs and partition:
+        raise ValueError(f"{sorted(kwargs)} are not supported with partition")
+    if kwargs and method == "copy":
+        logger.warning(f"{sorted(kwargs)} are arguments of to_postgis, saving {table_name} with to_postgis")
+        method = "to_postgis"
+
+    try:
+        if optimize and optimize.get("cluster") == "hilbert":
+            gdf = hilbert_sort(gdf)
 
         logger.debug(f"saving data to {table_name} in postgis")
-        gdf.to_postgis(
-            con=engine,
-            name=table_name,
+        with stage("db_load", table=table_name, method=method, partitioned=bool(partition)) as span:
+            if partition:
+                rows = copy_postgis_partitioned(
+                    gdf,
+                    table_name,
+                    partition,
+                    database_url=database_url,
+                    if_exists=if_exists,
+                    index=index,
+                    schema=schema,
+                    table_id=table_id,
+                )
+            elif method == "copy":
+                rows = copy_postgis(
+                    gdf,
+                    table_name,
+                    database_url=database_url,
+                    if_exists=if_exists,
+                    index=index,
+                    schema=schema,
+                    table_id=table_id,
+                    workers=workers,
+                )
+            else:
+                engine = create_engine(database_url)
+                has_table = exist_table(table_name)
+                gdf.to_postgis(
+                    con=engine,
+                    name=table_name,
+                    if_exists=if_exists,
+                    index=index,
+                    schema=schema,
+                    **kwargs,
+                )
+                rows = len(gdf)
+                if table_id and not has_table:
+                    create_pk(table_name, table_id)
+            span.add(rows=rows)
+
+        if optimize:
+            optimize_table(
+                table_name,
+                geometry_column=gdf.geometry.name,
+                schema=schema,
+                database_url=database_url,
+                **optimize,
+            )
+    except Exception as ex:
+        logger.error(f"Could not save {table_name}: {ex}")
+        raise
+    return rows
+
+
+def save_postgis_chunks(
+    chunks,
+    table_name: str,
+    path_base: str,
+    artifact_format: str = "geoparquet",
+    database_url: str = "",
+    if_exists: str = "replace",
+    schema: str = "public",
+    table_id: str = "id",
+    optimize: dict = None,
+    partition: dict = None,
+):
+    """Save a stream of GeoDataFrames to PostGIS and to an artifact file.
+
+    Each chunk is appended to the artifact in a background thread while it is
+    COPYed into the staging table, so only a couple of chunks are in memory at
+    any time. The staging table is created from the first chunk: its geometry
+    column accepts any geometry type, and the other column types follow the
+    dtypes of the chunks, which `readers.read_chunks` derives from the arrow
+    schema of the source. Chunks can't be Hilbert sorted as a whole, so a "hilbert"
+    optimization is done server side with CLUSTER instead.
+
+    Args:
+        chunks (iterable): GeoDataFrames sharing the same columns (e.g. from `readers.read_chunks`).
+        table_name (str): The name of the table to be created in PostGIS.
+        path_base (str): Artifact path without extension.
+        artifact_format (str, optional): See `artifacts.ARTIFACT_FORMATS`. Defaults to 'geoparquet'
+        database_url (str, optional): The URL for the database connection. Defaults to an environment variable called DATABASE_URL if not provided explicitly.
+        if_exists (str, optional): "fail", "replace", or "append". Defaults to 'replace'.
+        schema (str, optional): Used to Specify the schema of the table. Defaults to 'public'
+        table_id (str, optional): Used to Specify the id for table. Defaults to 'id'
+        optimize (dict, optional): Arguments for `optimize.optimize_table`. Defaults to None
+        partition (dict, optional): Load into a LIST partitioned table, see `save_postgis`. Defaults to None
+    Return:
+        dict: {"rows": int, "artifact": path, "bounds": hull points for `create_stac_item`, "crs": crs}
+    """
+    hulls = []
+    crs = None
+    # the span includes reading the chunks, which are consumed by the load
+    if partition:
+        loader = PartitionedLoader(
+            table_name,
+            partition,
+            database_url=database_url,
             if_exists=if_exists,
-            index=index,
             schema=schema,
-            **kwargs,
+            table_id=table_id,
         )
-        if table_id and not has_table:
-            create_pk(table_name, table_id)
-
-    except Exception as ex:
-        logger.error(ex.__str__())
-        return {"statusCode": 500, "msj": ex.__str__()}
     else:
-        return {
-            "statusCode": 200,
-            "msj": "the data has been saved successfully",
-        }
+        loader = BulkLoader(
+            table_name,
+            database_url=database_url,
+            if_exists=if_exists,
+            schema=schema,
+            table_id=table_id,
+            # the first chunk may only have Polygons and a later one MultiPolygons
+            geometry_type="Geometry",
+        )
+    with stage("db_load", table=table_name, method="chunks", partitioned=bool(partition)) as span:
+        with ArtifactWriter(path_base, artifact_format) as writer, loader:
+            pending = None
+            try:
+                for gdf in chunks:
+                    if pending:
+                        pending.result()
+                    pending = writer.write_async(gdf)
+                    loader.write(gdf)
+                    hulls.append(hull_points(gdf.geometry.bounds.to_numpy()))
+                    crs = gdf.crs
+                if pending:
+                    pending.result()
+            finally:
+                # the artifact thread must be done before the writer is closed,
+                # its error (if any) is secondary to the one being raised
+                if pending:
+                    wait([pending])
+        span.add(rows=loader.rows, bytes=os.path.getsize(writer.path) if os.path.exists(writer.path) else 0)
+
+    if optimize and loader.rows:
+        optimize = dict(optimize)
+        if optimize.get("cluster") == "hilbert":
+            optimize["cluster"] = "cluster"
+        optimize_table(
+            table_name,
+            geometry_column=loader.geometry_column or "geometry",
+            schema=schema,
+            database_url=database_url,
+            **optimize,
+        )
+    return {
+        "rows": loader.rows,
+        "artifact": writer.path,
+        "bounds": np.vstack(hulls) if hulls else np.empty((0, 4)),
+        "crs": crs,
+    }
 
 
 def run_cli(pre_commands: list, file: str, args: dict):
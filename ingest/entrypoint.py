@@ -1,23 +1,106 @@
+import json
+import sys
 import click
-import importlib
-from config import DATASETS
+from config import DATASETS, MAX_WORKERS
+from orchestrator import load_collection, run, run_dataset
 
 
-def run_dataset(dataset):
-    if dataset not in DATASETS:
-        raise ValueError(f"Unknown dataset: {dataset}")
+class DatasetGroup(click.Group):
+    """Also accept `entrypoint.py <dataset>`, which runs a single dataset as before."""
 
-    dataset_config = DATASETS[dataset]
-    module = importlib.import_module(dataset_config["module"])
-    process_function = getattr(module, dataset_config["function"])
-    process_function(**dataset_config["params"])
+    def get_command(self, ctx, cmd_name):
+        command = super().get_command(ctx, cmd_name)
+        if command is not None or cmd_name not in DATASETS:
+            return command
 
+        def run_single():
+            if DATASETS[cmd_name].get("collection"):
+                load_collection(cmd_name)
+            run_dataset(cmd_name)
 
-@click.command()
-@click.argument("dataset")
-def main(dataset):
-    """Run processing script for a specific dataset."""
-    run_dataset(dataset)
+        return click.Command(cmd_name, callback=run_single, help=f"Run {cmd_name} only.")
+
+
+def _exit(ok):
+    sys.exit(0 if ok else 1)
+
+
+def orchestrator_options(f):
+    f = click.option("--max-workers", default=MAX_WORKERS, show_default=True, help="Worker processes.")(f)
+    f = click.option("--dry-run", is_flag=True, help="Print the execution plan and exit.")(f)
+    return f
+
+
+@click.group(cls=DatasetGroup)
+def main():
+    """Run processing scripts for the datasets in config.DATASETS."""
+
+
+@main.command("run")
+@click.option("--datasets", required=True, help="Comma separated dataset names.")
+@click.option("--with-deps", is_flag=True, help="Also run the datasets they depend on.")
+@orchestrator_options
+def run_command(datasets, with_deps, max_workers, dry_run):
+    """Run some datasets concurrently, in dependency order."""
+    names = [d.strip() for d in datasets.split(",") if d.strip()]
+    _exit(run(names, with_deps=with_deps, max_workers=max_workers, dry_run=dry_run))
+
+
+@main.command("run-all")
+@orchestrator_options
+def run_all(max_workers, dry_run):
+    """Run every dataset concurrently, in dependency order."""
+    _exit(run(list(DATASETS), max_workers=max_workers, dry_run=dry_run))
+
+
+@main.command("worker")
+@click.option("--poll-interval", type=float, default=None, help="Seconds between polls of an empty queue.")
+@click.option("--max-jobs", type=int, default=None, help="Exit after that many jobs.")
+@click.option("--exit-when-empty", is_flag=True, help="Exit once the queue is empty.")
+def worker(poll_interval, max_jobs, exit_when_empty):
+    """Run jobs from the ingest.jobs queue in a long running process."""
+    from worker import POLL_INTERVAL, Worker
+
+    _exit(
+        Worker(
+            poll_interval=POLL_INTERVAL if poll_interval is None else poll_interval,
+            max_jobs=max_jobs,
+            exit_when_empty=exit_when_empty,
+        ).run()
+    )
+
+
+@main.command("enqueue")
+@click.argument("dataset", type=click.Choice(list(DATASETS)))
+@click.option("--params", default="{}", help="JSON object overriding the dataset params.")
+@click.option("--priority", type=int, default=0, show_default=True, help="Higher runs first.")
+@click.option("--max-attempts", type=int, default=1, show_default=True)
+def enqueue_command(dataset, params, priority, max_attempts):
+    """Queue a run of DATASET for the workers."""
+    from worker import enqueue
+
+    click.echo(enqueue(dataset, json.loads(params), priority=priority, max_attempts=max_attempts))
+
+
+@main.command("watch-shakemap")
+@click.option("--feed-url", default=None, help="USGS GeoJSON feed, URL or local file. Defaults to the significant events of the week.")
+@click.option("--interval", type=float, default=None, help="Seconds between polls of the feed.")
+@click.option("--min-magnitude", type=float, default=None, help="Ignore the events below this magnitude.")
+@click.option("--max-polls", type=int, default=None, help="Exit after that many polls.")
+def watch_shakemap(feed_url, interval, min_magnitude, max_polls):
+    """Poll the USGS feed and load new or updated shakemaps as they are published."""
+    from datasets.shakemap_peak.process import FEED_URL, POLL_INTERVAL, watch
+
+    params = DATASETS["shakemap_peak"]["params"]
+    watch(
+        params["path_local"],
+        feed_url=feed_url or FEED_URL,
+        interval=POLL_INTERVAL if interval is None else interval,
+        optimize=params.get("optimize"),
+        min_magnitude=min_magnitude,
+        max_polls=max_polls,
+        grid=params.get("grid", True),
+    )
 
 
 if __name__ == "__main__":
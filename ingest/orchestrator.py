@@ -0,0 +1,231 @@
+"""Run datasets concurrently, following the dependency DAG declared in config.DATASETS.
+
+Every dataset contributes two stages:
+
+- `<dataset>:collection` upserts its collection.json into pgstac,
+- `<dataset>:items` runs the dataset function (download, tables, STAC items).
+
+Items of a dataset run after its collection stage and after the items stage of
+every dataset listed in its `depends_on` (derived tables after their inputs).
+Ready stages are started as long as the resources they declare (network, cpu,
+db) fit within RESOURCE_LIMITS.
+"""
+
+import importlib
+import logging
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from graphlib import TopologicalSorter
+from config import DATASETS, MAX_WORKERS, RESOURCE_LIMITS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESOURCES = {"network": 1, "cpu": 1, "db": 1}
+COLLECTION_RESOURCES = {"db": 1}
+
+
+def load_collection(dataset):
+    from datasets.pgstac_loader import StacLoader
+
+    with StacLoader() as loader:
+        loader.add_collections(DATASETS[dataset]["collection"])
+
+
+def run_dataset(dataset, params=None):
+    """Run the function of dataset with its config params, updated with params."""
+    if dataset not in DATASETS:
+        raise ValueError(f"Unknown dataset: {dataset}")
+
+    from datasets import instrument
+
+    dataset_config = DATASETS[dataset]
+    module = importlib.import_module(dataset_config["module"])
+    process_function = getattr(module, dataset_config["function"])
+    # stage timings as JSON logs and a Prometheus textfile, see datasets/instrument.py
+    with instrument.run(dataset):
+        process_function(**{**dataset_config["params"], **(params or {})})
+
+
+def run_stage(dataset, stage):
+    """Run one stage in a worker process, return its (start, end) wall clock times."""
+    start = time.time()
+    if stage == "collection":
+        load_collection(dataset)
+    else:
+        run_dataset(dataset)
+    return start, time.time()
+
+
+def build_graph(datasets, with_deps=False):
+    """Return the DAG of stages for datasets, as {stage: set of stages it depends on}.
+
+    Args:
+        datasets (list): Dataset names.
+        with_deps (bool, optional): Also run the datasets they depend on, otherwise
+            their tables are expected to be loaded already. Defaults to False
+    """
+    unknown = [d for d in datasets if d not in DATASETS]
+    if unknown:
+        raise ValueError(f"Unknown dataset(s): {', '.join(unknown)}")
+
+    selected = list(datasets)
+    if with_deps:
+        queue = deque(selected)
+        while queue:
+            for dep in DATASETS[queue.popleft()].get("depends_on", []):
+                if dep not in selected:
+                    selected.append(dep)
+                    queue.append(dep)
+
+    graph = {}
+    for dataset in selected:
+        items = f"{dataset}:items"
+        graph[items] = set()
+        if DATASETS[dataset].get("collection"):
+            graph[f"{dataset}:collection"] = set()
+            graph[items].add(f"{dataset}:collection")
+        for dep in DATASETS[dataset].get("depends_on", []):
+            if dep in selected:
+                graph[items].add(f"{dep}:items")
+    # fail early on cycles
+    tuple(TopologicalSorter(graph).static_order())
+    return graph
+
+
+def stage_resources(node):
+    dataset, stage = node.split(":")
+    if stage == "collection":
+        return COLLECTION_RESOURCES
+    return DATASETS[dataset].get("resources", DEFAULT_RESOURCES)
+
+
+class ResourcePool:
+    """Counters of the network/cpu/db slots in use, bounded by RESOURCE_LIMITS."""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.used = {name: 0 for name in limits}
+
+    def _demand(self, resources):
+        # a stage asking for more than the limit runs alone rather than never
+        return {
+            name: min(amount, self.limits[name])
+            for name, amount in resources.items()
+            if name in self.limits
+        }
+
+    def fits(self, resources):
+        return all(
+            self.used[name] + amount <= self.limits[name]
+            for name, amount in self._demand(resources).items()
+        )
+
+    def acquire(self, resources):
+        for name, amount in self._demand(resources).items():
+            self.used[name] += amount
+
+    def release(self, resources):
+        for name, amount in self._demand(resources).items():
+            self.used[name] -= amount
+
+
+def critical_path(graph, timings):
+    """Return the chain of stages that determined the total wall time.
+
+    Walk back from the last stage to finish, through the dependency that
+    finished last each time.
+    """
+    if not timings:
+        return []
+    node = max(timings, key=lambda n: timings[n][1])
+    path = [node]
+    while True:
+        deps = [d for d in graph[node] if d in timings]
+        if not deps:
+            break
+        node = max(deps, key=lambda d: timings[d][1])
+        path.append(node)
+    return path[::-1]
+
+
+def summary(graph, timings, failed, skipped, started_at):
+    total = time.time() - started_at
+    lines = ["", f"{'stage':<40}{'start':>10}{'duration':>10}"]
+    for node, (start, end) in sorted(timings.items(), key=lambda kv: kv[1][0]):
+        lines.append(f"{node:<40}{start - started_at:>9.1f}s{end - start:>9.1f}s")
+    for node in failed:
+        lines.append(f"{node:<40}{'failed':>20}")
+    for node in skipped:
+        lines.append(f"{node:<40}{'skipped':>20}")
+
+    path = critical_path(graph, timings)
+    busy = sum(timings[n][1] - timings[n][0] for n in path)
+    lines.append("")
+    lines.append(f"Critical path ({busy:.1f}s of {total:.1f}s wall time):")
+    lines.append("  " + " -> ".join(f"{n} ({timings[n][1] - timings[n][0]:.1f}s)" for n in path))
+    work = sum(end - start for start, end in timings.values())
+    lines.append(f"Total stage time {work:.1f}s, parallelism {work / max(total, 1e-6):.2f}x")
+    logger.info("\n".join(lines))
+
+
+def run(datasets, with_deps=False, max_workers=MAX_WORKERS, limits=RESOURCE_LIMITS, dry_run=False):
+    """Run datasets and their stages concurrently, in dependency order.
+
+    Args:
+        datasets (list): Dataset names.
+        with_deps (bool, optional): Also run the datasets they depend on. Defaults to False
+        max_workers (int, optional): Number of worker processes.
+        limits (dict, optional): Slots per resource, e.g. {"network": 3, "cpu": 2, "db": 4}
+        dry_run (bool, optional): Only log the execution plan. Defaults to False
+    Return:
+        bool: True if every stage succeeded.
+    """
+    graph = build_graph(datasets, with_deps=with_deps)
+    if dry_run:
+        for i, node in enumerate(TopologicalSorter(graph).static_order()):
+            deps = ", ".join(sorted(graph[node])) or "-"
+            logger.info(f"{i:>3} {node:<40} after: {deps}  resources: {stage_resources(node)}")
+        return True
+
+    sorter = TopologicalSorter(graph)
+    sorter.prepare()
+    resources = ResourcePool(limits)
+    ready = deque()
+    running = {}
+    timings = {}
+    failed = []
+    started_at = time.time()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while sorter.is_active():
+            ready.extend(sorted(sorter.get_ready()))
+            # start every ready stage whose resources are available, in order
+            for node in list(ready):
+                if len(running) >= max_workers or not resources.fits(stage_resources(node)):
+                    continue
+                ready.remove(node)
+                resources.acquire(stage_resources(node))
+                logger.info(f"Starting {node}")
+                running[executor.submit(run_stage, *node.split(":"))] = node
+
+            if not running:
+                # only stages downstream of a failure are left
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                resources.release(stage_resources(node))
+                try:
+                    timings[node] = future.result()
+                except Exception as ex:
+                    logger.error(f"{node} failed: {ex!r}")
+                    failed.append(node)
+                    continue
+                logger.info(f"Finished {node} in {timings[node][1] - timings[node][0]:.1f}s")
+                sorter.done(node)
+
+    skipped = [n for n in graph if n not in timings and n not in failed]
+    summary(graph, timings, failed, skipped, started_at)
+    return not failed and not skipped
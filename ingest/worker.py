@@ -0,0 +1,269 @@
+"""Long running ingest worker: run dataset jobs queued in Postgres, back to back.
+
+A worker keeps its interpreter warm between jobs: geopandas/pyproj/GDAL and
+the dataset modules are imported once, the DB pool and the download session
+stay open. Jobs are rows of `ingest.jobs` (dataset + params overriding the
+config.DATASETS params), claimed with `FOR UPDATE SKIP LOCKED` so any number
+of workers can pull from the same queue without handing out a job twice.
+
+A running job gets a heartbeat from its worker; a job whose heartbeat stopped
+(e.g. its pod was OOM killed) is requeued by the next worker polling the queue,
+however long a live job runs.
+
+Usage:
+    python entrypoint.py enqueue shakemap_peak --params '{"path_local": "/data/shakemap"}'
+    python entrypoint.py worker
+"""
+
+import importlib
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+import psycopg
+from psycopg.types.json import Jsonb
+from config import DATASETS
+from orchestrator import load_collection, run_dataset
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = float(os.environ.get("INGEST_WORKER_POLL_INTERVAL", 5))
+HEARTBEAT_INTERVAL = float(os.environ.get("INGEST_WORKER_HEARTBEAT_INTERVAL", 30))
+# a running job without heartbeat for this long belongs to a dead worker
+STALE_AFTER = int(os.environ.get("INGEST_WORKER_STALE_AFTER", 300))
+
+CREATE_QUEUE = """
+CREATE SCHEMA IF NOT EXISTS ingest;
+CREATE TABLE IF NOT EXISTS ingest.jobs (
+    id bigserial PRIMARY KEY,
+    dataset text NOT NULL,
+    params jsonb NOT NULL DEFAULT '{}',
+    priority int NOT NULL DEFAULT 0,
+    status text NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    attempts int NOT NULL DEFAULT 0,
+    max_attempts int NOT NULL DEFAULT 1,
+    worker text,
+    error text,
+    enqueued_at timestamptz NOT NULL DEFAULT now(),
+    started_at timestamptz,
+    heartbeat_at timestamptz,
+    finished_at timestamptz
+);
+ALTER TABLE ingest.jobs ADD COLUMN IF NOT EXISTS heartbeat_at timestamptz;
+CREATE INDEX IF NOT EXISTS jobs_queued_idx ON ingest.jobs (priority DESC, id) WHERE status = 'queued';
+"""
+
+ENQUEUE = """
+INSERT INTO ingest.jobs (dataset, params, priority, max_attempts)
+VALUES (%s, %s, %s, %s) RETURNING id
+"""
+
+CLAIM = """
+UPDATE ingest.jobs
+SET status = 'running', worker = %s, started_at = now(), heartbeat_at = now(), attempts = attempts + 1
+WHERE id = (
+    SELECT id FROM ingest.jobs
+    WHERE status = 'queued'
+    ORDER BY priority DESC, id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id, dataset, params
+"""
+
+FINISH = """
+UPDATE ingest.jobs
+SET status = CASE
+        WHEN %(error)s::text IS NULL THEN 'done'
+        WHEN attempts < max_attempts THEN 'queued'
+        ELSE 'failed'
+    END,
+    error = %(error)s,
+    finished_at = now()
+WHERE id = %(id)s
+"""
+
+REQUEUE_STALE = """
+UPDATE ingest.jobs
+SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+    error = 'worker lost'
+WHERE status = 'running' AND coalesce(heartbeat_at, started_at) < now() - %s * interval '1 second'
+RETURNING id
+"""
+
+HEARTBEAT = """
+UPDATE ingest.jobs SET heartbeat_at = now() WHERE id = %s AND status = 'running'
+"""
+
+
+def _pool():
+    from datasets.db import get_pool
+
+    return get_pool()
+
+
+def ensure_queue():
+    """Create the `ingest.jobs` queue table if needed."""
+    with _pool().connection() as conn:
+        conn.execute(CREATE_QUEUE)
+
+
+def enqueue(dataset: str, params: dict = None, priority: int = 0, max_attempts: int = 1) -> int:
+    """Queue a run of dataset, params override its config.DATASETS params.
+
+    Return:
+        int: Job id.
+    """
+    if dataset not in DATASETS:
+        raise ValueError(f"Unknown dataset: {dataset}")
+    ensure_queue()
+    with _pool().connection() as conn:
+        cur = conn.execute(ENQUEUE, (dataset, Jsonb(params or {}), priority, max(1, max_attempts)))
+        job_id = cur.fetchone()[0]
+    logger.info(f"Queued job {job_id}: {dataset} {json.dumps(params or {})}")
+    return job_id
+
+
+def claim(worker_id: str):
+    """Take the next queued job, return (id, dataset, params) or None when the queue is empty."""
+    with _pool().connection() as conn:
+        return conn.execute(CLAIM, (worker_id,)).fetchone()
+
+
+def finish(job_id: int, error: str = None):
+    with _pool().connection() as conn:
+        conn.execute(FINISH, {"id": job_id, "error": error})
+
+
+def requeue_stale(stale_after: int = STALE_AFTER) -> list:
+    with _pool().connection() as conn:
+        job_ids = [row[0] for row in conn.execute(REQUEUE_STALE, (stale_after,)).fetchall()]
+    if job_ids:
+        logger.warning(f"Requeued jobs of lost workers: {job_ids}")
+    return job_ids
+
+
+class Heartbeat:
+    """Touch `heartbeat_at` of a running job every interval seconds, from a thread.
+
+    The heartbeat has its own connection: the job may hold every pooled one
+    (e.g. a parallel COPY) for longer than STALE_AFTER.
+    """
+
+    def __init__(self, job_id: int, interval: float = HEARTBEAT_INTERVAL):
+        self.job_id = job_id
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, name=f"heartbeat-{job_id}", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def _beat(self):
+        from datasets.db import conninfo
+
+        conn = None
+        while not self._stop.wait(self.interval):
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg.connect(conninfo(), autocommit=True)
+                conn.execute(HEARTBEAT, (self.job_id,))
+            except Exception as ex:
+                # the next beat reconnects, the job is only requeued after STALE_AFTER
+                logger.warning(f"Heartbeat of job {self.job_id} failed: {ex!r}")
+                if conn is not None:
+                    conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+
+def warm_up(datasets=None):
+    """Import the dataset modules and open the DB pool and the download session once."""
+    start = time.perf_counter()
+    for name in datasets or DATASETS:
+        try:
+            importlib.import_module(DATASETS[name]["module"])
+        except ImportError as ex:
+            logger.warning(f"Could not import {name}: {ex}")
+    from datasets.download import get_session
+
+    _pool().wait()
+    get_session()
+    logger.info(f"Worker warmed up in {time.perf_counter() - start:.1f}s")
+
+
+class Worker:
+    """Run queued jobs in this process until stopped.
+
+    Collections are upserted the first time a dataset runs in the worker.
+
+    Args:
+        poll_interval (float, optional): Seconds to wait when the queue is empty. Defaults to INGEST_WORKER_POLL_INTERVAL
+        max_jobs (int, optional): Exit after that many jobs, e.g. to recycle memory. Defaults to None (no limit)
+        exit_when_empty (bool, optional): Exit once the queue is empty. Defaults to False
+    """
+
+    def __init__(self, poll_interval: float = POLL_INTERVAL, max_jobs: int = None, exit_when_empty: bool = False):
+        self.poll_interval = poll_interval
+        self.max_jobs = max_jobs
+        self.exit_when_empty = exit_when_empty
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.collections = set()
+        self.done = 0
+        self.failed = 0
+        self.stopping = False
+
+    def stop(self, signum=None, frame=None):
+        """Stop once the current job is finished (SIGTERM/SIGINT)."""
+        logger.info("Stopping after the current job")
+        self.stopping = True
+
+    def run_job(self, job_id: int, dataset: str, params: dict):
+        start = time.perf_counter()
+        logger.info(f"Job {job_id}: {dataset} {json.dumps(params)}")
+        try:
+            if dataset not in self.collections and DATASETS[dataset].get("collection"):
+                load_collection(dataset)
+                self.collections.add(dataset)
+            with Heartbeat(job_id):
+                run_dataset(dataset, params)
+        except Exception as ex:
+            logger.error(f"Job {job_id} failed: {ex!r}")
+            finish(job_id, error="".join(traceback.format_exception(type(ex), ex, ex.__traceback__))[-4000:])
+            self.failed += 1
+        else:
+            finish(job_id)
+            self.done += 1
+            logger.info(f"Job {job_id} done in {time.perf_counter() - start:.1f}s")
+
+    def run(self) -> bool:
+        """Process jobs, return True if none failed."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        ensure_queue()
+        warm_up()
+        logger.info(f"Worker {self.worker_id} waiting for jobs")
+        while not self.stopping and (self.max_jobs is None or self.done + self.failed < self.max_jobs):
+            # any live worker requeues the jobs of the dead ones
+            requeue_stale()
+            job = claim(self.worker_id)
+            if job is None:
+                if self.exit_when_empty:
+                    break
+                time.sleep(self.poll_interval)
+                continue
+            self.run_job(*job)
+        logger.info(f"Worker {self.worker_id} stopping: {self.done} jobs done, {self.failed} failed")
+        return not self.failed